@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmarks of the device layer run against the synthetic
+# backend, so no real hardware is needed. Example:
+#
+#   $ python bench/bench_device.py --disks 1000 --partitions 4
+#
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from installer import l10n
+from installer import device
+from installer.synthetic import SyntheticBackend, _sd_name
+from installer.utils import GiB, TiB
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="device layer benchmarks")
+    parser.add_argument("--disks", type=int, default=500,
+                        help="number of synthetic disks (default: 500)")
+    parser.add_argument("--partitions", type=int, default=4,
+                        help="number of partitions per disk (default: 4)")
+    parser.add_argument("--md", type=int, default=16,
+                        help="number of RAID1 arrays built on partitions")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of runs per benchmark (default: 20)")
+    return parser.parse_args()
+
+
+def describe(args):
+    half = args.disks // 2
+    description = {
+        'disks': [
+            {'count': half, 'bus': 'ata', 'size': 4 * TiB,
+             'rotational': True, 'partitions': args.partitions},
+            {'count': args.disks - half, 'bus': 'scsi', 'size': 960 * GiB,
+             'rotational': False, 'partitions': args.partitions},
+        ],
+        'loop': 8,
+        'ram': 16,
+        'md': [],
+    }
+    # Build RAID1 arrays on the last partition of pairs of disks.
+    for i in range(min(args.md, half // 2)):
+        members = [_sd_name(2 * i) + str(args.partitions),
+                   _sd_name(2 * i + 1) + str(args.partitions)]
+        description['md'].append({'level': 'raid1', 'members': members})
+    return description
+
+
+def bench(name, func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    print("%-32s min %9.3f ms   median %9.3f ms   max %9.3f ms" %
+          (name, timings[0] * 1000, timings[len(timings) // 2] * 1000,
+           timings[-1] * 1000))
+
+
+def main():
+    args = parse_cmdline()
+    l10n.set_language('')
+
+    if args.partitions < 1 and args.md:
+        args.md = 0
+
+    start = time.time()
+    backend = SyntheticBackend(describe(args))
+    device.set_backend(backend)
+    device.wait_enumeration()
+    print("%d devices enumerated in %.3f ms" %
+          (len(backend.devices), (time.time() - start) * 1000))
+
+    # Imported lately since the partition module listens to uevents.
+    from installer import disk
+    from installer import partition
+
+    bench("leaf_block_devices()", device.leaf_block_devices, args.repeat)
+    bench("disk.get_candidates()", disk.get_candidates, args.repeat)
+    bench("disk.get_candidates() (uncached)",
+          lambda: (device.invalidate(), disk.get_candidates()), args.repeat)
+
+    candidates = [bdev for group in disk.get_candidates() for bdev in group]
+    bench("disk.select_candidates()",
+          lambda: disk.select_candidates(candidates), args.repeat)
+    bench("partition.get_candidates()",
+          lambda: partition.get_candidates(partition.root), args.repeat)
+
+    storm = list(backend.repartition_storm())
+    bench("repartition storm (%d events)" % len(storm),
+          lambda: backend.replay(storm), max(1, args.repeat // 10))
+    bench("repartition storm (%d events, unbatched)" % len(storm),
+          lambda: backend.replay(storm, batch=False), max(1, args.repeat // 10))
+
+    storm = list(backend.mkfs_storm())
+    bench("mkfs storm (%d events)" % len(storm),
+          lambda: backend.replay(storm), max(1, args.repeat // 10))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Compute the alignment of the partitions from the I/O topology
+# reported by the disks (physical block size, minimum and optimal I/O
+# sizes, alignment offset) and, for RAID members, from the chunk size
+# of the arrays built on top of them.
+#
+# Partitions start on a multiple of the grain (plus the alignment
+# offset of the disk) and their size is a multiple of it too. The
+# grain is at least 1MiB like most partitioning tools do, which also
+# covers 4K physical sectors, SSD pages and RAID chunks in practice.
+#
+from __future__ import unicode_literals
+
+import logging
+
+from .utils import KiB, MiB, pretty_size
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_GRAIN = 1 * MiB
+# For small disks (<256Mo) use 64 sectors alignment to avoid wasting
+# too much space.
+SMALL_DISK_SIZE  = 256 * MiB
+SMALL_DISK_GRAIN = 32 * KiB
+# Some devices report bogus optimal I/O sizes (USB bridges for
+# example), ignore them if they make the grain larger than this.
+MAX_GRAIN = 16 * MiB
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def _lcm(a, b):
+    if not a or not b:
+        return a or b
+    return a * b // _gcd(a, b)
+
+
+class Alignment(object):
+
+    __slots__ = ('grain', 'stripe')
+
+    def __init__(self, grain, stripe=0):
+        self.grain = grain      # bytes
+        self.stripe = stripe    # chunk × data disks, 0 if no RAID
+
+    def offset(self, bdev):
+        """Returns the offset in bytes of the aligned boundaries of
+        'bdev' from its start"""
+        # The kernel reports -1 when the device can't be aligned at
+        # all.
+        return max(bdev.alignment_offset, 0) % self.grain
+
+    def align_size(self, size):
+        """Round 'size' down to a multiple of the grain"""
+        return int(size) // self.grain * self.grain
+
+    def __str__(self):
+        s = "grain %s" % pretty_size(self.grain)
+        if self.stripe:
+            s += ", stripe %s" % pretty_size(self.stripe)
+        return s
+
+
+def _disk_grain(bdev):
+    grain = _lcm(bdev.physical_block_size, bdev.minimum_io_size)
+    opt = bdev.optimal_io_size
+    if opt and opt % grain == 0:
+        grain = opt
+    return grain
+
+
+def plan(disks, chunk=0, data_disks=1):
+    """Returns the Alignment of the partitions created on 'disks'.
+    If the partitions are RAID members, 'chunk' is the chunk size of
+    the array and 'data_disks' the number of members holding data in a
+    stripe."""
+    default = DEFAULT_GRAIN
+    if min(d.size for d in disks) < SMALL_DISK_SIZE:
+        default = SMALL_DISK_GRAIN
+
+    grain = _lcm(default, chunk)
+    for d in disks:
+        disk_grain = _lcm(grain, _disk_grain(d))
+        if disk_grain > MAX_GRAIN:
+            logger.debug("%s: ignoring optimal I/O size %d", d.devpath,
+                         d.optimal_io_size)
+            disk_grain = _lcm(grain, _lcm(d.physical_block_size, d.minimum_io_size))
+        grain = disk_grain
+
+    alignment = Alignment(grain, chunk * data_disks)
+    logger.debug("partition alignment: %s", alignment)
+    return alignment
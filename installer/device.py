@@ -7,11 +7,16 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import time
 import threading
 import logging
-from gi.repository import GUdev
+import functools
+from collections import OrderedDict
 from .utils import pretty_size
-from .process import monitor, check_output, CalledProcessError
+from .process import monitor
+from .mountinfo import mount_table
+from .uevent import UeventBatcher
+from . import lockstat
 
 
 logger = logging.getLogger(__name__)
@@ -24,84 +29,516 @@ PRIORITY_LOW     = 20
 PRIORITY_DEFAULT = 50
 PRIORITY_HIGH    = 70
 
-
-#class RLock(object):
 #
-#    def __init__(self):
-#        self._lock = threading.RLock()
+# Performance classes of the disks, from the fastest to the slowest.
+# Each class has its own priority so disks of different classes are
+# never mixed and the fastest ones are preferred.
+#
+DEVICE_CLASS_NVME      = 'nvme'
+DEVICE_CLASS_SSD       = 'ssd'
+DEVICE_CLASS_HDD       = 'hdd'
+DEVICE_CLASS_REMOVABLE = 'removable'
+
+_class_priorities = {
+    DEVICE_CLASS_NVME      : PRIORITY_DEFAULT + 15,
+    DEVICE_CLASS_SSD       : PRIORITY_DEFAULT + 10,
+    DEVICE_CLASS_HDD       : PRIORITY_DEFAULT + 5,
+    DEVICE_CLASS_REMOVABLE : PRIORITY_DEFAULT,
+}
+
+# Transports used by removable media (USB sticks, card readers...).
+_removable_transports = ('usb', 'ieee1394', 'memstick')
+
+
 #
-#    def acquire(self):
-#        import inspect
-#        logger.debug("pre-acquire %s %s" % (threading.current_thread().name,
-#                                            inspect.stack()[1][3]))
-#        self._lock.acquire()
-#        logger.debug("acquired %s %s" % (threading.current_thread().name,
-#                                         inspect.stack()[1][3]))
+# Sysfs attributes copied into the device snapshots. Any other
+# attribute is simply not available through the BlockDevice API.
 #
-#    def release(self):
-#        import inspect
-#        logger.debug("pre-release %s %s" % (threading.current_thread().name,
-#                                            inspect.stack()[1][3]))
-#        self._lock.release()
-#        logger.debug("released %s %s" % (threading.current_thread().name,
-#                                      inspect.stack()[1][3]))
+_SYSFS_ATTRS = ('size', 'ro', 'removable', 'queue/rotational',
+                'queue/nr_requests', 'queue/logical_block_size',
+                'queue/physical_block_size', 'queue/minimum_io_size',
+                'queue/optimal_io_size', 'queue/discard_max_bytes',
+                'queue/discard_zeroes_data', 'queue/write_zeroes_max_bytes',
+                'alignment_offset', 'start', 'loop/backing_file')
+
 #
-#    def __enter__(self):
-#        self.acquire()
+# Property keys are shared by all devices so make sure that each
+# snapshot references the same key objects instead of its own
+# copies.
 #
-#    def __exit__(self, type, value, traceback):
-#        self.release()
+_property_keys = {}
+
+def _intern(key):
+    return _property_keys.setdefault(key, key)
+
+
+class _Snapshot(object):
+    """Immutable copy of the udev properties and of the sysfs
+    attributes of a device taken when the device is discovered or
+    when udev reports a change. BlockDevice properties read it
+    instead of calling into GUdev or sysfs each time.
+    """
+
+    __slots__ = ('devfile', 'devtype', 'name', '_props', '_attrs')
+
+    def __init__(self, gudev):
+        props = {}
+        for key in gudev.get_property_keys():
+            props[_intern(key)] = gudev.get_property(key)
+
+        attrs = {}
+        for attr in _SYSFS_ATTRS:
+            value = gudev.get_sysfs_attr(attr)
+            if value is not None:
+                attrs[attr] = value.strip()
+
+        init = object.__setattr__
+        init(self, 'devfile', gudev.get_device_file())
+        init(self, 'devtype', gudev.get_devtype())
+        init(self, 'name', gudev.get_name())
+        init(self, '_props', props)
+        init(self, '_attrs', attrs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("device snapshots are read-only")
+
+    def keys(self):
+        return self._props.keys()
+
+    def get(self, key):
+        return self._props.get(key)
+
+    def get_int(self, key):
+        try:
+            return int(self._props.get(key, 0))
+        except ValueError:
+            return 0
+
+    def get_boolean(self, key):
+        value = self._props.get(key)
+        return value is not None and value.lower() in ('1', 'true')
+
+    def attr(self, name):
+        return self._attrs.get(name)
+
+    def attr_uint64(self, name):
+        try:
+            return int(self._attrs.get(name, 0))
+        except ValueError:
+            return 0
+
+    def attr_boolean(self, name):
+        value = self._attrs.get(name)
+        return value is not None and value.lower() in ('1', 'true')
+
+    def attr_strv(self, name):
+        value = self._attrs.get(name)
+        return value.split() if value else []
+
+
+class _DeviceIndex(object):
+    """Lookups shared by the registry and its published views"""
+
+    __slots__ = ()
+
+    def lookup_syspath(self, syspath):
+        return self._by_syspath.get(syspath)
+
+    def lookup_devnum(self, major, minor):
+        return self._by_devnum.get((major, minor))
+
+    def lookup_devpath(self, devpath):
+        return self._by_devpath.get(devpath)
+
+    def lookup_devfile(self, devpath):
+        """Same as lookup_devpath() but 'devpath' can be any file
+        referring to the device node."""
+        bdev = self._by_devpath.get(devpath)
+        if not bdev:
+            #
+            # 'devpath' can be a symlink (/dev/md/xxx,
+            # /dev/disk/by-xxx/...), in that case rely on
+            # major/minor instead.
+            #
+            try:
+                st = os.stat(devpath)
+            except OSError:
+                return None
+            bdev = self.lookup_devnum(os.major(st.st_rdev), os.minor(st.st_rdev))
+        return bdev
+
+
+class _DeviceView(_DeviceIndex):
+    """Immutable state of the registry. A new view is published each
+    time the registry is modified, readers simply grab the current
+    one and can use it without taking any lock: it never changes
+    under their feet.
+    """
+
+    __slots__ = ('devices', 'leaves', 'roots', '_by_syspath', '_by_devnum',
+                 '_by_devpath', '_parents', '_children')
+
+    def __init__(self, devices=(), leaves=(), roots=(), by_syspath={},
+                 by_devnum={}, by_devpath={}, parents={}, children={}):
+        init = object.__setattr__
+        init(self, 'devices', devices)
+        init(self, 'leaves', leaves)
+        init(self, 'roots', roots)
+        init(self, '_by_syspath', by_syspath)
+        init(self, '_by_devnum', by_devnum)
+        init(self, '_by_devpath', by_devpath)
+        init(self, '_parents', parents)
+        init(self, '_children', children)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("device views are read-only")
+
+    def get_parents(self, bdev):
+        return list(self._parents.get(bdev.syspath, ()))
+
+    def get_children(self, bdev):
+        return list(self._children.get(bdev.syspath, ()))
+
 
+class _DeviceRegistry(_DeviceIndex):
+    """Keep track of the known block devices.
 
-_bdev_lock = threading.RLock()
-_block_devices = []
+    Devices are indexed by their syspath, their (major, minor) pair
+    and their device file so looking a device up doesn't require to
+    scan the whole list of devices.
+
+    The registry also maintains the parent/child graph of the devices
+    as well as the sets of leaf and root devices. They're updated
+    incrementally on each uevent so that topology queries only cost
+    the size of their result.
+
+    The registry is only accessed by the writers (with _bdev_lock
+    held), which call publish() once they're done to make their
+    changes visible to the readers.
+    """
+
+    def __init__(self):
+        self._seq = 0
+        self._by_syspath = OrderedDict()
+        self._by_devnum  = {}
+        self._by_devpath = {}
+        self._order      = {}     # syspath -> enumeration order
+        self._parents    = {}     # syspath -> [bdev, ...]
+        self._children   = {}     # syspath -> OrderedDict(syspath -> bdev)
+        self._unresolved = OrderedDict()
+        self._leaves     = {}
+        self._roots      = {}
+        self._dirty      = set()  # syspaths whose links changed
+        self._changed    = set()  # parts of the view to rebuild
+        self._view       = _DeviceView()
+
+    def __len__(self):
+        return len(self._by_syspath)
+
+    def _index(self, bdev):
+        self._changed.add('index')
+        self._by_devnum[(bdev.major, bdev.minor)] = bdev
+        if bdev.devpath:
+            self._by_devpath[bdev.devpath] = bdev
+
+    def _unindex(self, bdev, devnum, devpath):
+        self._changed.add('index')
+        if self._by_devnum.get(devnum) is bdev:
+            del self._by_devnum[devnum]
+        if self._by_devpath.get(devpath) is bdev:
+            del self._by_devpath[devpath]
+
+    def _sorted(self, bdevs):
+        return sorted(bdevs, key=lambda d: self._order[d.syspath])
+
+    #
+    # Topology maintenance
+    #
+    def _link(self, bdev):
+        """(Re)compute the direct parents of 'bdev'"""
+        self._unlink(bdev)
+        parents, complete = bdev._resolve_parents(self)
+        self._parents[bdev.syspath] = parents
+        self._dirty.add(bdev.syspath)
+        for p in parents:
+            self._children[p.syspath][bdev.syspath] = bdev
+            self._dirty.add(p.syspath)
+        if complete:
+            self._unresolved.pop(bdev.syspath, None)
+        else:
+            self._unresolved[bdev.syspath] = bdev
+        return parents
+
+    def _unlink(self, bdev):
+        parents = self._parents.pop(bdev.syspath, [])
+        self._dirty.add(bdev.syspath)
+        for p in parents:
+            self._children[p.syspath].pop(bdev.syspath, None)
+            self._dirty.add(p.syspath)
+        return parents
+
+    def _relink_unresolved(self):
+        updated = []
+        for bdev in list(self._unresolved.values()):
+            old = self._parents.get(bdev.syspath, [])
+            new = self._link(bdev)
+            if new != old:
+                updated.append(bdev)
+                updated.extend(old + new)
+        return updated
+
+    def _refresh(self, bdevs):
+        """Update the leaf and root status of the given devices"""
+        for bdev in bdevs:
+            syspath = bdev.syspath
+            if syspath not in self._by_syspath:
+                continue
+            is_ready = bdev.is_ready
+
+            is_leaf = is_ready
+            if is_leaf:
+                for child in self._children[syspath].values():
+                    if child.is_ready:
+                        is_leaf = False
+                        break
+            if is_leaf != (syspath in self._leaves):
+                self._changed.add('leaves')
+                if is_leaf:
+                    self._leaves[syspath] = bdev
+                else:
+                    del self._leaves[syspath]
+
+            is_root = is_ready and bdev.devtype == 'disk' and not self._parents[syspath]
+            if is_root != (syspath in self._roots):
+                self._changed.add('roots')
+                if is_root:
+                    self._roots[syspath] = bdev
+                else:
+                    del self._roots[syspath]
+
+    #
+    # Mutations
+    #
+    def add(self, syspath, bdev):
+        old = self._by_syspath.get(syspath)
+        if old:
+            self.remove(syspath)
+        self._changed.add('devices')
+        self._seq += 1
+        self._order[syspath] = self._seq
+        self._by_syspath[syspath] = bdev
+        self._children[syspath] = OrderedDict()
+        self._index(bdev)
+
+        parents = self._link(bdev)
+        affected = [bdev] + parents + self._relink_unresolved()
+        self._refresh(affected)
+
+    def remove(self, syspath):
+        bdev = self._by_syspath.pop(syspath, None)
+        if not bdev:
+            return None
+        self._changed.add('devices')
+        self._unindex(bdev, (bdev.major, bdev.minor), bdev.devpath)
+        parents = self._unlink(bdev)
+
+        # The children lost one of their parents.
+        children = list(self._children.pop(syspath).values())
+        for child in children:
+            self._parents[child.syspath].remove(bdev)
+            self._unresolved[child.syspath] = child
+            self._dirty.add(child.syspath)
+
+        del self._order[syspath]
+        self._unresolved.pop(syspath, None)
+        if self._leaves.pop(syspath, None):
+            self._changed.add('leaves')
+        if self._roots.pop(syspath, None):
+            self._changed.add('roots')
+        self._refresh(parents + children)
+        return bdev
+
+    def update(self, syspath, gudev):
+        """Refresh the device data, its indexes and its links."""
+        bdev = self._by_syspath.get(syspath)
+        if bdev:
+            self._unindex(bdev, (bdev.major, bdev.minor), bdev.devpath)
+            bdev._update(gudev)
+            self._index(bdev)
+            # The device parents can change: MD arrays are the
+            # usual example.
+            parents = self._parents.get(syspath, [])
+            parents = parents + self._link(bdev)
+            affected = [bdev] + parents + self._relink_unresolved()
+            self._refresh(affected)
+        return bdev
+
+    #
+    # Publication
+    #
+    def publish(self):
+        """Make the changes done since the last call visible to the
+        readers by building a new view. The parts of the previous
+        view which haven't changed are shared with the new one."""
+        old = self._view
+        changed = self._changed
+        if not changed and not self._dirty:
+            return old
+
+        devices, leaves, roots = old.devices, old.leaves, old.roots
+        by_syspath, by_devnum, by_devpath = old._by_syspath, old._by_devnum, old._by_devpath
+        parents, children = old._parents, old._children
+
+        if 'devices' in changed:
+            devices = tuple(self._by_syspath.values())
+            by_syspath = dict(self._by_syspath)
+        if 'leaves' in changed:
+            leaves = tuple(self._sorted(self._leaves.values()))
+        if 'roots' in changed:
+            roots = tuple(self._sorted(self._roots.values()))
+        if 'index' in changed:
+            by_devnum = dict(self._by_devnum)
+            by_devpath = dict(self._by_devpath)
+
+        if self._dirty:
+            parents = dict(parents)
+            children = dict(children)
+            for syspath in self._dirty:
+                if syspath in self._by_syspath:
+                    parents[syspath] = tuple(self._parents[syspath])
+                    children[syspath] = tuple(self._children[syspath].values())
+                else:
+                    parents.pop(syspath, None)
+                    children.pop(syspath, None)
+
+        self._view = _DeviceView(devices, leaves, roots, by_syspath,
+                                 by_devnum, by_devpath, parents, children)
+        self._dirty.clear()
+        self._changed.clear()
+        return self._view
+
+
+#
+# The lock serializes the writers (uevent handlers and the initial
+# enumeration) and is used by wait_for() to sleep until the next
+# change. Readers never take it: they use the last view published by
+# the registry, which is replaced atomically by a simple assignment.
+# Set INSTALLER_LOCKSTAT to get statistics about its usage, see the
+# lockstat module.
+#
+_bdev_lock = lockstat.rlock("device")
+_bdev_cond = threading.Condition(_bdev_lock)
+_block_devices = _DeviceRegistry()
+_view = _block_devices.publish()
 
 
 def block_devices():
     """Returns a list of the block devices ready to be used."""
-    with _bdev_lock:
-        return [bdev for bdev in _block_devices if bdev.is_ready]
+    _start()
+    return [bdev for bdev in _view.devices if bdev.is_ready]
 
 def leaf_block_devices():
     """Returns the list of partition devices or any block devices
     without partitions.
     """
-    with _bdev_lock:
-        leaves = block_devices()
-        for dev in leaves[:]:
-            for parent in dev.get_parents():
-                if parent in leaves:
-                    leaves.remove(parent)
-    return leaves
+    _start()
+    return list(_view.leaves)
 
 def root_block_devices():
     """Returns the list of root block devices"""
-    roots = []
-    with _bdev_lock:
-        for dev in block_devices():
-            if dev.devtype != 'disk':
-                continue
-            if dev.get_parents():
-                continue
-            if dev in roots:
-                continue
-            roots.append(dev)
-    return roots
+    _start()
+    return list(_view.roots)
+
+def wait_for(predicate, timeout=None, cancel=None):
+    """Block until 'predicate' returns a true value. The predicate is
+    evaluated right away and then each time a uevent has been
+    processed, so the caller wakes up as soon as udev reports the
+    awaited change.
+
+    Returns the last value returned by the predicate, which is false
+    if 'timeout' (in seconds) expired or if the event 'cancel' has been
+    set, see wake_waiters(). This must not be called from the thread
+    dispatching the uevents.
+    """
+    _start()
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    with _bdev_cond:
+        result = predicate()
+        while not result:
+            if cancel and cancel.is_set():
+                break
+            if deadline is None:
+                _bdev_cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _bdev_cond.wait(remaining)
+            result = predicate()
+    return result
+
+def wake_waiters():
+    """Make the threads blocked in wait_for() check their cancel
+    event"""
+    with _bdev_cond:
+        _bdev_cond.notify_all()
 
 # For now consider also bdevs which are not ready.
 def syspath_to_bdev(syspath):
-    syspath = os.path.realpath(syspath)
-    for dev in block_devices():
-        if dev.syspath == syspath:
-            return dev
+    _start()
+    return _view.lookup_syspath(os.path.realpath(syspath))
 
 def devpath_to_bdev(devpath):
-    # It's probably safer to rely on major/minor instead of devpath.
-    st = os.stat(devpath)
-    major, minor = (os.major(st.st_rdev), os.minor(st.st_rdev))
-    for dev in block_devices():
-        if (dev.major, dev.minor) == (major, minor):
-            return dev
+    _start()
+    return _view.lookup_devfile(devpath)
+
+#
+# The generation is bumped each time the device list changes or when
+# a user of this module tells that the results computed from the
+# device list must be refreshed (a device has been assigned to a
+# partition...). Results depending on it can be memoized with
+# @memoize_generation.
+#
+_generation = 0
+
+def generation():
+    return _generation
+
+def invalidate():
+    """Bump the generation, dropping all memoized results"""
+    global _generation
+    with _bdev_lock:
+        _generation += 1
+
+def memoize_generation(func):
+    """Cache the results of 'func' per arguments until the next
+    generation. The arguments must be hashable."""
+    cache = {}
+    cache_lock = threading.Lock()
+    state = {'generation': None}
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        gen = _generation
+        with cache_lock:
+            if state['generation'] != gen:
+                cache.clear()
+                state['generation'] = gen
+            elif args in cache:
+                return cache[args]
+
+        result = func(*args)
+
+        with cache_lock:
+            # Don't store results computed from outdated data.
+            if state['generation'] == gen:
+                cache[args] = result
+        return result
+
+    return wrapper
 
 def _format_description(lines):
     width = max([len(line[0]) for line in lines])
@@ -129,9 +566,17 @@ class SignatureDeviceError(DeviceError):
 
 class BlockDevice(object):
 
+    __slots__ = ('_snapshot', '_syspath', '_mntpoint')
+
     def __init__(self, gudev):
-        self._gudev = gudev
+        self._snapshot = _Snapshot(gudev)
         self._mntpoint = None
+        # The sysfs path of a device never changes.
+        self._syspath = os.path.realpath(gudev.get_sysfs_path())
+
+    def _update(self, gudev):
+        """Called on 'change' uevents to swap in fresh device data"""
+        self._snapshot = _Snapshot(gudev)
 
     def __eq__(self, other):
         return other and other.syspath == self.syspath
@@ -144,51 +589,55 @@ class BlockDevice(object):
 
     @property
     def syspath(self):
-        return os.path.realpath(self._gudev.get_sysfs_path())
+        return self._syspath
 
     @property
     def devpath(self):
-        return self._gudev.get_device_file()
+        return self._snapshot.devfile
 
     @property
     def devtype(self):
-        return self._gudev.get_devtype()
+        return self._snapshot.devtype
 
     @property
     def major(self):
-        return int(self._gudev.get_property("MAJOR"))
+        return self._snapshot.get_int("MAJOR")
 
     @property
     def minor(self):
-        return int(self._gudev.get_property("MINOR"))
+        return self._snapshot.get_int("MINOR")
 
     @property
     def model(self):
-        return self._gudev.get_property("ID_MODEL")
+        return self._snapshot.get("ID_MODEL")
 
     @property
     def bus(self):
-        return self._gudev.get_property("ID_BUS")
+        return self._snapshot.get("ID_BUS")
+
+    @property
+    def serial(self):
+        return self._snapshot.get("ID_SERIAL")
 
     @property
     def size(self):
-        return self._gudev.get_sysfs_attr_as_uint64('size') * 512
+        return self._snapshot.attr_uint64('size') * 512
 
     @property
     def is_readonly(self):
-        return self._gudev.get_sysfs_attr_as_boolean('ro')
+        return self._snapshot.attr_boolean('ro')
 
     @property
     def filesystem(self):
-        return self._gudev.get_property("ID_FS_TYPE")
+        return self._snapshot.get("ID_FS_TYPE")
 
     @property
     def fsuuid(self):
-        return self._gudev.get_property("ID_FS_UUID")
+        return self._snapshot.get("ID_FS_UUID")
 
     @property
     def fslabel(self):
-        return self._gudev.get_property("ID_FS_LABEL")
+        return self._snapshot.get("ID_FS_LABEL")
 
     @property
     def is_ready(self):
@@ -199,14 +648,15 @@ class BlockDevice(object):
     def mountpoints(self):
         # Don't test if there's a filesystem: there're cases where
         # there's no (more) filesystem but the device is still mounted.
-        try:
-            args = ["findmnt", "-n", "-o", "TARGET", "--source", self.devpath]
-            return check_output(args).decode().split()
-        except CalledProcessError:
-            return []
+        entries = mount_table.find_device(self.major, self.minor, self.devpath)
+        targets = []
+        for entry in entries:
+            if entry.target not in targets:
+                targets.append(entry.target)
+        return targets
 
     def devlinks(self, ident=None):
-        links = self._gudev.get_property("DEVLINKS").split()
+        links = (self._snapshot.get("DEVLINKS") or "").split()
         if ident:
             links = [l for l in links if l.startswith("/dev/disk/by-" + ident)]
         return links
@@ -230,22 +680,38 @@ class BlockDevice(object):
         self._mntpoint = None
         return mntpnt
 
-    def get_root_parents(self):
-        """Give the list of the very first parent(s)"""
-        if not self.get_parents():
-            return [self]
+    def _resolve_parents(self, registry):
+        """Returns the list of the direct parents known by 'registry'
+        and whether all of them have been found.
+        """
+        return [], True
+
+    def get_parents(self):
+        """Gives the list of direct parent(s)"""
+        return _view.get_parents(self)
 
-        roots = []
-        for parent in self.get_parents():
-            roots.extend(parent.get_root_parents())
-        return roots
+    def get_children(self):
+        """Gives the list of direct children"""
+        return _view.get_children(self)
 
     def iterparents(self):
-        """Helper to recursively yield all device parents"""
-        yield self
-        for p in self.get_parents():
-            for gp in p.iterparents():
-                yield gp
+        """Helper to yield the device and all its ancestors"""
+        # Walk a single view so the result is consistent even if
+        # uevents are processed meanwhile.
+        view = _view
+        seen = set()
+        stack = [self]
+        while stack:
+            dev = stack.pop()
+            if dev in seen:
+                continue
+            seen.add(dev)
+            yield dev
+            stack.extend(reversed(view.get_parents(dev)))
+
+    def get_root_parents(self):
+        """Give the list of the very first parent(s)"""
+        return [dev for dev in self.iterparents() if not dev.get_parents()]
 
     def is_compound(self):
         """Indicate if the device is built unpon other devices"""
@@ -267,6 +733,8 @@ class BlockDevice(object):
 
 class DiskDevice(BlockDevice):
 
+    __slots__ = ()
+
     def __init__(self, gudev):
         super(DiskDevice, self).__init__(gudev)
 
@@ -279,46 +747,105 @@ class DiskDevice(BlockDevice):
     @property
     def priority(self):
         """Usage preference for this disk: higher is better."""
-        return PRIORITY_DEFAULT if self.bus else PRIORITY_LOW + 5
+        if not self.bus:
+            return PRIORITY_LOW + 5
+        return _class_priorities[self.device_class]
+
+    @property
+    def transport(self):
+        """The bus the disk is attached to. Unlike 'bus', it's also
+        guessed from the device path when udev doesn't report it."""
+        if self.bus:
+            return self.bus.lower()
+        path = self._snapshot.get("ID_PATH") or ""
+        for transport in ('nvme', 'usb', 'ieee1394'):
+            if "-%s-" % transport in path:
+                return transport
+        return None
+
+    @property
+    def device_class(self):
+        if self.is_removable or self.transport in _removable_transports:
+            return DEVICE_CLASS_REMOVABLE
+        if self.transport == 'nvme':
+            return DEVICE_CLASS_NVME
+        return DEVICE_CLASS_HDD if self.is_rotational else DEVICE_CLASS_SSD
+
+    @property
+    def queue_depth(self):
+        return self._snapshot.attr_uint64('queue/nr_requests')
+
+    @property
+    def sector_size(self):
+        """Logical block size in bytes"""
+        return self._snapshot.attr_uint64('queue/logical_block_size') or 512
+
+    #
+    # I/O topology, see Documentation/ABI/stable/sysfs-block in the
+    # kernel sources. Sizes are in bytes, 0 means not reported.
+    #
+    @property
+    def physical_block_size(self):
+        return self._snapshot.attr_uint64('queue/physical_block_size') or self.sector_size
+
+    @property
+    def minimum_io_size(self):
+        return self._snapshot.attr_uint64('queue/minimum_io_size')
+
+    @property
+    def optimal_io_size(self):
+        return self._snapshot.attr_uint64('queue/optimal_io_size')
+
+    @property
+    def alignment_offset(self):
+        return self._snapshot.attr_uint64('alignment_offset')
+
+    @property
+    def supports_discard(self):
+        return self._snapshot.attr_uint64('queue/discard_max_bytes') > 0
+
+    @property
+    def discard_zeroes_data(self):
+        # Removed by kernel 4.12 which always reports 0.
+        return self._snapshot.attr_boolean('queue/discard_zeroes_data')
+
+    @property
+    def supports_write_zeroes(self):
+        """True if zeroing is offloaded to the device (WRITE ZEROES,
+        WRITE SAME...)"""
+        return self._snapshot.attr_uint64('queue/write_zeroes_max_bytes') > 0
 
     @property
     def is_removable(self):
-        return self._gudev.get_sysfs_attr_as_boolean('removable')
+        return self._snapshot.attr_boolean('removable')
 
     @property
     def is_rotational(self):
-        return self._gudev.get_sysfs_attr_as_boolean('queue/rotational')
+        return self._snapshot.attr_boolean('queue/rotational')
 
     @property
     def scheme(self):
-        return self._gudev.get_property("ID_PART_TABLE_TYPE")
+        return self._snapshot.get("ID_PART_TABLE_TYPE")
 
     @property
     def partuuid(self):
-        assert(not self._gudev.get_property("ID_PART_ENTRY_UUID"))
+        assert(not self._snapshot.get("ID_PART_ENTRY_UUID"))
 
     @property
     def partlabel(self):
-        assert(not self._gudev.get_property("ID_PART_ENTRY_NAME"))
-
-    def get_parents(self):
-        """Gives the list of direct parent(s)"""
-        return []
+        assert(not self._snapshot.get("ID_PART_ENTRY_NAME"))
 
     def get_partitions(self):
-        parts = []
-        with _bdev_lock:
-            for dev in _block_devices:
-                if dev.devtype != 'partition':
-                    continue
-                if dev.syspath.startswith(self.syspath):
-                    parts.append(dev)
+        parts = [dev for dev in self.get_children()
+                 if dev.devtype == 'partition']
         parts.sort(key=lambda part: part.syspath)
         return parts
 
 
 class RamDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def priority(self):
         return PRIORITY_LOW
@@ -334,6 +861,8 @@ class RamDevice(DiskDevice):
 
 class LoopDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def priority(self):
         return PRIORITY_LOW + 10
@@ -349,7 +878,7 @@ class LoopDevice(DiskDevice):
     @property
     def backing_file(self):
         try:
-            return self._gudev.get_sysfs_attr_as_strv('loop/backing_file')[0]
+            return self._snapshot.attr_strv('loop/backing_file')[0]
         except IndexError:
             return None
 
@@ -368,6 +897,8 @@ class LoopDevice(DiskDevice):
 
 class FloppyDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def priority(self):
         return PRIORITY_DISABLE
@@ -379,6 +910,8 @@ class FloppyDevice(DiskDevice):
 
 class CdromDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def priority(self):
         return PRIORITY_DISABLE
@@ -390,8 +923,20 @@ class CdromDevice(DiskDevice):
         return "SCSI CDROM"
 
 
+class NvmeDevice(DiskDevice):
+
+    __slots__ = ()
+
+    @property
+    def bus(self):
+        # Older udev versions don't set ID_BUS for NVMe disks.
+        return BlockDevice.bus.fget(self) or "nvme"
+
+
 class VirtualDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def priority(self):
         return PRIORITY_HIGH
@@ -403,6 +948,8 @@ class VirtualDevice(DiskDevice):
 
 class VirtioVirtualDevice(VirtualDevice):
 
+    __slots__ = ()
+
     @property
     def model(self):
         return "Virtio Disk #%d" % (self.minor/16)
@@ -410,6 +957,8 @@ class VirtioVirtualDevice(VirtualDevice):
 
 class XenVirtualDevice(VirtualDevice):
 
+    __slots__ = ()
+
     @property
     def model(self):
         return "Xen Virtual Disk #%d" % (self.minor/16)
@@ -417,6 +966,8 @@ class XenVirtualDevice(VirtualDevice):
 
 class MetadiskDevice(DiskDevice):
 
+    __slots__ = ()
+
     @property
     def bus(self):
         return "MD"
@@ -427,7 +978,7 @@ class MetadiskDevice(DiskDevice):
 
     @property
     def level(self):
-        return self._gudev.get_property("MD_LEVEL")
+        return self._snapshot.get("MD_LEVEL")
 
     @property
     def is_ready(self):
@@ -440,31 +991,39 @@ class MetadiskDevice(DiskDevice):
     def metadata(self):
         if self.md_container:
             return self.md_container.metadata
-        return self._gudev.get_property("MD_METADATA")
+        return self._snapshot.get("MD_METADATA")
 
     @property
     def md_devname(self):
-        return self._gudev.get_property("MD_DEVNAME")
+        return self._snapshot.get("MD_DEVNAME")
 
     @property
     def md_devices(self):
-        return self._gudev.get_property_as_int("MD_DEVICES")
+        return self._snapshot.get_int("MD_DEVICES")
 
     @property
     def md_container(self):
-        if self._gudev.get_property("MD_CONTAINER"):
-            return devpath_to_bdev(self._gudev.get_property("MD_CONTAINER"))
+        if self._snapshot.get("MD_CONTAINER"):
+            return devpath_to_bdev(self._snapshot.get("MD_CONTAINER"))
 
     @property
     def is_md_container(self):
         return self.level == "container"
 
-    def get_parents(self):
+    def _resolve_parents(self, registry):
         parents = []
-        for key in self._gudev.get_property_keys():
+        complete = True
+        for key in self._snapshot.keys():
             if key[:10] == 'MD_DEVICE_' and key[-4:] == '_DEV':
-                bdev = devpath_to_bdev(self._gudev.get_property(key))
-                parents.append(bdev)
+                bdev = registry.lookup_devfile(self._snapshot.get(key))
+                if bdev:
+                    parents.append(bdev)
+                else:
+                    complete = False
+        return parents, complete
+
+    def get_parents(self):
+        parents = BlockDevice.get_parents(self)
         assert(parents)
         return parents
 
@@ -479,6 +1038,8 @@ class MetadiskDevice(DiskDevice):
 
 class PartitionDevice(BlockDevice):
 
+    __slots__ = ()
+
     def __init__(self, gudev):
         super(PartitionDevice, self).__init__(gudev)
 
@@ -488,7 +1049,7 @@ class PartitionDevice(BlockDevice):
 
     @property
     def scheme(self):
-        return self._gudev.get_property("ID_PART_ENTRY_SCHEME")
+        return self._snapshot.get("ID_PART_ENTRY_SCHEME")
 
     @property
     def model(self):
@@ -514,110 +1075,225 @@ class PartitionDevice(BlockDevice):
         # GPT.
         #
         if self.scheme == 'gpt':
-            return self._gudev.get_property("ID_PART_ENTRY_UUID")
+            return self._snapshot.get("ID_PART_ENTRY_UUID")
 
     @property
     def partlabel(self):
         # same comments as in partuuid().
         if self.scheme == 'gpt':
-            return self._gudev.get_property("ID_PART_ENTRY_NAME")
+            return self._snapshot.get("ID_PART_ENTRY_NAME")
 
     @property
     def partnum(self):
-        return int(self._gudev.get_property("ID_PART_ENTRY_NUMBER"))
+        return self._snapshot.get_int("ID_PART_ENTRY_NUMBER")
+
+    @property
+    def start(self):
+        """Offset of the partition on its disk in bytes"""
+        return self._snapshot.attr_uint64('start') * 512
+
+    def _resolve_parents(self, registry):
+        pdev = registry.lookup_syspath(os.path.dirname(self.syspath))
+        if pdev:
+            return [pdev], True
+        return [], False
 
     def get_parents(self):
-        pdev = syspath_to_bdev(os.path.join(self.syspath, ".."))
-        if not pdev:
+        parents = BlockDevice.get_parents(self)
+        if not parents:
             raise DeviceError(self, "partition has no direct parent !")
-        return [pdev]
+        return parents
 
 
+#
+# Uevents usually come in bursts, so they're processed by batches: the
+# device list is updated once per batch and the handlers registered
+# with batch=True are called once with the list of (action, bdev)
+# pairs. The others are still called for each uevent.
+#
 __uevent_handlers = []
 
-def listen_uevent(cb):
-    __uevent_handlers.append(cb)
+def listen_uevent(cb, batch=False):
+    __uevent_handlers.append((cb, batch))
 
-def __notify_uevent_handlers(action, bdev):
-    for cb in __uevent_handlers:
+def __notify_uevent_handlers(events):
+    for cb, batch in __uevent_handlers:
         #
         # pygobject cannot propagate exceptions from a callback back
         # to the main thread. For now, only log them athough it will
         # lead to a fatal error.
         #
         try:
-            cb(action, bdev)
+            if batch:
+                cb(events)
+            else:
+                for action, bdev in events:
+                    cb(action, bdev)
         except:
             logger.exception("uevent callback got an unexpected exception")
 
-def __on_add_uevent(gudev):
-    bdev = None
+def __new_block_device(gudev):
     major = gudev.get_property_as_int("MAJOR")
 
     if gudev.get_devtype() == "partition":
-        bdev = PartitionDevice(gudev)
-    elif major == 1:
-        bdev = RamDevice(gudev)
-    elif major == 2:
-        bdev = FloppyDevice(gudev)
-    elif major == 7:
-        bdev = LoopDevice(gudev)
-    elif major == 9:
-        bdev = MetadiskDevice(gudev)
-    elif major == 11:
-        bdev = CdromDevice(gudev)
-    elif major == 202:
-        bdev = XenVirtualDevice(gudev)
-    elif gudev.get_name().startswith("vd"):
-        bdev = VirtioVirtualDevice(gudev)
-    elif gudev.get_property_as_boolean("ID_CDROM_DVD"):
-        bdev = CdromDevice(gudev)
-    elif gudev.get_property_as_boolean("ID_CDROM"):
-        bdev = CdromDevice(gudev)
-    elif gudev.get_devtype() == "disk":
-        bdev = DiskDevice(gudev)
-
-    if bdev:
-        _block_devices.append(bdev) # atomic operation
-        __notify_uevent_handlers("add", bdev)
-
-def __on_remove_uevent(gudev):
-    _bdev_lock.acquire()
-    for bdev in _block_devices:
-        if bdev.syspath == gudev.get_sysfs_path():
-            _block_devices.remove(bdev)
-            _bdev_lock.release()
-            __notify_uevent_handlers("remove", bdev)
-            _bdev_lock.acquire()
-    _bdev_lock.release()
-
-def __on_change_uevent(gudev):
-    _bdev_lock.acquire()
-    for bdev in _block_devices:
-        if bdev.syspath == gudev.get_sysfs_path():
-            bdev._gudev = gudev
-            _bdev_lock.release()
-            __notify_uevent_handlers("change", bdev)
-            _bdev_lock.acquire()
-    _bdev_lock.release()
-
-def __on_uevent(client, action, gudev):
-    if action == "add":
-        __on_add_uevent(gudev)
-    if action == "remove":
-        __on_remove_uevent(gudev)
-    if action == "change":
-        __on_change_uevent(gudev)
+        return PartitionDevice(gudev)
+    if major == 1:
+        return RamDevice(gudev)
+    if major == 2:
+        return FloppyDevice(gudev)
+    if major == 7:
+        return LoopDevice(gudev)
+    if major == 9:
+        return MetadiskDevice(gudev)
+    if major == 11:
+        return CdromDevice(gudev)
+    if major == 202:
+        return XenVirtualDevice(gudev)
+    if gudev.get_name().startswith("vd"):
+        return VirtioVirtualDevice(gudev)
+    if gudev.get_name().startswith("nvme"):
+        return NvmeDevice(gudev)
+    if gudev.get_property_as_boolean("ID_CDROM_DVD"):
+        return CdromDevice(gudev)
+    if gudev.get_property_as_boolean("ID_CDROM"):
+        return CdromDevice(gudev)
+    if gudev.get_devtype() == "disk":
+        return DiskDevice(gudev)
+    return None
+
+def _publish():
+    global _view
+    view = _block_devices.publish()
+    if view is not _view:
+        _view = view
+        invalidate()
+
+def __on_uevents(client, uevents):
+    # Build the new devices before taking the lock since it involves
+    # reading sysfs.
+    pending = []
+    for action, gudev in uevents:
+        if action == "add":
+            bdev = __new_block_device(gudev)
+            if bdev:
+                pending.append((action, bdev.syspath, bdev))
+        elif action in ("remove", "change"):
+            syspath = os.path.realpath(gudev.get_sysfs_path())
+            pending.append((action, syspath, gudev))
+
+    events = []
+    with _bdev_lock:
+        for action, syspath, obj in pending:
+            if action == "add":
+                _block_devices.add(syspath, obj)
+                bdev = obj
+            elif action == "remove":
+                bdev = _block_devices.remove(syspath)
+            else:
+                bdev = _block_devices.update(syspath, obj)
+            if bdev:
+                events.append((action, bdev))
+        _publish()
+        _bdev_cond.notify_all()
+
+    if events:
+        __notify_uevent_handlers(events)
+
+#
+# The backend is a factory returning objects implementing the subset
+# of the GUdev.Client API used by this module: connect("uevent", cb)
+# and query_by_subsystem("block"). The devices they report must
+# implement the GUdev.Device getters used by _Snapshot.
+#
+# Backends setting 'batch_uevents' deliver the uevents by batches
+# through connect("uevents", cb), cb being passed a list of (action,
+# device) pairs. The uevents of the other ones are batched by a
+# UeventBatcher.
+#
+def _gudev_client():
+    from gi.repository import GUdev
+
+    #
+    # Gudev.Client() doesn't take unicode on python2.7 which is
+    # probably a bug, so use byte string for this case.
+    #
+    block = 'block'
+    if sys.version_info[0] < 3:
+        block = block.encode('ascii')
+    return GUdev.Client(subsystems=[block])
+
+__backend = _gudev_client
+
+def set_backend(factory):
+    """Replace GUdev as the source of block devices and uevents. This
+    must be done before the module is used."""
+    global __backend
+    assert(not __client)
+    __backend = factory
 
 #
-# Gudev.Client() doesn't take unicode on python2.7 which is probably a
-# bug, so use byte string for this case.
+# Enumerating the block devices can take a while on hosts with a lot
+# of devices, so it's done by a background thread started the first
+# time the module is used. Users needing the full list of devices
+# should call wait_enumeration() first, others will get the devices
+# through 'add' uevents as they're discovered.
 #
-block = 'block'
-if sys.version_info[0] < 3:
-    block = block.encode('ascii')
-
-__client = GUdev.Client(subsystems=[block])
-__client.connect("uevent", __on_uevent)
-for gudev in __client.query_by_subsystem("block"):
-    __on_add_uevent(gudev)
+__client = None
+__client_lock = threading.Lock()
+_enumerated = threading.Event()
+
+# Number of devices reported by the enumeration at once.
+_ENUMERATION_BATCH = 64
+
+def __enumerate():
+    try:
+        # libudev objects can't be shared between threads, so use a
+        # dedicated client for the enumeration.
+        client = __backend()
+        devices = client.query_by_subsystem("block")
+        for i in range(0, len(devices), _ENUMERATION_BATCH):
+            # The device might have been already reported by a
+            # uevent, in that case its data are more recent.
+            batch = [("add", gudev) for gudev in devices[i:i+_ENUMERATION_BATCH]
+                     if not syspath_to_bdev(gudev.get_sysfs_path())]
+            __on_uevents(client, batch)
+    except:
+        logger.exception("block device enumeration failed")
+    finally:
+        _enumerated.set()
+        with _bdev_cond:
+            _bdev_cond.notify_all()
+
+def _start():
+    """Start listening for uevents and enumerating the block devices
+    if it's not been done yet."""
+    global __client
+
+    # Fast path: readers don't serialize once the backend is up.
+    if __client:
+        return
+
+    with __client_lock:
+        if __client:
+            return
+        client = __backend()
+        if getattr(client, 'batch_uevents', False):
+            client.connect("uevents", __on_uevents)
+        else:
+            batcher = UeventBatcher(lambda events: __on_uevents(None, events))
+            client.connect("uevent", lambda c, action, gudev:
+                           batcher.push((action, gudev)))
+
+        th = threading.Thread(target=__enumerate, name="bdev-enumeration")
+        th.daemon = True
+        th.start()
+
+        # Published last so the fast path never sees a half
+        # initialized client.
+        __client = client
+
+def wait_enumeration(timeout=None):
+    """Wait for the initial enumeration of the block devices to be
+    done. Returns False if 'timeout' expired."""
+    _start()
+    return _enumerated.wait(timeout)
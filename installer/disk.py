@@ -6,11 +6,19 @@ import logging
 from itertools import groupby
 
 from . import device
+from . import probe
+from .mountinfo import mount_table
+from .settings import settings
 from .utils import MiB, GiB
 
 
 DISK_MINSIZE = 1 * MiB
 
+# Probed disks slower than this ratio of the fastest disk of their
+# group are moved into a separate group so they're not combined into
+# the same RAID array.
+PROBE_GROUP_RATIO = 0.7
+
 logger = logging.getLogger(__name__)
 
 
@@ -63,9 +71,52 @@ class DiskRaidBusyError(DiskBusyError):
         DiskBusyError.__init__(self, bdev, message)
 
 
-def _sort_and_group_bdevs(bdevs):
+def _throughput(bdev):
+    result = probe.get_result(bdev)
+    return result.throughput if result else 0
+
+
+def _perf_key(bdev):
+    """Sort key ordering the disks of a group from the fastest to the
+    slowest: by throughput then by access latency. Disks which have
+    not been probed come last.
+
+    Controllers with deep queues (SAS, NVMe...) are preferred over
+    the ones with shallow queues (SATA NCQ) when nothing else makes
+    the difference. The queue depth depends on the I/O scheduler so
+    it's never used to tell groups apart."""
+    depth = -bdev.queue_depth
+    result = probe.get_result(bdev)
+    if not result:
+        return (1, 0, 0, depth)
+    return (0, -result.throughput, result.latency, depth)
+
+
+def _split_by_throughput(bdevs):
+    """Split a group of disks sorted by _perf_key() in groups of disks
+    having similar performances. Disks which have not been probed are
+    put in the last group."""
+    throughput = _throughput
+
+    groups = []
+    for bdev in bdevs:
+        t = throughput(bdev)
+        if groups:
+            fastest = throughput(groups[-1][0])
+            if t >= fastest * PROBE_GROUP_RATIO or not fastest:
+                groups[-1].append(bdev)
+                continue
+        groups.append([bdev])
+    return groups
+
+
+def _sort_and_group_bdevs(bdevs, split=True):
     """Group block devices by bus and priority: devices on the same
     bus but having a different prio won't be part of the same group.
+
+    If the disks have been probed, the disks of a group are sorted by
+    performance and, if 'split' is set, the groups are also split by
+    throughput.
     """
     groups = []
 
@@ -74,7 +125,11 @@ def _sort_and_group_bdevs(bdevs):
 
     bdevs.sort(key=keyfunc, reverse=True)
     for k, g in groupby(bdevs, keyfunc):
-        groups.append(list(g))
+        g = sorted(g, key=_perf_key)
+        if split:
+            groups += _split_by_throughput(g)
+        else:
+            groups.append(g)
 
     return groups
 
@@ -87,13 +142,22 @@ def get_candidates(bdev=None):
     If 'bdev' is provided, the device will be used as a starting
     point otherwise all devices will be considered.
     """
-    candidates = []
+    groups = _get_candidates(bdev)
+    if bdev:
+        return list(groups)
+    return [list(group) for group in groups]
+
+
+# The result is shared by the callers, hence it's made of tuples.
+@device.memoize_generation
+def _get_candidates(bdev):
+    candidates = set()
 
     for dev in [bdev] if bdev else device.leaf_block_devices():
 
         if type(dev) == device.PartitionDevice:
             # Any device that can be partitioned is a candidate.
-            candidates += dev.get_parents()
+            candidates.update(dev.get_parents())
             continue
 
         if type(dev) == device.MetadiskDevice and dev.is_md_container:
@@ -108,49 +172,91 @@ def get_candidates(bdev=None):
                 # If the device is based on partition devs (such as
                 # MD), use partition parents.
                 for p in parents:
-                    candidates += p.get_parents()
+                    candidates.update(p.get_parents())
                 continue
         #
         # The current device is a disk or is based on a whole disk
         # (common for fake RAID devices) (such as MD). Use it as
         # is.
-        candidates.append(dev)
-
-    groups = _sort_and_group_bdevs(list(set(candidates)))
+        candidates.add(dev)
 
+    #
     # If 'bdev' was passed, make sure that the parent devices are part
     # of the same bus. In that case simply returns the list of the
-    # parents.
+    # parents: they're already used together (by a RAID array for
+    # example) whatever their measured performances.
+    #
+    groups = _sort_and_group_bdevs(list(candidates), split=not bdev)
     if bdev:
         assert(len(groups) == 1)
-        groups = groups[0]
+        return tuple(groups[0])
 
-    return groups
+    return tuple(tuple(group) for group in groups)
+
+
+class _BusyMap(object):
+    """Snapshot of the devices currently in use: the mounted ones and
+    the disks backing a running RAID array. It's built once and used
+    to validate any number of disks."""
+
+    def __init__(self):
+        self._devnums, self._sources = mount_table.mounted_devices()
+
+        self._raid_members = {}
+        for md in device.leaf_block_devices():
+            if type(md) == device.MetadiskDevice:
+                for root in md.get_root_parents():
+                    self._raid_members.setdefault(root, md)
 
+    def is_mounted(self, bdev):
+        return ((bdev.major, bdev.minor) in self._devnums or
+                bdev.devpath in self._sources)
 
-def check_candidate(bdev):
+    def get_raid(self, bdev):
+        return self._raid_members.get(bdev)
+
+
+def check_candidate(bdev, busy=None):
     """Check that a single device, previously returned by
     get_candidates(), is suitable for an installation.
     """
+    if busy is None:
+        busy = _BusyMap()
+
     if bdev.is_readonly:
         raise DiskReadOnlyError(bdev)
 
     if bdev.size < DISK_MINSIZE:
         raise DiskTooSmallError(bdev)
 
-    if bdev.mountpoints:
+    if busy.is_mounted(bdev):
         raise DiskBusyError(bdev, _("currently mounted"))
 
     for pdev in bdev.get_partitions():
-        if pdev.mountpoints:
+        if busy.is_mounted(pdev):
             raise DiskBusyError(bdev, _("has at least one mounted partition"))
 
     # Check that the disk or its siblings are not part of a running
     # RAID array.
-    for md in device.leaf_block_devices():
-        if type(md) == device.MetadiskDevice:
-            if bdev in md.get_root_parents():
-                raise DiskRaidBusyError(bdev, md)
+    md = busy.get_raid(bdev)
+    if md:
+        raise DiskRaidBusyError(bdev, md)
+
+
+def validate_candidates(bdevs):
+    """Check all the given disks at once. Returns the list of the
+    valid disks and a dict mapping the others to their error."""
+    busy = _BusyMap()
+    valid = []
+    errors = {}
+    for bdev in bdevs:
+        try:
+            check_candidate(bdev, busy)
+        except DiskError as e:
+            errors[bdev] = e
+        else:
+            valid.append(bdev)
+    return valid, errors
 
 
 def check_candidates(bdevs, RAID=True):
@@ -158,13 +264,18 @@ def check_candidates(bdevs, RAID=True):
     installation and if 'RAID' is true also check that those device
     can be used to create a RAID array.
     """
+    busy = _BusyMap()
     for bdev in bdevs:
-        check_candidate(bdev)
+        check_candidate(bdev, busy)
 
     if len(bdevs) < 2 or not RAID:
         return
 
-    # Check that those disks can be used to create a RAID array.
+    _check_raid(bdevs)
+
+
+def _check_raid(bdevs):
+    """Check that those disks can be used to create a RAID array"""
 
     # should be part of the same bus.
     bus = bdevs[0].bus
@@ -189,6 +300,35 @@ def check_candidates(bdevs, RAID=True):
             raise DiskRaidError(_("largest drive exceeds size by more than 1%"))
 
 
+def _best_raid_subset(bdevs):
+    """Find the largest subset of disks that passes _check_raid(): the
+    disks are split by kind (SSD/HDD) and sorted by size, then a
+    window slides over them to find the longest run whose sizes are
+    within 1% of each other. Among subsets of the same length, SSDs,
+    then the fastest (if probed) and finally the largest disks are
+    preferred."""
+    best = []
+    best_key = None
+
+    for rotational in (False, True):
+        disks = sorted([d for d in bdevs if d.is_rotational == rotational],
+                       key=lambda d: d.size)
+        first = 0
+        for last in range(len(disks)):
+            maxsize = disks[last].size
+            while (maxsize - disks[first].size) * 100 > maxsize:
+                first += 1
+            window = disks[first:last + 1]
+            if best_key and len(window) < best_key[0]:
+                continue
+            key = (len(window), not rotational,
+                   min(_throughput(d) for d in window), disks[first].size)
+            if best_key is None or key > best_key:
+                best, best_key = window, key
+
+    return best
+
+
 def select_candidates(bdevs):
     """Given a list of disks, select the best candidates for a installation.
     Multiple disks can be returned meaning the proposed setup will use RAID.
@@ -198,18 +338,22 @@ def select_candidates(bdevs):
     # must be part of the same bus and have the same prio. Device with
     # an unknown bus are ignored.
     #
+    # The priority reflects the performance class of the disks so the
+    # groups of the fastest class come first and removable disks are
+    # only picked up if nothing else is usable.
+    #
     bdevs  = [bdev for bdev in bdevs if bdev.bus]
+    if settings.Disk.probe:
+        probe.probe(bdevs)
     groups = _sort_and_group_bdevs(bdevs)
 
+    valid, errors = validate_candidates(bdevs)
+    for bdev, e in errors.items():
+        logger.debug("skipping %s: %s", bdev.devpath, e)
+    valid = set(valid)
+
     for bdevs in groups:
-        candidates = []
-        for bdev in bdevs:
-            try:
-                check_candidate(bdev)
-            except DiskError as e:
-                logger.debug("skipping %s: %s", bdev.devpath, e)
-            else:
-                candidates.append(bdev)
+        candidates = [bdev for bdev in bdevs if bdev in valid]
 
         if not candidates:
             continue
@@ -217,16 +361,20 @@ def select_candidates(bdevs):
             # easy case only one disk can be used for an installation.
             return candidates
 
-        # try to build a RAID array
+        # try to build a RAID array, the disks have been validated
+        # already.
         try:
-            check_candidates(candidates)
+            _check_raid(candidates)
         except DiskRaidError as e:
             #
-            # several disks are good candidates but can't be combined into
-            # a RAID array, let the user choose the good one.
+            # several disks are good candidates but can't be combined
+            # into a single RAID array, pick up the best subset that
+            # can.
             #
-            logger.error("%s: %s" % ([d.devpath for d in candidates], e))
-            return []
+            subset = _best_raid_subset(candidates)
+            logger.info("%s: %s, using %s", [d.devpath for d in candidates],
+                        e, [d.devpath for d in subset])
+            return subset
         return candidates
 
     # no good disk has been found
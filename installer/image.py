@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# Install a partition from a prebuilt filesystem image instead of
+# formatting it and populating it with the package manager.
+#
+# Only the mapped areas of the image are copied: the image file is
+# expected to be sparse (created with 'truncate' and formatted with
+# mkfs for example) and its holes, found with SEEK_DATA/SEEK_HOLE,
+# make the block map. The data is copied with copy_file_range() or
+# sendfile() so it doesn't go through userspace, with a fallback to
+# plain reads and writes.
+#
+# Filesystems can rely on their free space reading back as zeroes
+# (mke2fs does when it can discard the image file), so the holes are
+# cleared on the target without writing them: they're discarded if
+# the device guarantees zeroes after a discard, otherwise they're
+# zeroed with BLKZEROOUT which is offloaded to the device when it
+# supports it.
+#
+# Once written, the filesystem is grown to the size of its partition.
+#
+from __future__ import unicode_literals
+
+import os
+import stat
+import errno
+import fcntl
+import struct
+import logging
+
+from . import device
+from . import mkfs
+from .mkfs import BLKDISCARD, BLKZEROOUT
+from .process import check_output, CalledProcessError
+from .utils import MiB
+
+
+logger = logging.getLogger(__name__)
+
+
+# Python 2 doesn't define them.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# Max size of a single copy request, so the progress is reported
+# regularly.
+COPY_CHUNK = 8 * MiB
+
+# Errors meaning a copy method isn't usable for the source/target
+# pair, the next one is tried.
+_FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                    errno.EOPNOTSUPP, errno.EBADF)
+
+
+class ImageError(Exception):
+    """Base class for exceptions in the image module"""
+
+
+class BlockMap(object):
+    """The (offset, length) of the data areas of an image"""
+
+    __slots__ = ('size', 'extents')
+
+    def __init__(self, size, extents):
+        self.size = size
+        self.extents = extents
+
+    @property
+    def mapped(self):
+        return sum(length for offset, length in self.extents)
+
+    @classmethod
+    def from_fd(cls, fd):
+        size = os.lseek(fd, 0, os.SEEK_END)
+        extents = []
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole is left.
+                    break
+                if e.errno == errno.EINVAL and offset == 0:
+                    # Not supported (block devices), map everything.
+                    extents = [(0, size)]
+                    break
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+        return cls(size, extents)
+
+
+def probe(path):
+    """Returns the filesystem type and UUID of the image 'path'"""
+    # blkid doesn't tell a missing file from one without signature.
+    os.stat(path)
+    try:
+        out = check_output(['blkid', '-p', '-o', 'export', path])
+    except CalledProcessError as e:
+        # Exit code 2: nothing has been identified.
+        if e.returncode == 2:
+            raise ImageError(_("%s is not a filesystem image") % path)
+        raise ImageError(_("failed to probe %s: %s") % (path, e))
+    except OSError as e:
+        raise ImageError(_("failed to run blkid: %s") % e)
+
+    tags = dict(line.split('=', 1) for line in out.decode().splitlines()
+                if '=' in line)
+    if tags.get('USAGE') != 'filesystem':
+        raise ImageError(_("%s is not a filesystem image") % path)
+    return tags['TYPE'], tags.get('UUID')
+
+
+class _Copier(object):
+    """Copy ranges of a file at the same offsets of another one"""
+
+    def __init__(self, src, dst):
+        self._src = src
+        self._dst = dst
+        self._methods = []
+        if hasattr(os, 'copy_file_range'):
+            self._methods.append(self._copy_file_range)
+        if hasattr(os, 'sendfile'):
+            self._methods.append(self._sendfile)
+        self._methods.append(self._read_write)
+
+    def _copy_file_range(self, offset, count):
+        return os.copy_file_range(self._src, self._dst, count, offset, offset)
+
+    def _sendfile(self, offset, count):
+        os.lseek(self._dst, offset, os.SEEK_SET)
+        return os.sendfile(self._dst, self._src, offset, count)
+
+    def _read_write(self, offset, count):
+        os.lseek(self._src, offset, os.SEEK_SET)
+        data = os.read(self._src, count)
+        os.lseek(self._dst, offset, os.SEEK_SET)
+        written = 0
+        while written < len(data):
+            written += os.write(self._dst, data[written:])
+        return written
+
+    def copy(self, offset, length, callback):
+        end = offset + length
+        while offset < end:
+            count = min(end - offset, COPY_CHUNK)
+            try:
+                copied = self._methods[0](offset, count)
+            except (IOError, OSError) as e:
+                if e.errno not in _FALLBACK_ERRNOS or len(self._methods) == 1:
+                    raise
+                logger.debug("%s() failed (%s), falling back",
+                             self._methods[0].__name__.lstrip('_'), e)
+                self._methods.pop(0)
+                continue
+            if not copied:
+                raise ImageError(_("unexpected end of image"))
+            offset += copied
+            callback(copied)
+
+
+class _Cleaner(object):
+    """Clear ranges of a device (or a file) so they read back as
+    zeroes"""
+
+    def __init__(self, fd, discard):
+        self._fd = fd
+        self._methods = []
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            if discard:
+                self._methods.append(self._discard)
+            self._methods.append(self._zeroout)
+        self._methods.append(self._write_zeroes)
+
+    def _discard(self, offset, length):
+        fcntl.ioctl(self._fd, BLKDISCARD, struct.pack(str('QQ'), offset, length))
+
+    def _zeroout(self, offset, length):
+        fcntl.ioctl(self._fd, BLKZEROOUT, struct.pack(str('QQ'), offset, length))
+
+    def _write_zeroes(self, offset, length):
+        zeroes = b'\0' * min(length, COPY_CHUNK)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        end = offset + length
+        while offset < end:
+            offset += os.write(self._fd, zeroes[:end - offset])
+
+    def clear(self, offset, length):
+        while True:
+            try:
+                return self._methods[0](offset, length)
+            except (IOError, OSError) as e:
+                if e.errno not in _FALLBACK_ERRNOS or len(self._methods) == 1:
+                    raise
+                logger.debug("%s() failed (%s), falling back",
+                             self._methods[0].__name__.lstrip('_'), e)
+                self._methods.pop(0)
+
+
+def _holes(bmap):
+    offset = 0
+    for start, length in bmap.extents:
+        if start > offset:
+            yield offset, start - offset
+        offset = start + length
+    if bmap.size > offset:
+        yield offset, bmap.size - offset
+
+
+def write(path, target, callback=lambda written, total: None, discard=False,
+          cancel=None):
+    """Write the mapped areas of the image 'path' onto the device
+    'target' and clear its holes. 'discard' tells if discarded blocks
+    of 'target' are guaranteed to read back as zeroes. 'callback' is
+    called with the number of bytes written so far and the total
+    number of bytes to write. The copy stops once the 'cancel' event
+    is set. Returns the BlockMap of the image."""
+    src = os.open(path, os.O_RDONLY)
+    try:
+        bmap = BlockMap.from_fd(src)
+        # O_EXCL fails if the block device is in use (mounted...).
+        dst = os.open(target, os.O_WRONLY | os.O_EXCL)
+        try:
+            size = os.lseek(dst, 0, os.SEEK_END)
+            if bmap.size > size:
+                raise ImageError(_("%s is too big for %s") % (path, target))
+
+            cleaner = _Cleaner(dst, discard)
+            for offset, length in _holes(bmap):
+                cleaner.clear(offset, length)
+
+            total = bmap.mapped
+            written = [0]
+            def progress(count):
+                if cancel and cancel.is_set():
+                    raise ImageError(_("cancelled while writing %s") % target)
+                written[0] += count
+                callback(written[0], total)
+
+            copier = _Copier(src, dst)
+            for offset, length in bmap.extents:
+                copier.copy(offset, length, progress)
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+    return bmap
+
+
+def install(path, bdev, callback=lambda written, total: None,
+            timeout=None, cancel=None, assume_clean=False):
+    """Write the image 'path' on the block device 'bdev' and wait for
+    udev to report the new filesystem, see device.wait_for(). Like
+    for mkfs.plan(), 'assume_clean' arrays are never discarded.
+    Returns the BlockMap of the image."""
+    fs, uuid = probe(path)
+    logger.debug("writing %s image %s to %s", fs, path, bdev.devpath)
+
+    discard = (not assume_clean and mkfs.supports_discard(bdev) and
+               mkfs.discard_zeroes_data(bdev))
+    bmap = write(path, bdev.devpath, callback, discard, cancel)
+
+    # udev doesn't watch all devices (MD ones for example), make it
+    # probe the new filesystem.
+    with open(os.path.join(bdev.syspath, 'uevent'), 'w') as f:
+        f.write('change')
+    if not device.wait_for(lambda: (bdev.filesystem, bdev.fsuuid) == (fs, uuid),
+                           timeout, cancel):
+        if cancel and cancel.is_set():
+            raise ImageError(_("cancelled while waiting for %s filesystem on %s")
+                             % (fs, bdev.devpath))
+        raise ImageError(_("timeout while waiting for %s filesystem on %s")
+                         % (fs, bdev.devpath))
+    return bmap
+
+
+def grow_command(fs, devpath, mountpoint):
+    """Returns the command growing the filesystem 'fs' to the size of
+    its device once mounted on 'mountpoint', or None if 'fs' can't be
+    grown"""
+    if fs.startswith('ext'):
+        return ['resize2fs', devpath]
+    if fs == 'xfs':
+        return ['xfs_growfs', mountpoint]
+    if fs == 'btrfs':
+        return ['btrfs', 'filesystem', 'resize', 'max', mountpoint]
+    return None
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Opt-in instrumentation of the locks shared by the installer threads
+# (uevent handlers, steps, UI...). When INSTALLER_LOCKSTAT is set in
+# the environment, the locks created by rlock() record for each call
+# site:
+#
+#  - the number of acquisitions and how many had to wait,
+#  - the time spent waiting for the lock,
+#  - the time the lock was held,
+#
+# both times being also accounted in log2 histograms (in µs). The
+# report is written at exit to the file named by INSTALLER_LOCKSTAT
+# ('1' or '-' means stderr) and can be dumped at any time with
+# report().
+#
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import io
+import sys
+import time
+import atexit
+import threading
+
+
+LOCKSTAT_ENV = 'INSTALLER_LOCKSTAT'
+
+# Histogram buckets: bucket N counts durations in [2^(N-1), 2^N) µs,
+# the last one counts everything above.
+_NR_BUCKETS = 24
+
+
+def _bucket(duration):
+    return min(int(duration * 1000000).bit_length(), _NR_BUCKETS - 1)
+
+
+_threading_file = os.path.splitext(threading.__file__)[0]
+
+def _call_site(depth):
+    frame = sys._getframe(depth + 1)
+    # Skip threading.Condition when the lock is used through it.
+    while os.path.splitext(frame.f_code.co_filename)[0] == _threading_file:
+        frame = frame.f_back
+    code = frame.f_code
+    return "%s:%d (%s)" % (os.path.basename(code.co_filename),
+                           frame.f_lineno, code.co_name)
+
+
+class _SiteStats(object):
+
+    __slots__ = ('acquired', 'contended', 'wait_total', 'wait_max',
+                 'hold_total', 'hold_max', 'wait_hist', 'hold_hist')
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.wait_hist = [0] * _NR_BUCKETS
+        self.hold_hist = [0] * _NR_BUCKETS
+
+    def add_wait(self, duration, contended):
+        self.acquired += 1
+        if contended:
+            self.contended += 1
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+            self.wait_hist[_bucket(duration)] += 1
+
+    def add_hold(self, duration):
+        self.hold_total += duration
+        self.hold_max = max(self.hold_max, duration)
+        self.hold_hist[_bucket(duration)] += 1
+
+
+class InstrumentedRLock(object):
+    """A reentrant lock recording its usage per call site. Only the
+    outermost acquisition of a thread is accounted. It can be passed
+    to threading.Condition()."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._stats = {}
+        # Owner state, only touched with the lock held.
+        self._depth = 0
+        self._site = None
+        self._since = 0
+
+    def _stats_of(self, site):
+        stats = self._stats.get(site)
+        if stats is None:
+            stats = self._stats[site] = _SiteStats()
+        return stats
+
+    def _acquire(self, site, blocking=True):
+        start = time.time()
+        contended = not self._lock.acquire(False)
+        if contended:
+            if not blocking:
+                return False
+            self._lock.acquire()
+
+        self._depth += 1
+        if self._depth == 1:
+            now = time.time()
+            self._stats_of(site).add_wait(now - start, contended)
+            self._site = site
+            self._since = now
+        return True
+
+    def _release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._stats_of(self._site).add_hold(time.time() - self._since)
+        self._lock.release()
+
+    def acquire(self, blocking=True):
+        return self._acquire(_call_site(1), blocking)
+
+    def release(self):
+        self._release()
+
+    def __enter__(self):
+        self._acquire(_call_site(1))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._release()
+
+    #
+    # Used by threading.Condition: waiting on a condition releases the
+    # lock completely, the wake up is accounted as a new acquisition
+    # from the caller of wait().
+    #
+    def _is_owned(self):
+        return self._lock._is_owned()
+
+    def _release_save(self):
+        self._stats_of(self._site).add_hold(time.time() - self._since)
+        depth, self._depth = self._depth, 0
+        return (self._lock._release_save(), depth)
+
+    def _acquire_restore(self, state):
+        site = _call_site(2)
+        start = time.time()
+        self._lock._acquire_restore(state[0])
+        now = time.time()
+        self._stats_of(site).add_wait(now - start, True)
+        self._depth = state[1]
+        self._site = site
+        self._since = now
+
+    def report(self, out):
+        with self._lock:
+            stats = sorted(self._stats.items(),
+                           key=lambda item: item[1].wait_total + item[1].hold_total,
+                           reverse=True)
+        print("lock '%s':" % self.name, file=out)
+        for site, st in stats:
+            print("  %s" % site, file=out)
+            print("    acquired %d times, contended %d times" %
+                  (st.acquired, st.contended), file=out)
+            if st.contended:
+                print("    wait: total %.3f ms, avg %.3f ms, max %.3f ms" %
+                      (st.wait_total * 1000, st.wait_total * 1000 / st.contended,
+                       st.wait_max * 1000), file=out)
+                _print_histogram(st.wait_hist, out)
+            if st.acquired:
+                print("    hold: total %.3f ms, avg %.3f ms, max %.3f ms" %
+                      (st.hold_total * 1000, st.hold_total * 1000 / st.acquired,
+                       st.hold_max * 1000), file=out)
+                _print_histogram(st.hold_hist, out)
+
+
+def _print_histogram(hist, out):
+    used = [i for i, count in enumerate(hist) if count]
+    if not used:
+        # The lock is still held, its hold time isn't known yet.
+        print("      no samples", file=out)
+        return
+    for i in range(used[0], used[-1] + 1):
+        label = "< %dus" % (1 << i) if i < _NR_BUCKETS - 1 else ">= %dus" % (1 << (i - 1))
+        print("      %10s | %d" % (label, hist[i]), file=out)
+
+
+_locks = []
+
+def enabled():
+    return bool(os.environ.get(LOCKSTAT_ENV))
+
+
+def rlock(name):
+    """Returns a reentrant lock, which is instrumented if lock
+    statistics are enabled."""
+    if not enabled():
+        return threading.RLock()
+    lock = InstrumentedRLock(name)
+    _locks.append(lock)
+    if len(_locks) == 1:
+        atexit.register(_report_at_exit)
+    return lock
+
+
+def report(out=None):
+    """Write the statistics of all instrumented locks to 'out'"""
+    out = out or sys.stderr
+    for lock in _locks:
+        lock.report(out)
+
+
+def _report_at_exit():
+    path = os.environ.get(LOCKSTAT_ENV)
+    if path in ('1', '-'):
+        report()
+        return
+    with io.open(path, 'w', encoding='utf-8') as f:
+        report(f)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# Follow the synchronization of the MD arrays.
+#
+# The state of the arrays is parsed from /proc/mdstat, which looks
+# like this:
+#
+#   Personalities : [raid1] [raid6] [raid5] [raid4]
+#   md1 : active raid5 sdc2[3] sdb2[1] sda2[0]
+#         6157312 blocks super 1.2 level 5, 512k chunk, algorithm 2 [3/2] [UU_]
+#         [===>.................]  recovery = 17.5% (539136/3078656) finish=0.7min speed=53913K/sec
+#         bitmap: 0/1 pages [0KB], 65536KB chunk
+#
+#   md0 : active (auto-read-only) raid1 sdb1[1] sda1[0]
+#         262080 blocks super 1.0 [2/2] [UU]
+#           resync=PENDING
+#
+#   unused devices: <none>
+#
+# The resync of a new array competes with the installation of the
+# packages for the disk bandwidth, so it can be throttled in the
+# meantime through the speed_limit_max sysctl.
+#
+from __future__ import unicode_literals
+
+import re
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+MDSTAT = '/proc/mdstat'
+SPEED_LIMIT_MAX = '/proc/sys/dev/raid/speed_limit_max'
+
+# Delay between 2 reads of /proc/mdstat when monitoring the arrays.
+MONITOR_INTERVAL = 5
+
+
+_array_re = re.compile(r'^(md\S+) : (\S+)(?: \([^)]*\))* ?(\S*) ?(.*)$')
+_progress_re = re.compile(r'(resync|recovery|check|reshape|repair)\s*=\s*'
+                          r'([\d.]+)%.*?finish=([\d.]+)min\s+speed=(\d+)K/sec')
+_pending_re = re.compile(r'(resync|recovery|check|reshape|repair)\s*=\s*'
+                         r'(PENDING|DELAYED)')
+
+
+class MdStatus(object):
+
+    __slots__ = ('name', 'state', 'level', 'members', 'action',
+                 'progress', 'finish', 'speed')
+
+    def __init__(self, name, state, level, members):
+        self.name = name
+        self.state = state          # 'active', 'inactive'
+        self.level = level
+        self.members = members
+        self.action = None          # 'resync', 'recovery'... if any
+        self.progress = None        # done fraction, None if pending
+        self.finish = None          # estimated seconds left
+        self.speed = None           # KiB/s
+
+    @property
+    def is_syncing(self):
+        return self.action is not None
+
+    def __str__(self):
+        if not self.action:
+            return "%s: %s %s" % (self.name, self.state, self.level)
+        if self.progress is None:
+            return "%s: %s pending" % (self.name, self.action)
+        return "%s: %s %.1f%% done, %.1f min left (%d KiB/s)" % \
+            (self.name, self.action, self.progress * 100,
+             self.finish / 60.0, self.speed)
+
+
+def parse(content):
+    """Parse the content of /proc/mdstat and returns the status of
+    the arrays indexed by their names"""
+    arrays = OrderedDict()
+    current = None
+    for line in content.splitlines():
+        match = _array_re.match(line)
+        if match:
+            name, state, level, members = match.groups()
+            # Inactive arrays have no level.
+            if '[' in level:
+                level, members = '', level + ' ' + members
+            members = [m.split('[')[0] for m in members.split()]
+            current = arrays[name] = MdStatus(name, state, level, members)
+            continue
+        if not line.strip():
+            current = None
+            continue
+        if current is None:
+            continue
+
+        match = _progress_re.search(line)
+        if match:
+            current.action = match.group(1)
+            current.progress = float(match.group(2)) / 100
+            current.finish = float(match.group(3)) * 60
+            current.speed = int(match.group(4))
+            continue
+        match = _pending_re.search(line)
+        if match:
+            current.action = match.group(1)
+    return arrays
+
+
+def read(path=MDSTAT):
+    try:
+        with open(path) as f:
+            return parse(f.read())
+    except (IOError, OSError):
+        # md module not loaded.
+        return OrderedDict()
+
+
+def get_speed_limit():
+    """Returns the maximum resync speed in KiB/s"""
+    with open(SPEED_LIMIT_MAX) as f:
+        return int(f.read())
+
+
+def set_speed_limit(speed):
+    with open(SPEED_LIMIT_MAX, 'w') as f:
+        f.write('%d\n' % speed)
+
+
+@contextmanager
+def throttle_resync(speed):
+    """Limit the resync speed of the arrays to 'speed' KiB/s while
+    the block is executed if any array is being synchronized. 0
+    means no limit."""
+    previous = None
+    if speed and any(md.is_syncing for md in read().values()):
+        try:
+            previous = get_speed_limit()
+            if previous > speed:
+                logger.debug("limiting MD resync speed to %d KiB/s", speed)
+                set_speed_limit(speed)
+            else:
+                previous = None
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("failed to limit MD resync speed: %s", e)
+            previous = None
+    try:
+        yield
+    finally:
+        if previous:
+            try:
+                set_speed_limit(previous)
+            except (IOError, OSError) as e:
+                logger.warning("failed to restore MD resync speed: %s", e)
+
+
+class ResyncMonitor(object):
+    """Call 'callback' with the status of the arrays being
+    synchronized every 'interval' seconds until stopped. It can be
+    used as a context manager."""
+
+    def __init__(self, callback, interval=MONITOR_INTERVAL):
+        self._callback = callback
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            syncing = [md for md in read().values() if md.is_syncing]
+            if syncing:
+                try:
+                    self._callback(syncing)
+                except Exception:
+                    logger.exception("MD resync callback failed")
+            self._stopped.wait(self._interval)
+            if self._stopped.is_set():
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="md-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# Build the mkfs command lines used to format the new partitions.
+#
+# In fast mode, the work that mkfs would do upfront is reduced
+# according to the underlying disks:
+#
+#  - ext4 initializes its inode tables and journal lazily (the kernel
+#    zeroes the inode tables in the background after the first mount),
+#
+#  - devices supporting discard are discarded with one BLKDISCARD
+#    before mkfs, which is then told not to discard (mke2fs discards
+#    in chunks and checks whether discarded blocks read back as
+#    zeroes),
+#
+#  - xfs gets more allocation groups on striped arrays so the
+#    allocations are spread over the members.
+#
+# Mirrors whose members were zeroed are created in sync (mdadm
+# --assume-clean). They're never discarded afterwards: discarded
+# blocks may read back differently from each member, whatever the
+# kernel reports.
+#
+# On RAID arrays, the filesystems are always told the stripe geometry
+# (chunk size and number of data disks) so their allocations are
+# aligned on full stripes.
+#
+from __future__ import unicode_literals
+
+import os
+import fcntl
+import struct
+import logging
+
+from . import probe
+from .device import MetadiskDevice, DEVICE_CLASS_NVME, DEVICE_CLASS_SSD, \
+    DEVICE_CLASS_HDD, DEVICE_CLASS_REMOVABLE
+from .utils import MiB, GiB, pretty_size
+
+
+logger = logging.getLogger(__name__)
+
+
+BLKDISCARD = 0x1277     # _IO(0x12, 119)
+BLKZEROOUT = 0x127f     # _IO(0x12, 127)
+
+EXT4_BLOCK_SIZE = 4096
+# Default inode ratio and size of mke2fs.
+EXT4_INODE_RATIO = 16384
+EXT4_INODE_SIZE  = 256
+
+# Typical sequential write throughput of each class of disks (bytes/s),
+# used when the disks haven't been probed.
+_CLASS_THROUGHPUTS = {
+    DEVICE_CLASS_NVME      : 1000 * MiB,
+    DEVICE_CLASS_SSD       : 300 * MiB,
+    DEVICE_CLASS_HDD       : 120 * MiB,
+    DEVICE_CLASS_REMOVABLE : 20 * MiB,
+}
+
+# mkfs.xfs refuses allocation groups smaller than 16MiB.
+XFS_MIN_AG_SIZE = 16 * MiB
+XFS_MAX_AGCOUNT = 32
+
+
+class MkfsPlan(object):
+    """Describe how a device is formatted: the mkfs command, whether
+    the device should be discarded first and an estimation of the
+    bytes mkfs won't have to write compared to the default mode."""
+
+    __slots__ = ('command', 'discard', 'deferred')
+
+    def __init__(self, command, discard=False, deferred=0):
+        self.command = command
+        self.discard = discard
+        self.deferred = deferred
+
+
+def _disks(bdev):
+    return bdev.get_root_parents() or [bdev]
+
+
+def is_rotational(bdev):
+    return any(d.is_rotational for d in _disks(bdev))
+
+
+def supports_discard(bdev):
+    # An array may not pass discard requests down (raid5 for example)
+    # even if its members support it.
+    if isinstance(bdev, MetadiskDevice) and not bdev.supports_discard:
+        return False
+    return all(d.supports_discard for d in _disks(bdev))
+
+
+def discard_zeroes_data(bdev):
+    """True if discarded blocks of 'bdev' are guaranteed to read back
+    as zeroes (deterministic read zeroes after TRIM)"""
+    return all(d.discard_zeroes_data for d in _disks(bdev))
+
+
+def supports_write_zeroes(bdev):
+    return all(d.supports_write_zeroes for d in _disks(bdev))
+
+
+def zeroing_method(level, members):
+    """Returns the function zeroing the 'members' of a new array so
+    its initial resync can be skipped, or None if it can't be"""
+    #
+    # The mirrors of raid1/raid10 arrays are identical if all the
+    # members read back as zeroes. This doesn't hold for parity
+    # levels, whose parity blocks must be computed anyway.
+    #
+    # Only SSDs reporting deterministic zeroes after TRIM can be
+    # simply discarded, others may return anything for discarded
+    # blocks. Otherwise the zeroing must be offloaded to the devices
+    # (write zeroes) or it would be slower than the resync.
+    #
+    if level not in ('raid1', 'raid10'):
+        return None
+    if any(is_rotational(m) for m in members):
+        return None
+    if all(supports_discard(m) and discard_zeroes_data(m) for m in members):
+        return discard
+    if all(supports_write_zeroes(m) for m in members):
+        return zeroout
+    return None
+
+
+def _ext4_journal_size(size):
+    # Same as ext2fs_default_journal_size() with 4K blocks.
+    for fs_size, journal_size in ((128 * MiB, 16 * MiB),
+                                  (1 * GiB, 32 * MiB),
+                                  (16 * GiB, 64 * MiB),
+                                  (32 * GiB, 128 * MiB),
+                                  (64 * GiB, 256 * MiB),
+                                  (128 * GiB, 512 * MiB)):
+        if size < fs_size:
+            return journal_size
+    return 1 * GiB
+
+
+def _xfs_agcount(bdev, data_disks):
+    # 4 groups per data disk, like the default for a single disk.
+    agcount = min(4 * data_disks, XFS_MAX_AGCOUNT)
+    return min(agcount, bdev.size // XFS_MIN_AG_SIZE)
+
+
+def plan(bdev, fs, fast=False, stripe=None, assume_clean=False):
+    """Returns the MkfsPlan to format 'bdev' with 'fs'. 'stripe' is
+    (chunk size in bytes, number of data disks) if 'bdev' is a striped
+    array. 'assume_clean' is set if 'bdev' is an array created without
+    initial resync, it must not be discarded."""
+    discard = fast and not assume_clean and supports_discard(bdev)
+    nodiscard = fast or assume_clean
+
+    if fs == 'swap':
+        return MkfsPlan(['mkswap', bdev.devpath], discard)
+
+    opts = []
+    deferred = 0
+
+    if fs == 'vfat':
+        # Needed when the partition is actually a MD device.
+        opts = ['-I']
+
+    elif fs.startswith('ext'):
+        opts = ['-q']
+        extended = []
+        if stripe:
+            # Both are expressed in filesystem blocks, so don't let
+            # mke2fs pick another block size for small filesystems.
+            chunk, data_disks = stripe
+            stride = chunk // EXT4_BLOCK_SIZE
+            opts += ['-b', str(EXT4_BLOCK_SIZE)]
+            extended += ['stride=%d' % stride,
+                         'stripe_width=%d' % (stride * data_disks)]
+        if nodiscard:
+            extended += ['nodiscard']
+        if fast:
+            if fs == 'ext4':
+                extended += ['lazy_itable_init=1', 'lazy_journal_init=1']
+                deferred = (bdev.size // EXT4_INODE_RATIO * EXT4_INODE_SIZE +
+                            _ext4_journal_size(bdev.size))
+        if extended:
+            opts += ['-E', ','.join(extended)]
+
+    elif fs == 'xfs':
+        data = []
+        if stripe:
+            chunk, data_disks = stripe
+            data += ['su=%dk' % (chunk // 1024), 'sw=%d' % data_disks]
+        if nodiscard:
+            opts = ['-K']
+        if fast:
+            if stripe:
+                agcount = _xfs_agcount(bdev, stripe[1])
+                if agcount > 4:
+                    data += ['agcount=%d' % agcount]
+        if data:
+            opts += ['-d', ','.join(data)]
+
+    return MkfsPlan(['mkfs', '-t', fs] + opts + [bdev.devpath], discard, deferred)
+
+
+def discard(bdev):
+    """Discard the whole content of 'bdev' with a single request"""
+    fd = os.open(bdev.devpath, os.O_WRONLY)
+    try:
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack(str('QQ'), 0, bdev.size))
+    finally:
+        os.close(fd)
+
+
+def zeroout(bdev):
+    """Zero the whole content of 'bdev' with a single request, it's
+    only fast if the device supports write zeroes"""
+    fd = os.open(bdev.devpath, os.O_WRONLY)
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack(str('QQ'), 0, bdev.size))
+    finally:
+        os.close(fd)
+
+
+def _throughput(disk):
+    """Returns the throughput of 'disk' in bytes/s and whether it was
+    measured"""
+    result = probe.get_result(disk)
+    if result:
+        return result.throughput, True
+    return _CLASS_THROUGHPUTS[disk.device_class], False
+
+
+def estimate_savings(bdev, deferred):
+    """Returns the time in seconds the disks of 'bdev' would need to
+    write 'deferred' bytes and whether it's based on the measured
+    throughput of all of them"""
+    throughputs = [_throughput(d) for d in _disks(bdev)]
+    seconds = deferred / float(min(t for t, measured in throughputs))
+    return seconds, all(measured for t, measured in throughputs)
+
+
+def describe_savings(bdev, deferred):
+    seconds, measured = estimate_savings(bdev, deferred)
+    s = "%s of initialization deferred, about %.1fs saved" % \
+        (pretty_size(deferred), seconds)
+    if not measured:
+        s += " (estimated for %s)" % ", ".join(sorted(set(d.device_class
+                                                          for d in _disks(bdev))))
+    return s
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Parse /proc/self/mountinfo once and keep it indexed by device
+# number, source and target so looking up the mount points of a device
+# doesn't require to spawn findmnt(8) each time.
+#
+# The kernel flags the mountinfo file descriptor with POLLPRI (and
+# POLLERR) each time the mount table of the namespace changes, so the
+# file is parsed again only when it's needed. See proc(5).
+#
+from __future__ import unicode_literals
+
+import os
+import re
+import select
+import threading
+
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+_escape_pattern = re.compile(r'\\([0-7]{3})')
+
+def _unescape(field):
+    """Decode the octal escapes (\\040 for space...) used by the kernel"""
+    return _escape_pattern.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountEntry(object):
+    """A single line of the mountinfo file"""
+
+    __slots__ = ('devnum', 'root', 'target', 'options', 'fstype',
+                 'source', 'super_options')
+
+    def __init__(self, line):
+        fields = line.split()
+        # Optional fields are terminated by a single hyphen.
+        sep = fields.index('-', 6)
+
+        major, minor = fields[2].split(':')
+        self.devnum  = (int(major), int(minor))
+        self.root    = _unescape(fields[3])
+        self.target  = _unescape(fields[4])
+        self.options = fields[5].split(',')
+        self.fstype  = fields[sep + 1]
+        self.source  = _unescape(fields[sep + 2])
+        self.super_options = fields[sep + 3].split(',')
+
+    @property
+    def all_options(self):
+        """Per mount options followed by the superblock ones, the way
+        findmnt(8) reports them."""
+        opts = list(self.options)
+        for opt in self.super_options:
+            if opt not in opts and opt not in ('rw', 'ro'):
+                opts.append(opt)
+        return opts
+
+
+class _MountTable(object):
+
+    def __init__(self, path=MOUNTINFO):
+        self._path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._poll = None
+        self._by_devnum = {}
+        self._by_source = {}
+        self._by_target = {}
+
+    def _open(self):
+        self._fd = os.open(self._path, os.O_RDONLY)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+
+    def _read(self):
+        chunks = []
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode('utf-8', 'replace')
+
+    def _parse(self):
+        by_devnum = {}
+        by_source = {}
+        by_target = {}
+
+        for line in self._read().splitlines():
+            if not line:
+                continue
+            entry = MountEntry(line)
+            by_devnum.setdefault(entry.devnum, []).append(entry)
+            by_source.setdefault(entry.source, []).append(entry)
+            by_target.setdefault(entry.target, []).append(entry)
+
+        self._by_devnum = by_devnum
+        self._by_source = by_source
+        self._by_target = by_target
+
+    def refresh(self, force=False):
+        """Reparse the mount table if it has changed since the last
+        time it was read."""
+        with self._lock:
+            if self._fd is None:
+                self._open()
+                force = True
+            if self._poll.poll(0):
+                force = True
+            if force:
+                self._parse()
+
+    def find_device(self, major, minor, devpath=None):
+        """Returns the mount entries of a block device. Filesystems
+        such as btrfs report an anonymous device number, so the
+        source can be matched too."""
+        self.refresh()
+        entries = list(self._by_devnum.get((major, minor), []))
+        if devpath:
+            for entry in self._by_source.get(devpath, []):
+                if entry not in entries:
+                    entries.append(entry)
+        return entries
+
+    def find_target(self, target):
+        self.refresh()
+        return list(self._by_target.get(target, []))
+
+    def mounted_devices(self):
+        """Returns the set of the device numbers and the set of the
+        sources currently mounted."""
+        self.refresh()
+        return set(self._by_devnum), set(self._by_source)
+
+
+mount_table = _MountTable()
@@ -10,7 +10,7 @@ from tempfile import mkdtemp
 from .settings import settings
 from .system import distribution, get_arch
 from .utils import pretty_size, MiB, GiB
-from .process import check_output
+from .mountinfo import mount_table
 from . import device
 from . import disk
 
@@ -41,8 +41,12 @@ class PartitionSetup(object):
         self.size = 0 # size that will be used to create partition
         self.fs_hint_size = 0
         self.fs = None
+        self.image = None # filesystem image written instead of mkfs
         self._raid_level    = None
         self._raid_metadata = None
+        self._raid_chunk    = 0
+        self._raid_data_disks = 1
+        self._raid_bitmap   = None
 
     def estimate_size(self, pretty=False):
         """Returns an estimation of the partition size once the target
@@ -64,6 +68,18 @@ class PartitionSetup(object):
         if metadata:
             self._raid_metadata = metadata
 
+    @property
+    def raid_geometry(self):
+        """Returns (chunk size in bytes, number of data disks, bitmap),
+        the chunk size is 0 for levels without striping"""
+        if self._raid_level:
+            return (self._raid_chunk, self._raid_data_disks, self._raid_bitmap)
+
+    def set_raid_geometry(self, chunk, data_disks, bitmap=None):
+        self._raid_chunk = chunk
+        self._raid_data_disks = data_disks
+        self._raid_bitmap = bitmap
+
 #
 # Note: we follow the "The Discoverable Partitions Specification":
 #
@@ -145,6 +161,8 @@ class Partition(object):
             settings.remove("Partitions", self.name)
 
         self._device = dev
+        # Candidates of the other partitions have changed.
+        device.invalidate()
 
     def mount(self, target, options=[]):
         self.device.mount(target, options)
@@ -159,10 +177,11 @@ class Partition(object):
     @property
     def mount_options(self):
         if not self._mnt_options:
-            devpath = self.device.devpath
-            opts = check_output(["findmnt", "-cvuno", "OPTIONS", devpath])
-            opts = opts.split()[0].decode()
-            opts = opts.split(',')
+            dev = self.device
+            entries = mount_table.find_device(dev.major, dev.minor, dev.devpath)
+            if not entries:
+                raise PartitionError(_("%s is not mounted") % dev.devpath)
+            opts = entries[0].all_options
 
             # Before kernels 3.8, codepage option in fat filesystems
             # was stored by the kernel with the 'cp' prefix making the
@@ -416,13 +435,21 @@ def find_partition(name):
             return part
 
 def get_candidates(part, all=False):
+    return list(_get_candidates(part, all))
+
+#
+# The candidates are computed again only when the device list changes
+# or when a device is assigned to a partition, see Partition.device.
+#
+@device.memoize_generation
+def _get_candidates(part, all):
     candidates = []
 
     #
-    # Build the list of devices currently selected by partitions and
+    # Build the set of devices currently selected by partitions and
     # exclude them.
     #
-    busy_devices = [p.device for p in partitions if p != part and p.device]
+    busy_devices = set(p.device for p in partitions if p != part and p.device)
 
     #
     # Consider leaf devices only: it can be either a disk or a
@@ -447,7 +474,7 @@ def get_candidates(part, all=False):
 
         candidates.append(dev)
 
-    return candidates
+    return tuple(candidates)
 
 def __uevent_callback(action, bdev):
     if action == "remove":
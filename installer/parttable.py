@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# Create and update GPT and MBR partition tables without relying on
+# sgdisk/sfdisk: the whole layout is computed in memory and written
+# with a couple of writes per disk (the primary structures at the
+# start of the disk and, for GPT, the backup ones at its end).
+#
+# It works on block devices as well as on plain image files. For block
+# devices, the kernel is asked to re-read the partition table once the
+# table is written.
+#
+# See the UEFI specification (chapter 5, "GUID Partition Table
+# Format") for the on-disk layouts.
+#
+from __future__ import unicode_literals
+
+import os
+import stat
+import uuid
+import zlib
+import errno
+import fcntl
+import struct
+import time
+
+
+class PartitionTableError(Exception):
+    """Base class for exceptions in the parttable module"""
+
+
+BLKRRPART = 0x125f      # _IO(0x12, 95)
+
+BOOTCODE_SIZE = 440
+
+# GPT attributes (bit numbers)
+GPT_ATTR_REQUIRED        = 0
+GPT_ATTR_NO_BLOCK_IO     = 1
+GPT_ATTR_LEGACY_BOOTABLE = 2
+
+_GPT_SIGNATURE = b'EFI PART'
+_GPT_REVISION = 0x00010000
+_GPT_HEADER = struct.Struct(str('<8sIIIIQQQQ16sQIII'))
+_GPT_ENTRY = struct.Struct(str('<16s16sQQQ72s'))
+_GPT_ENTRIES = 128
+
+_MBR_ENTRY = struct.Struct(str('<B3sB3sII'))
+_MBR_ENTRIES_OFFSET = 446
+_MBR_SIGNATURE = b'\x55\xaa'
+_MBR_TYPE_PROTECTIVE = 0xee
+# CHS addresses aren't used by Linux, use the "out of range" value.
+_MBR_CHS_MAX = b'\xfe\xff\xff'
+
+# MBR partition types of the sgdisk type codes. The GPT-only Linux
+# types (root, /home, /srv...) are plain Linux partitions on MBR.
+_MBR_TYPES = {
+    '0700': 0x07,   # Microsoft basic data
+    '8200': 0x82,   # Linux swap
+    '8300': 0x83,   # Linux filesystem
+    '8301': 0x83,   # Linux reserved
+    '8302': 0x83,   # Linux /home
+    '8303': 0x83,   # Linux x86 root
+    '8304': 0x83,   # Linux x86-64 root
+    '8305': 0x83,   # Linux ARM64 root
+    '8306': 0x83,   # Linux /srv
+    '8e00': 0x8e,   # Linux LVM
+    'ea00': 0xea,   # Extended boot loader
+    'ef00': 0xef,   # EFI system
+    'fd00': 0xfd,   # Linux RAID
+}
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _align_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class PartitionEntry(object):
+
+    __slots__ = ('num', 'start', 'end', 'typeuuid', 'uuid', 'name',
+                 'attributes', 'mbr_type', 'active')
+
+    def __init__(self, num, start, end, typeuuid=None, name='',
+                 partuuid=None, attributes=0, mbr_type=0x83, active=False):
+        self.num = num
+        self.start = start      # first sector
+        self.end = end          # last sector (inclusive)
+        self.typeuuid = typeuuid
+        self.uuid = partuuid or str(uuid.uuid4())
+        self.name = name
+        self.attributes = attributes
+        self.mbr_type = mbr_type
+        self.active = active
+
+    @property
+    def sectors(self):
+        return self.end - self.start + 1
+
+
+class PartitionTable(object):
+    """In memory partition table of a disk of 'size' bytes"""
+
+    def __init__(self, size, scheme='gpt', sector_size=512, alignment=2048,
+                 disk_uuid=None, alignment_offset=0):
+        if scheme not in ('gpt', 'dos'):
+            raise PartitionTableError("unsupported partition scheme '%s'" % scheme)
+        self.scheme = scheme
+        self.sector_size = sector_size
+        self.alignment = alignment
+        self.alignment_offset = alignment_offset
+        self.sectors = size // sector_size
+        self.bootcode = None
+        self.partitions = []
+
+        if scheme == 'gpt':
+            self.disk_uuid = disk_uuid or str(uuid.uuid4())
+            self._entries_sectors = _align_up(_GPT_ENTRIES * _GPT_ENTRY.size,
+                                              sector_size) // sector_size
+            self.first_usable = 2 + self._entries_sectors
+            self.last_usable = self.sectors - 2 - self._entries_sectors
+        else:
+            self.disk_uuid = disk_uuid or '%08x' % struct.unpack(str('<I'), os.urandom(4))[0]
+            self.first_usable = 1
+            self.last_usable = min(self.sectors, 0xffffffff) - 1
+
+        if self.last_usable <= self.first_usable:
+            raise PartitionTableError("disk is too small")
+
+    def _next_start(self):
+        start = self.first_usable
+        if self.partitions:
+            start = self.partitions[-1].end + 1
+        # The aligned LBAs are the multiples of 'alignment' shifted
+        # by the offset of the first one.
+        offset = self.alignment_offset
+        return max(self.first_usable, _align_up(start - offset, self.alignment) + offset)
+
+    def add(self, size=0, typeuuid=None, name='', typecode=None):
+        """Append a partition of 'size' bytes, 0 means the remaining
+        space. Its start is aligned on 'alignment' sectors, shifted
+        by 'alignment_offset' sectors.
+        'typecode' is the sgdisk 2-byte type code ('8300'...), only
+        used by MBR. Returns the new entry."""
+        if self.scheme == 'dos' and len(self.partitions) == 4:
+            raise PartitionTableError("no more than 4 primary partitions on MBR")
+
+        start = self._next_start()
+        if size:
+            end = start + int(size) // self.sector_size - 1
+        else:
+            # Keep the size a multiple of the alignment too.
+            end = self.last_usable + 1
+            end = start + (end - start) // self.alignment * self.alignment - 1
+        if end > self.last_usable or end < start:
+            raise PartitionTableError("not enough space left on device")
+
+        mbr_type = 0x83
+        if typecode:
+            try:
+                mbr_type = _MBR_TYPES[typecode.lower()]
+            except KeyError:
+                raise PartitionTableError("no MBR type for type code %s" % typecode)
+        part = PartitionEntry(len(self.partitions) + 1, start, end, typeuuid,
+                              name, mbr_type=mbr_type)
+        self.partitions.append(part)
+        return part
+
+    def get(self, num):
+        for part in self.partitions:
+            if part.num == num:
+                return part
+        raise PartitionTableError("no partition #%d" % num)
+
+    def set_attribute(self, num, bit):
+        self.get(num).attributes |= 1 << bit
+
+    def set_active(self, num):
+        """Mark the partition as the only active (bootable) one"""
+        for part in self.partitions:
+            part.active = part.num == num
+
+    def set_bootcode(self, data):
+        self.bootcode = data[:BOOTCODE_SIZE]
+
+    #
+    # Serialization
+    #
+    def _mbr(self, entries):
+        mbr = bytearray(self.sector_size)
+        if self.bootcode:
+            mbr[:len(self.bootcode)] = self.bootcode
+        if self.scheme == 'dos':
+            mbr[440:444] = struct.pack(str('<I'), int(self.disk_uuid, 16))
+        for i, entry in enumerate(entries):
+            off = _MBR_ENTRIES_OFFSET + i * _MBR_ENTRY.size
+            mbr[off:off + _MBR_ENTRY.size] = _MBR_ENTRY.pack(*entry)
+        mbr[510:512] = _MBR_SIGNATURE
+        return bytes(mbr)
+
+    def _gpt_entries(self):
+        data = bytearray(self._entries_sectors * self.sector_size)
+        for part in self.partitions:
+            name = part.name.encode('utf-16-le')[:72]
+            entry = _GPT_ENTRY.pack(uuid.UUID(part.typeuuid).bytes_le,
+                                    uuid.UUID(part.uuid).bytes_le,
+                                    part.start, part.end, part.attributes, name)
+            off = (part.num - 1) * _GPT_ENTRY.size
+            data[off:off + _GPT_ENTRY.size] = entry
+        return bytes(data)
+
+    def _gpt_header(self, current, backup, entries_lba, entries_crc):
+        def pack(crc):
+            return _GPT_HEADER.pack(_GPT_SIGNATURE, _GPT_REVISION,
+                                    _GPT_HEADER.size, crc, 0, current, backup,
+                                    self.first_usable, self.last_usable,
+                                    uuid.UUID(self.disk_uuid).bytes_le,
+                                    entries_lba, _GPT_ENTRIES, _GPT_ENTRY.size,
+                                    entries_crc)
+        header = pack(_crc32(pack(0)))
+        return header + b'\0' * (self.sector_size - len(header))
+
+    def build(self):
+        """Returns the list of (offset, data) to write on the disk"""
+        ss = self.sector_size
+        last = self.sectors - 1
+
+        if self.scheme == 'dos':
+            entries = []
+            for part in self.partitions:
+                entries.append((0x80 if part.active else 0, _MBR_CHS_MAX,
+                                part.mbr_type, _MBR_CHS_MAX, part.start,
+                                part.sectors))
+            # A GPT left over is ignored without a protective MBR, and
+            # the last sectors may belong to a partition in use.
+            return [(0, self._mbr(entries))]
+
+        protective = (0, b'\x00\x02\x00', _MBR_TYPE_PROTECTIVE, _MBR_CHS_MAX,
+                      1, min(last, 0xffffffff))
+        entries = self._gpt_entries()
+        crc = _crc32(entries)
+        backup_entries_lba = last - self._entries_sectors
+
+        primary = (self._mbr([protective]) +
+                   self._gpt_header(1, last, 2, crc) +
+                   entries)
+        backup = entries + self._gpt_header(last, 1, backup_entries_lba, crc)
+        return [(0, primary), (backup_entries_lba * ss, backup)]
+
+    def write(self, path, reread=True):
+        """Write the table on 'path' with a single pass. If 'path' is a
+        block device and 'reread' is true, the kernel re-reads the
+        table afterwards."""
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for offset, data in self.build():
+                os.lseek(fd, offset, os.SEEK_SET)
+                while data:
+                    data = data[os.write(fd, data):]
+            os.fsync(fd)
+            if reread and stat.S_ISBLK(os.fstat(fd).st_mode):
+                _reread(fd)
+        finally:
+            os.close(fd)
+
+    #
+    # Parsing
+    #
+    @classmethod
+    def read(cls, path, sector_size=512, alignment=2048):
+        """Load the table currently written on 'path'"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            os.lseek(fd, 0, os.SEEK_SET)
+            head = bytearray(os.read(fd, sector_size * 2))
+            if len(head) < sector_size * 2 or bytes(head[510:512]) != _MBR_SIGNATURE:
+                raise PartitionTableError("%s: no partition table found" % path)
+
+            # Like libblkid, ignore a GPT without a protective MBR.
+            if (head[_MBR_ENTRIES_OFFSET + 4] == _MBR_TYPE_PROTECTIVE and
+                bytes(head[sector_size:sector_size + 8]) == _GPT_SIGNATURE):
+                return cls._read_gpt(fd, size, bytes(head), sector_size, alignment)
+            return cls._read_mbr(size, bytes(head), sector_size, alignment)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _read_gpt(cls, fd, size, head, sector_size, alignment):
+        fields = _GPT_HEADER.unpack_from(head, sector_size)
+        disk_uuid = str(uuid.UUID(bytes_le=fields[9]))
+        entries_lba, count, entry_size = fields[10:13]
+
+        table = cls(size, 'gpt', sector_size, alignment, disk_uuid)
+        table.bootcode = head[:BOOTCODE_SIZE]
+
+        os.lseek(fd, entries_lba * sector_size, os.SEEK_SET)
+        data = os.read(fd, count * entry_size)
+        for i in range(count):
+            typeuuid, partuuid, start, end, attrs, name = \
+                _GPT_ENTRY.unpack_from(data, i * entry_size)
+            if typeuuid == b'\0' * 16:
+                continue
+            name = name.decode('utf-16-le').split('\0')[0]
+            table.partitions.append(PartitionEntry(
+                i + 1, start, end, str(uuid.UUID(bytes_le=typeuuid)), name,
+                str(uuid.UUID(bytes_le=partuuid)), attrs))
+        return table
+
+    @classmethod
+    def _read_mbr(cls, size, head, sector_size, alignment):
+        disk_uuid = '%08x' % struct.unpack_from(str('<I'), head, 440)[0]
+        table = cls(size, 'dos', sector_size, alignment, disk_uuid)
+        table.bootcode = head[:BOOTCODE_SIZE]
+        for i in range(4):
+            status, _chs, mbr_type, _chs, start, sectors = \
+                _MBR_ENTRY.unpack_from(head, _MBR_ENTRIES_OFFSET + i * _MBR_ENTRY.size)
+            if not mbr_type:
+                continue
+            table.partitions.append(PartitionEntry(
+                i + 1, start, start + sectors - 1, mbr_type=mbr_type,
+                active=status == 0x80))
+        return table
+
+
+def _reread(fd):
+    # udev might still have the device opened after the previous
+    # operations (wipe...), retry for a short while.
+    for retry in range(10):
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+            return
+        except IOError as e:
+            if e.errno != errno.EBUSY or retry == 9:
+                raise PartitionTableError("failed to re-read partition table: %s" % e)
+            time.sleep(0.1)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#
+# Compute the disk layout of an installation: the partitions created
+# on each disk, their sizes and filesystems, and the RAID arrays built
+# on top of them.
+#
+# The planning only depends on an inventory of the hardware (disks,
+# memory, firmware) which can be taken from the running system or
+# loaded from JSON. It doesn't touch any global state, so layouts can
+# be evaluated offline for any number of machines.
+#
+from __future__ import unicode_literals
+
+import os
+import json
+import logging
+
+from . import alignment
+from . import partition
+from .partition import PartitionSetup, PartitionSetupError
+from .utils import KiB, MiB, GiB
+
+
+logger = logging.getLogger(__name__)
+
+
+PRESETS = ('small', 'mail', 'web')
+
+DEFAULT_FILESYSTEM = "ext4"
+ROOT_DEFAULT_SIZE = 16 * GiB
+ROOT_MIN_SIZE = 300 * MiB
+HOME_MIN_SIZE = 20 * GiB
+VAR_MIN_SIZE  = 20 * GiB
+SWAP_MIN_SIZE = 100 * MiB
+
+# Memory size assumed for generic (not hostonly) installations.
+DEFAULT_MEMORY = 2 * GiB
+
+# RAID chunk size per preset: mail servers do a lot of small
+# synchronous writes, smaller chunks limit the read-modify-write
+# cycles of raid5/6. Otherwise mdadm default is used.
+RAID_CHUNK_SIZES = {
+    'small': 512 * KiB,
+    'mail' :  64 * KiB,
+    'web'  : 256 * KiB,
+}
+
+
+# Based on: https://access.redhat.com/site/documentation/en-US/Red_Hat_Enterprise_Linux/6/html/Installation_Guide/s2-diskpartrecommend-x86.html
+def calculate_swap_size(memsize, hibernation=False):
+    if memsize <= 2*GiB:
+        factor = 2 if not hibernation else 3
+        size   = factor * memsize
+    elif memsize <= 8*GiB:
+        factor = 1 if not hibernation else 2
+        size   = memsize
+    elif memsize < 64*GiB:
+        factor = 0.5 if not hibernation else 1.5
+        size   = factor * memsize
+    else:
+        size = 4*GiB
+
+    return size
+
+
+#
+# Inventory
+#
+class InventoryDisk(object):
+    """The characteristics of a disk used by the planning. It
+    implements the subset of the DiskDevice API needed by the
+    alignment planner."""
+
+    __slots__ = ('name', 'size', 'bus', 'is_rotational', 'sector_size',
+                 'physical_block_size', 'minimum_io_size', 'optimal_io_size',
+                 'alignment_offset')
+
+    # Serialized name and default value of each attribute.
+    _fields = (('name', None), ('size', 0), ('bus', None),
+               ('rotational', True), ('sector_size', 512),
+               ('physical_block_size', 0), ('minimum_io_size', 0),
+               ('optimal_io_size', 0), ('alignment_offset', 0))
+
+    def __init__(self, **kwargs):
+        for key, default in self._fields:
+            value = kwargs.get(key, default)
+            setattr(self, 'is_rotational' if key == 'rotational' else key, value)
+        self.physical_block_size = self.physical_block_size or self.sector_size
+
+    @property
+    def devpath(self):
+        return '/dev/' + self.name
+
+    @classmethod
+    def from_bdev(cls, bdev):
+        return cls(name=os.path.basename(bdev.devpath), size=bdev.size, bus=bdev.bus,
+                   rotational=bdev.is_rotational,
+                   sector_size=bdev.sector_size,
+                   physical_block_size=bdev.physical_block_size,
+                   minimum_io_size=bdev.minimum_io_size,
+                   optimal_io_size=bdev.optimal_io_size,
+                   alignment_offset=bdev.alignment_offset)
+
+    def to_dict(self):
+        d = {}
+        for key, default in self._fields:
+            d[key] = getattr(self, 'is_rotational' if key == 'rotational' else key)
+        return d
+
+
+class Inventory(object):
+    """The hardware of a machine. 'memory' is None for generic
+    installations (the target machine isn't known)."""
+
+    __slots__ = ('id', 'disks', 'memory', 'firmware')
+
+    def __init__(self, disks, memory=None, firmware=('bios',), id=None):
+        self.id = id
+        self.disks = disks
+        self.memory = memory
+        self.firmware = list(firmware)
+
+    @classmethod
+    def from_system(cls, bdevs):
+        """Returns the inventory of the running system restricted to
+        the disks 'bdevs'"""
+        from .settings import settings
+        from .system import get_meminfo
+
+        memory = None
+        if settings.Options.hostonly:
+            memory = get_meminfo()['MemTotal']
+        return cls([InventoryDisk.from_bdev(b) for b in bdevs], memory,
+                   settings.Options.firmware)
+
+    @classmethod
+    def from_dict(cls, d):
+        disks = [InventoryDisk(**disk) for disk in d.get('disks', [])]
+        return cls(disks, d.get('memory'), d.get('firmware', ['bios']), d.get('id'))
+
+    def to_dict(self):
+        d = {'disks': [disk.to_dict() for disk in self.disks],
+             'memory': self.memory,
+             'firmware': self.firmware}
+        if self.id is not None:
+            d['id'] = self.id
+        return d
+
+
+def load_inventories(fp):
+    """Read the inventories stored in the file object 'fp': either a
+    JSON object, a JSON list of objects, or one JSON object per
+    line"""
+    content = fp.read()
+    try:
+        data = json.loads(content)
+    except ValueError:
+        data = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = [data]
+    return [Inventory.from_dict(d) for d in data]
+
+
+#
+# Planning
+#
+class Layout(object):
+    """The result of the planning. 'partitions' is the list of the
+    (Partition, PartitionSetup) to create on each disk, in order."""
+
+    __slots__ = ('preset', 'disks', 'alignment', 'partitions', 'swap_dropped')
+
+    def __init__(self, preset, disks, alignment, partitions, swap_dropped):
+        self.preset = preset
+        self.disks = disks
+        self.alignment = alignment
+        self.partitions = partitions
+        self.swap_dropped = swap_dropped
+
+    @property
+    def RAID(self):
+        return len(self.disks) > 1
+
+    def to_dict(self):
+        parts = []
+        for part, setup in self.partitions:
+            p = {'name': part.name,
+                 'label': part.label,
+                 'size': int(setup.size),
+                 'fs': setup.fs,
+                 'fs_hint_size': int(setup.fs_hint_size)}
+            if setup.raid_level:
+                level, metadata = setup.raid_level
+                chunk, data_disks, bitmap = setup.raid_geometry
+                p['raid'] = {'level': level, 'metadata': metadata,
+                             'chunk': chunk, 'data_disks': data_disks,
+                             'bitmap': bitmap}
+            parts.append(p)
+        return {'preset': self.preset,
+                'disks': [d.name for d in self.disks],
+                'alignment': {'grain': self.alignment.grain,
+                              'stripe': self.alignment.stripe},
+                'partitions': parts}
+
+
+def _plan_raid_level(disks):
+    """Returns the RAID level used for the arrays (but /boot) and the
+    number of disks holding data in a stripe"""
+    count = len(disks)
+    if count == 2:
+        return 'raid1', 1
+    if count == 3:
+        # level 5 nécessite impérativement un minimum de trois disques durs
+        # at least 2 raid-devices needed for level 4 or 5
+        return 'raid5', 2
+    #
+    # SSDs have no seek penalty, so favour the write performance and
+    # the short rebuilds of raid10 over the capacity of raid6. An even
+    # number of disks keeps the stripe a whole number of disks.
+    #
+    if count % 2 == 0 and not any(d.is_rotational for d in disks):
+        return 'raid10', count // 2
+    # at least 4 raid-devices needed for level 6
+    # no more than 256 raid-devices supported for level 6
+    return 'raid6', count - 2
+
+
+class _Planner(object):
+
+    def __init__(self, inventory, preset, align, with_swap):
+        self.inventory = inventory
+        self.preset = preset
+        self.alignment = align
+        self.partitions = []
+
+        disks = inventory.disks
+        self.RAID = len(disks) > 1
+
+        total = min(d.size for d in disks)
+        #
+        # Leave room for the partition tables at both ends: the first
+        # partition starts one grain into the disk and the backup GPT
+        # takes the last sectors, which costs another grain once the
+        # partitions are aligned. Otherwise partitions with a fixed
+        # size could be planned on disks they don't fit on.
+        #
+        free = total - 2 * align.grain
+
+        free = self._create_boot_partition(free)
+        if with_swap:
+            free = self._create_swap_partition(free, total)
+        free = self._create_root_partition(free)
+        free = self._create_data_partition(free)
+
+    def _add(self, part):
+        setup = PartitionSetup()
+        self.partitions.append((part, setup))
+        return setup
+
+    def _create_boot_partition(self, free):
+        firmware = self.inventory.firmware
+        if self.RAID or "uefi" in firmware:
+            if free < 1 * GiB:
+                size = 34 * MiB
+            elif free < 16 * GiB:
+                size = 64 * MiB
+            elif free < 32 * GiB:
+                size = 128 * MiB
+            elif free < 128 * GiB:
+                size = 256 * MiB
+            else:
+                size = 512 * MiB
+
+            setup = self._add(partition.boot)
+            if "uefi" in firmware:
+                setup.fs = 'vfat'
+            else:
+                setup.fs = DEFAULT_FILESYSTEM
+
+            size = self.alignment.align_size(size)
+            setup.size = size
+            free -= size
+        return free
+
+    def _create_swap_partition(self, free, total):
+        memsize = self.inventory.memory or DEFAULT_MEMORY
+
+        size = min(calculate_swap_size(memsize), total * 10/100)
+        size = max(size, partition.swap.minsize)
+        if free < size:
+            raise PartitionSetupError() # FIXME
+
+        size = self.alignment.align_size(size)
+        setup = self._add(partition.swap)
+        setup.fs   = "swap"
+        setup.size = size
+        return free - size
+
+    def _create_root_partition(self, free):
+        if free < partition.root.minsize:
+            raise PartitionSetupError() # FIXME
+
+        setup = self._add(partition.root)
+        if self.preset == 'small':
+            setup.fs_hint_size = free # remaining of the free space
+            free = 0
+        elif free >= ROOT_DEFAULT_SIZE:
+            setup.size = self.alignment.align_size(ROOT_DEFAULT_SIZE)
+            free -= setup.size
+        else:
+            raise PartitionSetupError() # FIXME
+
+        setup.fs = DEFAULT_FILESYSTEM
+        return free
+
+    def _create_data_partition(self, free):
+        if self.preset in ('mail', 'web'):
+            if self.preset == 'mail':
+                part = partition.home
+            elif self.preset == 'web':
+                part = partition.var
+
+            if free < part.minsize:
+                raise PartitionSetupError() # FIXME
+
+            setup = self._add(part)
+            setup.fs = DEFAULT_FILESYSTEM
+            setup.fs_hint_size = free # remaining of the free space
+            free = 0
+        return free
+
+
+def plan(inventory, preset='small', raid_bitmap=True):
+    """Returns the Layout of an installation on all the disks of
+    'inventory' for 'preset'. Several disks are assembled with RAID
+    arrays, with a write-intent bitmap if 'raid_bitmap' is set.
+
+    PartitionSetupError is raised if the disks are too small."""
+    assert(preset in PRESETS)
+    disks = inventory.disks
+    if not disks:
+        raise PartitionSetupError()
+
+    #
+    # RAID members are aligned on the chunk size of the arrays
+    # (raid1 has no chunk), so the stripes of the arrays are aligned
+    # too.
+    #
+    level, chunk, data_disks = None, 0, 1
+    if len(disks) > 1:
+        level, data_disks = _plan_raid_level(disks)
+        if level != 'raid1':
+            chunk = RAID_CHUNK_SIZES[preset]
+    align = alignment.plan(disks, chunk, data_disks)
+
+    swap_is_mandatory = False # FIXME: should be given by the preset
+
+    for with_swap in (True, False):
+        try:
+            planner = _Planner(inventory, preset, align, with_swap)
+            break
+        except PartitionSetupError:
+            if with_swap and not swap_is_mandatory:
+                continue
+            raise
+
+    if level:
+        for part, setup in planner.partitions:
+            #
+            # The write-intent bitmap avoids a full resync after a
+            # crash, it's useless for swap.
+            #
+            bitmap = 'none'
+            if raid_bitmap and not part.is_swap:
+                bitmap = 'internal'
+
+            if part == partition.boot:
+                setup.set_raid_level('raid1', '1.0')
+                setup.set_raid_geometry(0, 1, bitmap)
+            else:
+                setup.set_raid_level(level)
+                setup.set_raid_geometry(chunk, data_disks, bitmap)
+
+    return Layout(preset, disks, align, planner.partitions, not with_swap)
+
+
+def plan_all(inventories, preset='small', raid_bitmap=True):
+    """Plan the layouts of many inventories. Returns a list of dicts
+    holding either the layout or the error of each inventory."""
+    results = []
+    for inventory in inventories:
+        result = {}
+        if inventory.id is not None:
+            result['id'] = inventory.id
+        try:
+            result['layout'] = plan(inventory, preset, raid_bitmap).to_dict()
+        except PartitionSetupError:
+            result['error'] = "disk(s) too small for a %s server setup" % preset
+        results.append(result)
+    return results
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Quick throughput probe of the candidate disks. Each disk is read
+# sequentially with O_DIRECT (so the page cache doesn't hide the disk
+# speed) for at most PROBE_SIZE bytes or PROBE_TIMEOUT seconds, and a
+# few small reads spread over the disk give its access latency.
+#
+# Disks are probed in parallel and the results are cached per disk
+# serial number: a disk is probed only once per session even if it's
+# reported again by udev.
+#
+from __future__ import unicode_literals
+
+import io
+import os
+import mmap
+import time
+import logging
+import threading
+
+from . import device
+
+
+logger = logging.getLogger(__name__)
+
+
+PROBE_SIZE    = 64 * 1024 * 1024
+PROBE_BLOCK   = 1024 * 1024
+PROBE_TIMEOUT = 1.0
+# Number of small reads used to measure the latency.
+PROBE_SEEKS   = 8
+PROBE_SEEK_BLOCK = 4096
+# Maximum number of disks probed at the same time.
+PROBE_WORKERS = 8
+
+
+class ProbeResult(object):
+
+    __slots__ = ('throughput', 'latency')
+
+    def __init__(self, throughput, latency):
+        self.throughput = throughput    # bytes/s
+        self.latency = latency          # seconds
+
+    def __str__(self):
+        return "%.1f MB/s, %.2f ms" % (self.throughput / 1000000.0,
+                                       self.latency * 1000)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _cache_key(bdev):
+    # Devices without a serial (virtual disks...) are identified by
+    # their sysfs path.
+    return bdev.serial or bdev.syspath
+
+
+def _probe_device(devpath, size):
+    # O_DIRECT requires aligned buffers: anonymous mappings are page
+    # aligned.
+    buf = mmap.mmap(-1, PROBE_BLOCK)
+    seek_buf = mmap.mmap(-1, PROBE_SEEK_BLOCK)
+    fd = os.open(devpath, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+    try:
+        f = io.FileIO(fd, 'rb', closefd=False)
+
+        # Sequential reads.
+        length = min(size, PROBE_SIZE) // PROBE_BLOCK * PROBE_BLOCK
+        count = 0
+        start = time.time()
+        deadline = start + PROBE_TIMEOUT
+        while count < length and time.time() < deadline:
+            n = f.readinto(buf)
+            if not n:
+                break
+            count += n
+        elapsed = time.time() - start
+
+        # Spread small reads over the whole disk.
+        step = size // PROBE_SEEKS // PROBE_SEEK_BLOCK * PROBE_SEEK_BLOCK
+        latencies = []
+        for i in range(PROBE_SEEKS):
+            os.lseek(fd, (PROBE_SEEKS - 1 - i) * step, os.SEEK_SET)
+            t = time.time()
+            f.readinto(seek_buf)
+            latencies.append(time.time() - t)
+        latencies.sort()
+    finally:
+        os.close(fd)
+        buf.close()
+        seek_buf.close()
+
+    if not count or elapsed <= 0:
+        return None
+    return ProbeResult(count / elapsed, latencies[len(latencies) // 2])
+
+
+def _worker(queue, lock):
+    while True:
+        with lock:
+            if not queue:
+                return
+            bdev = queue.pop()
+        try:
+            result = _probe_device(bdev.devpath, bdev.size)
+        except (IOError, OSError) as e:
+            logger.debug("failed to probe %s: %s", bdev.devpath, e)
+            result = None
+        if result:
+            logger.debug("%s: %s", bdev.devpath, result)
+        with _cache_lock:
+            _cache[_cache_key(bdev)] = result
+
+
+def probe(bdevs):
+    """Measure the disks which haven't been probed yet. It blocks
+    until all of them are done, which takes roughly PROBE_TIMEOUT per
+    batch of PROBE_WORKERS disks."""
+    with _cache_lock:
+        queue = [b for b in bdevs if _cache_key(b) not in _cache]
+    if not queue:
+        return
+
+    lock = threading.Lock()
+    threads = []
+    for i in range(min(PROBE_WORKERS, len(queue))):
+        th = threading.Thread(target=_worker, args=(queue, lock),
+                              name="disk-probe-%d" % i)
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    for th in threads:
+        th.join()
+
+    # The candidates are ordered according to the results.
+    device.invalidate()
+
+
+def get_result(bdev):
+    """Returns the cached result of the probe of 'bdev' or None if
+    the disk hasn't been (successfully) probed."""
+    with _cache_lock:
+        return _cache.get(_cache_key(bdev))
@@ -82,23 +82,32 @@ def check_output(*args, **kwargs):
 # 'args' is list of arguments to be passed to Popen(shell=False) (ie
 # execvp())
 #
-_current = None
+# Several processes can be monitored at the same time by different
+# threads.
+#
+_current = set()
+_current_lock = threading.Lock()
+
 def get_current():
-    return _current
+    """Returns the list of the processes currently monitored"""
+    with _current_lock:
+        return list(_current)
 
 
 def monitor_kill(sig=signal.SIGTERM, logger=None):
-    if get_current():
-        # current is the process group leader
-        pid = get_current().pid
+    for p in get_current():
+        # each process is a process group leader
+        pid = p.pid
         if logger:
             logger.debug("killing spawned process group %d" % pid)
-        os.killpg(pid, sig)
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            # the process has just exited.
+            pass
 
 
 def _monitor(args, logger=None, stdout_handler=None, stderr_handler=None):
-    global _current
-
     if logger:
         logger.debug("running: %s", " ".join(args))
 
@@ -129,28 +138,27 @@ def _monitor(args, logger=None, stdout_handler=None, stderr_handler=None):
     #
     p = subprocess.Popen(args, env=env, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
-    _current = p
-    stdout_worker.connect(p.stdout)
-    stderr_worker.connect(p.stderr)
-
-    retcode = p.wait()
-    stdout_worker.join()
-    stderr_worker.join()
-    _current = None
+    with _current_lock:
+        _current.add(p)
+    try:
+        stdout_worker.connect(p.stdout)
+        stderr_worker.connect(p.stderr)
+
+        retcode = p.wait()
+        stdout_worker.join()
+        stderr_worker.join()
+    finally:
+        with _current_lock:
+            _current.discard(p)
+        if p.returncode is None:
+            p.terminate()
+
     if retcode:
         raise CalledProcessError(retcode, " ".join(args))
 
 
 def monitor(args, logger=None, stdout_handler=None, stderr_handler=None):
-    global _current
-    assert(not _current)
-
-    try:
-        _monitor(args, logger, stdout_handler, stderr_handler)
-    finally:
-        if _current:
-            _current.terminate()
-            _current = None
+    _monitor(args, logger, stdout_handler, stderr_handler)
 
 #
 # Same as above but execute the command in a chrooted/container
@@ -114,8 +114,22 @@ class End(StepSection):
         self._action = a
 
 
+class Disk(StepSection):
+    # Measure the throughput of the disks before selecting them
+    # automatically.
+    probe = False
+    # Format with lazy initialization and a single upfront discard,
+    # see the mkfs module.
+    fast_format = False
+    # Create the RAID arrays with an internal write-intent bitmap.
+    raid_bitmap = True
+
+
 class Installation(StepSection):
     repositories = []
+    # Maximum resync speed (KiB/s) of the MD arrays while installing
+    # the packages, 0 for no limit.
+    resync_speed_limit = 10000
     _pkgfiles = []
 
     @property
@@ -175,6 +189,16 @@ class Localization(StepSection):
 #
 # Other sections.
 #
+
+#
+# Partitions can be installed from prebuilt filesystem images instead
+# of packages: one entry per mount point ('/', '/boot'...) giving the
+# path of its image. See the image module.
+#
+class Images(Section):
+    pass
+
+
 class Kernel(Section):
     cmdline  = 'rw quiet'
 
@@ -219,8 +243,10 @@ class _Settings(object):
 
     def __init__(self):
         self._sections = {
+            'Disk'             : Disk(),
             'End'              : End(),
             'Localization'     : Localization(),
+            'Images'           : Images(),
             'Installation'     : Installation(),
             'Kernel'           : Kernel(),
             'License'          : License(),
@@ -4,7 +4,8 @@ from __future__ import unicode_literals
 
 import os
 import logging
-from threading import current_thread, Thread, RLock
+from threading import current_thread, Thread, RLock, Event
+from installer import device
 from installer import distro
 from installer import l10n
 from installer.utils import Signal, rsync
@@ -82,6 +83,9 @@ class Step(object):
         self._skip = not settings.get('Steps', self.view_class_name)
         self._root = None
         self._thread = None
+        # Set when the step is cancelled, for the work that can't be
+        # simply killed (waiting for udev...).
+        self._cancelled = Event()
         self.requires = set(self.requires)
         self.provides = set(self.provides)
         self._completion = 0
@@ -133,15 +137,16 @@ class Step(object):
     def __process(self, *args):
         self.logger.debug('starting step')
 
-        #
-        # Mount rootfs only if the step needs it. Also mount it in the
-        # case the step is going to initialize it.
-        #
-        if 'rootfs' in self.requires or 'rootfs' in self.provides:
-            self._root = mount_rootfs()
-            assert(self._root)
-
         try:
+            self._prepare(*args)
+            #
+            # Mount rootfs only if the step needs it. Also mount it in
+            # the case the step is going to initialize it.
+            #
+            if 'rootfs' in self.requires or 'rootfs' in self.provides:
+                self._root = mount_rootfs()
+                assert(self._root)
+
             self._process(*args)
         except (StepError, SettingsError) as e:
             self.logger.error(e)
@@ -166,6 +171,7 @@ class Step(object):
 
     def process_async(self, *args):
         assert(not self.is_in_progress())
+        self._cancelled.clear()
         self._thread = Thread(target=self.__process, args=args)
         self._state = _STATE_IN_PROGRESS
         self._thread.start()
@@ -190,10 +196,16 @@ class Step(object):
 
             self.logger.info(_('aborting step...'))
             self._state = _STATE_CANCELLED
+            self._cancelled.set()
+            device.wake_waiters()
             monitor_kill(logger=self.logger)
             self._thread.join()
             self.logger.info(_('step aborted.'))
 
+    def _prepare(self):
+        """Work done asynchronously before the rootfs is mounted"""
+        pass
+
     def _process(self):
         """Implement the actual work executed asynchronously"""
         raise NotImplementedError()
@@ -2,170 +2,60 @@
 #
 from __future__ import unicode_literals
 
-from time import sleep
+import os
+import time
 import logging
+from functools import partial
 
-from installer import device, partition, disk
-from installer.system import distribution, get_meminfo
+from installer import device, partition, disk, wipe, mkfs, planner, image
+from installer.system import distribution
+from installer.parttable import PartitionTable, PartitionTableError
 from installer.process import monitor
-from installer.settings import settings
-from installer.utils import MiB, GiB
-from . import Step
+from installer.settings import settings, absolute_path
+from installer.tasks import TaskGraph
+from installer.utils import KiB, pretty_size
+from . import Step, StepError
 
 
-DEFAULT_FILESYSTEM = "ext4"
-ROOT_DEFAULT_SIZE = 16 * GiB
-ROOT_MIN_SIZE = 300 * MiB
-HOME_MIN_SIZE = 20 * GiB
-VAR_MIN_SIZE  = 20 * GiB
-SWAP_MIN_SIZE = 100 * MiB
+# Max time to wait for udev to report a device change.
+UEVENT_TIMEOUT = 60
 
+# Max number of disk operations run concurrently.
+DISK_JOBS = 8
 
-logger = logging.getLogger(__name__)
 
+logger = logging.getLogger(__name__)
 
-# Based on: https://access.redhat.com/site/documentation/en-US/Red_Hat_Enterprise_Linux/6/html/Installation_Guide/s2-diskpartrecommend-x86.html
-def calculate_swap_size(memsize, hibernation=False):
-    if memsize <= 2*GiB:
-        factor = 2 if not hibernation else 3
-        size   = factor * memsize
-    elif memsize <= 8*GiB:
-        factor = 1 if not hibernation else 2
-        size   = memsize
-    elif memsize < 64*GiB:
-        factor = 0.5 if not hibernation else 1.5
-        size   = factor * memsize
-    else:
-        size = 4*GiB
 
-    return size
+def image_path(name):
+    """Returns the path of the image to install on the partition
+    mounted on 'name', given by the 'Images' section, or None"""
+    path = settings.get('Images', name)
+    if path and not os.path.isabs(path):
+        path = absolute_path(path)
+    return path
 
 
 class DiskSetup(object):
+    """Apply the layout planned for 'disks' to the partitions"""
 
     def __init__(self, disks, preset='small'):
-        self._scheme = None
         self._disks  = disks
         self.preset = preset
 
-        swap_is_mandatory = False # FIXME: should be given by the preset
-
-        for with_swap in (True, False):
-            try:
-                self._create_partition_setup(with_swap)
-                break
-            except partition.PartitionSetupError:
-                if with_swap and not swap_is_mandatory:
-                    logger.warn(_("small disk(s), trying with no swap"))
-                    continue
-                raise
-
-        if self.RAID:
-            for p in self._partitions:
-                if p == partition.boot:
-                    p.setup.set_raid_level('raid1', '1.0')
-                else:
-                    if len(disks) == 2:
-                        level = 'raid1'
-                    elif len(disks) == 3:
-                        # level 5 nécessite impérativement un minimum de trois disques durs
-                        # at least 2 raid-devices needed for level 4 or 5
-                        level = 'raid5'
-                    elif len(disks) > 3:
-                        # at least 4 raid-devices needed for level 6
-                        # no more than 256 raid-devices supported for level 6
-                        level = 'raid6'
-                    p.setup.set_raid_level(level)
-
-    def _create_partition_setup(self, with_swap):
-        self._partitions = []
-
-        total = self.disks[0].size
-        for d in self.disks[1:]:
-            total = min(total, d.size)
-        free = total
+        inventory = planner.Inventory.from_system(disks)
+        layout = planner.plan(inventory, preset, settings.Disk.raid_bitmap)
+        if layout.swap_dropped:
+            logger.warn(_("small disk(s), trying with no swap"))
 
+        self.alignment = layout.alignment
         for part in partition.partitions:
             part.setup = partition.PartitionSetup()
-
-        free = self._create_boot_partition(free)
-        if with_swap:
-            free = self._create_swap_partition(free, total)
-        free = self._create_root_partition(free)
-        free = self._create_data_partition(free)
-
-    def _create_boot_partition(self, free):
-        if self.RAID or "uefi" in settings.Options.firmware:
-            if free < 1 * GiB:
-                size = 34 * MiB
-            elif free < 16 * GiB:
-                size = 64 * MiB
-            elif free < 32 * GiB:
-                size = 128 * MiB
-            elif free < 128 * GiB:
-                size = 256 * MiB
-            else:
-                size = 512 * MiB
-
-            if "uefi" in settings.Options.firmware:
-                partition.boot.setup.fs = 'vfat'
-            else:
-                partition.boot.setup.fs = DEFAULT_FILESYSTEM
-
-            partition.boot.setup.size = size
-            self._partitions.append(partition.boot)
-            free -= size
-        return free
-
-    def _create_swap_partition(self, free, total):
-        if settings.Options.hostonly:
-            meminfo = get_meminfo()
-            memsize = meminfo['MemTotal']
-        else:
-            memsize = 2*GiB
-
-        size = min(calculate_swap_size(memsize), total * 10/100)
-        size = max(size, partition.swap.minsize)
-        if free < size:
-            raise partition.PartitionSetupError() # FIXME
-
-        partition.swap.setup.fs   = "swap"
-        partition.swap.setup.size = size
-        self._partitions.append(partition.swap)
-        return free - size
-
-    def _create_root_partition(self, free):
-        if free < partition.root.minsize:
-            raise partition.PartitionSetupError() # FIXME
-
-        if self.preset == 'small':
-            partition.root.setup.fs_hint_size = free # remaining of the free space
-            free = 0
-        elif free >= ROOT_DEFAULT_SIZE:
-            partition.root.setup.size = ROOT_DEFAULT_SIZE
-            free -= ROOT_DEFAULT_SIZE
-        else:
-            raise partition.PartitionSetupError() # FIXME
-
-        partition.root.setup.fs = DEFAULT_FILESYSTEM
-        self._partitions.append(partition.root)
-        return free
-
-    def _create_data_partition(self, free):
-        if self.preset in ('mail', 'web'):
-            if self.preset == 'mail':
-                part = partition.home
-            elif self.preset == 'web':
-                part = partition.var
-
-            if free < part.minsize:
-                raise partition.PartitionSetupError() # FIXME
-
-            part.setup.fs = DEFAULT_FILESYSTEM
-            part.setup.fs_hint_size = free # remaining of the free space
-            self._partitions.append(part)
-            free = 0
-        return free
+        for part, setup in layout.partitions:
+            part.setup = setup
+            if not part.is_swap:
+                setup.image = image_path(part.name)
+        self._partitions = [part for part, setup in layout.partitions]
 
     @property
     def RAID(self):
@@ -191,79 +81,81 @@ class DiskStep(Step):
         logger = self.logger
         self._setup = None
         self._devices = []
+        self._assume_clean = set()
 
     @property
     def name(self):
         return _("Disk")
 
-    def _do_clean_disks(self):
-        """wipefs all disks and their direct siblings"""
-        self.logger.debug("cleaning disk(s)")
-        for d in self._setup.disks:
-            #
-            # wipefs doens't clean signatures recursively, meaning
-            # signatures stored on partitions are still
-            # present. Therefore if we recreate an exact partition
-            # layout than the previous one, all already present
-            # signatures will be reused and udev will automatically
-            # create the device (RAID signature is an example).
-            #
-            for p in d.get_partitions():
-                self._monitor(['wipefs', '-a', p.devpath])
-            self._monitor(['wipefs', '-a', d.devpath])
-
-    def _do_partitioning_with_sgdisk(self, setup):
-        self.logger.debug("partitioning disk(s) with sgdisk")
-        cmd = ['sgdisk']
-
-        # For small disks (<256Mo) use 64 sectors
-        # alignment to avoid wasting too much space.
-        if setup.disks[0].size < 256 * MiB:
-            cmd += ['-a', '64']
-        else:
-            cmd += ['-a', '2048']
-
-        # start by clearing out all partition data again.
-        for d in setup.disks:
-            self._monitor(cmd + ['-o', d.devpath])
-        self.set_completion(20)
+    def _do_clean_disk(self, d):
+        """Erase the signatures of a disk and of its partitions"""
+        self.logger.debug("cleaning disk %s", d.devpath)
+        #
+        # Signatures stored on partitions must be cleared too: if we
+        # recreate an exact partition layout than the previous one,
+        # all already present signatures would be reused and udev
+        # would automatically create the device (RAID signature is an
+        # example). The partitions still described by the partition
+        # table are scanned as well.
+        #
+        parts = [(p.start, p.size) for p in d.get_partitions()]
+        try:
+            erased = wipe.wipe(d.devpath, parts, d.sector_size)
+        except (IOError, OSError) as e:
+            raise StepError(_("failed to clean %s: %s") % (d.devpath, e))
+        for sig in erased:
+            self.logger.debug("%s: erased %s signature", d.devpath, sig)
+
+    def _do_partitioning(self, d, setup):
+        self.logger.debug("partitioning disk %s", d.devpath)
+
+        # Partitions are aligned according to the disk topology.
+        align = setup.alignment
+        grain = align.grain // d.sector_size
+        offset = align.offset(d) // d.sector_size
 
-        for p in setup.partitions:
-            #
-            # - A partnum value of 0 causes the program to use the
-            #   first available partition number. This feature is only
-            #   available since gdisk 0.8.10.
-            #
-            # - A start value of 0 specifies the default value, which
-            #   is the start of the largest available.
-            #
-            args  = ['--new=0:0:+%dK' % (p.setup.size / 1024)]
-            args += ['--change-name=0:%s' % p.label]
-            args += ['--typecode=0:%s' % p.typecode(uuid=True)]
-            for d in setup.disks:
-                self._monitor(cmd + args + [d.devpath])
-        self.set_completion(50)
+        #
+        # Writing the table makes the kernel re-read it, hence
+        # recreate the partition devices. Remember the current ones so
+        # we don't mistake them for the new ones. Devices compare equal
+        # if they have the same syspath, which is the case of the new
+        # partitions, so the objects are tracked instead.
+        #
+        stale = d.get_partitions()
+        stale_ids = set(id(p) for p in stale)
 
         #
-        # Now that the partitions have been created, the associated
-        # devices should be known by udev. Make sure we registered
-        # these new devices.
+        # The whole layout is built in memory and replaces the
+        # current partition table in one go.
         #
-        self._monitor(["udevadm", "settle"])
-        for d in setup.disks:
-            while len(d.get_partitions()) < len(setup.partitions):
-                sleep(0.5)
-        self.set_completion(55)
+        table = PartitionTable(d.size, 'gpt', d.sector_size, grain,
+                               alignment_offset=offset)
+        try:
+            for p in setup.partitions:
+                table.add(p.setup.size, p.typecode(uuid=True), p.label)
+            table.write(d.devpath)
+        except (PartitionTableError, IOError, OSError) as e:
+            raise StepError(_("failed to partition %s: %s") % (d.devpath, e))
+
+        #
+        # Now that the partitions have been created, wait for udev to
+        # report the associated devices.
+        #
+        def partitions_ready():
+            parts = d.get_partitions()
+            if len(parts) != len(setup.partitions):
+                return False
+            return not any(id(p) in stale_ids for p in parts)
+
+        self._wait_for(partitions_ready, "partitions of %s" % d.devpath)
 
         #
         # RAID case is handled later.
         #
         if not setup.RAID:
-            self._devices = setup.disks[0].get_partitions()
-
-    def _do_partitioning(self):
-        self._do_partitioning_with_sgdisk(self._setup)
+            self._devices = d.get_partitions()
 
+    def _do_check_disks(self):
         #
         # A disk could have had a 'hidden' partition layout (the user
         # riped it out manually with wipefs). In that case we didn't
@@ -282,73 +174,146 @@ class DiskStep(Step):
             except disk.DiskRaidBusyError as e:
                     self._monitor(["mdadm", "--stop", e.md.devpath])
                     # wait the md device is gone
-                    while e.md in device.leaf_block_devices():
-                        sleep(0.1)
-
-    def _do_soft_raid(self):
-        if not self._setup.RAID:
-            return
-
+                    self._wait_for(lambda: e.md not in device.leaf_block_devices(),
+                                   "%s to stop" % e.md.devpath)
+
+    def _zero_members(self, level, members):
+        """Returns True if the initial resync of the array can be
+        skipped"""
+        clear = mkfs.zeroing_method(level, members)
+        if not clear:
+            return False
+        try:
+            for m in members:
+                clear(m)
+        except (IOError, OSError) as e:
+            self.logger.debug("failed to zero %s: %s", m.devpath, e)
+            return False
+        return True
+
+    def _do_soft_raid(self, i, p):
         disks = self._setup.disks
-        md_devnames = []
-
-        for i, p in enumerate(self._setup.partitions):
-            md = p.label
-            md_devnames.append(md)
-
-            args = ['--force', '--run']
-            level, metadata = p.setup.raid_level
-            if metadata:
-                args += ['--metadata=%s' % metadata]
-            args += ['--level=%s' % level]
-            args += ['--raid-devices=%d' % len(disks)]
-
-            # component devices:
-            args += [ d.get_partitions()[i].devpath for d in disks]
-
-            self._monitor(['mdadm', '--create', md] + args)
-            self._monitor(["udevadm", "settle", "-E", "/dev/md/" + md])
-
-        # Retrieve the MD devices we have just created.
-        for md in md_devnames:
-            bdev = None
-            while not bdev:
-                for bdev in device.leaf_block_devices():
-                    if type(bdev) == device.MetadiskDevice:
-                        if bdev.md_devname == md:
-                            break
-                else:
-                    sleep(0.5) # executed if no break
-                    bdev = None
-            self._devices.append(bdev)
-
-    def _do_mkfs(self):
-        for bdev, part in zip(self._devices, self._setup.partitions):
-            fs = part.setup.fs
-            if not fs:
-                continue
-            if fs == 'swap':
-                self._monitor(['mkswap', bdev.devpath])
-            else:
-                opts = []
-                if fs == 'vfat':
-                    # Needed when the partition is actually a MD device.
-                    opts = ['-I']
-                if fs.startswith('ext'):
-                    opts = ['-q']
-                self._monitor(['mkfs', '-t', fs] + opts + [bdev.devpath])
-            # make sure GUdev catch up
-            while not bdev.filesystem:
-                sleep(0.1)
+        md = p.label
+
+        args = ['--force', '--run']
+        level, metadata = p.setup.raid_level
+        if metadata:
+            args += ['--metadata=%s' % metadata]
+        args += ['--level=%s' % level]
+        args += ['--raid-devices=%d' % len(disks)]
+        chunk, data_disks, bitmap = p.setup.raid_geometry
+        if chunk:
+            args += ['--chunk=%dK' % (chunk // KiB)]
+        if bitmap:
+            args += ['--bitmap=%s' % bitmap]
+
+        members = [d.get_partitions()[i] for d in disks]
+        if self._zero_members(level, members):
+            args += ['--assume-clean']
+            self._assume_clean.add(i)
+
+        # component devices:
+        args += [m.devpath for m in members]
+
+        self._monitor(['mdadm', '--create', md] + args)
+
+        # Retrieve the MD device we have just created.
+        def find_md():
+            for bdev in device.leaf_block_devices():
+                if type(bdev) == device.MetadiskDevice:
+                    if bdev.md_devname == md:
+                        return bdev
+        self._devices[i] = self._wait_for(find_md, "/dev/md/" + md)
+
+    def _do_mkfs(self, i, part):
+        bdev = self._devices[i]
+        fs = part.setup.fs
+        stripe = None
+        if part.setup.raid_geometry and part.setup.raid_geometry[0]:
+            stripe = part.setup.raid_geometry[:2]
+        plan = mkfs.plan(bdev, fs, fast=settings.Disk.fast_format, stripe=stripe,
+                         assume_clean=i in self._assume_clean)
+
+        start = time.time()
+        if plan.discard:
+            try:
+                mkfs.discard(bdev)
+            except (IOError, OSError) as e:
+                # mkfs will still work, only slower.
+                self.logger.debug("failed to discard %s: %s", bdev.devpath, e)
+        self._monitor(plan.command)
+        self.logger.debug("%s: %s created in %.1fs", bdev.devpath, fs,
+                          time.time() - start)
+        if plan.deferred:
+            self.logger.info("%s: %s", bdev.devpath,
+                             mkfs.describe_savings(bdev, plan.deferred))
+
+        # make sure GUdev catch up
+        self._wait_for(lambda: bdev.filesystem == fs,
+                       "%s filesystem on %s" % (fs, bdev.devpath))
+
+    def _do_image(self, i, part):
+        bdev = self._devices[i]
+        start = time.time()
+        try:
+            bmap = image.install(part.setup.image, bdev, timeout=UEVENT_TIMEOUT,
+                                 cancel=self._cancelled,
+                                 assume_clean=i in self._assume_clean)
+        except (IOError, OSError, image.ImageError) as e:
+            raise StepError(_("failed to write image: %s") % e)
+        self.logger.debug("%s: %s of %s written in %.1fs", bdev.devpath,
+                          pretty_size(bmap.mapped), pretty_size(bmap.size),
+                          time.time() - start)
+
+    def _wait_for(self, predicate, what):
+        result = device.wait_for(predicate, UEVENT_TIMEOUT, self._cancelled)
+        if self._cancelled.is_set():
+            raise StepError(_("cancelled while waiting for %s") % what)
+        if not result:
+            raise StepError(_("timeout while waiting for %s") % what)
+        return result
 
     def _process(self):
-        self._do_clean_disks()
-        self.set_completion(10)
-        self._do_partitioning()
-        self.set_completion(60)
-        self._do_soft_raid()
-        self.set_completion(70)
-        self._do_mkfs()
+        device.wait_enumeration()
+        setup = self._setup
+        self._devices = [None] * len(setup.partitions)
+        self._assume_clean = set()
+
+        #
+        # The disks are wiped and partitioned concurrently, then the
+        # arrays are created and formatted as soon as their component
+        # devices are ready.
+        #
+        graph = TaskGraph(DISK_JOBS)
+
+        partitioned = []
+        for d in setup.disks:
+            wiped = graph.add("wipe " + d.devpath,
+                              partial(self._do_clean_disk, d))
+            partitioned.append(graph.add("partition " + d.devpath,
+                               partial(self._do_partitioning, d, setup),
+                               [wiped], weight=2))
+
+        checked = graph.add("check disks", self._do_check_disks, partitioned)
+
+        for i, part in enumerate(setup.partitions):
+            ready = checked
+            if setup.RAID:
+                ready = graph.add("create " + part.label,
+                                  partial(self._do_soft_raid, i, part),
+                                  [checked], weight=2)
+            #
+            # A partition installed from an image isn't formatted,
+            # the image overwrites it anyway.
+            #
+            if part.setup.image:
+                graph.add("image " + part.label, partial(self._do_image, i, part),
+                          [ready], weight=3)
+            elif part.setup.fs:
+                graph.add("mkfs " + part.label, partial(self._do_mkfs, i, part),
+                          [ready], weight=3)
+
+        graph.run(lambda done: self.set_completion(5 + int(done * 90)))
 
         for bdev, part in zip(self._devices, self._setup.partitions):
             part.device = bdev
@@ -6,16 +6,22 @@ from __future__ import print_function
 import os
 import re
 import glob
+import time
 
 from installer import disk
 from installer import l10n
+from installer import image
 from installer import distro
-from installer.utils import sed
+from installer import mdstat
+from installer.utils import sed, pretty_size
 from installer.partition import partitions
 from installer.device import MetadiskDevice
+from installer.parttable import PartitionTable, PartitionTableError, \
+    BOOTCODE_SIZE, GPT_ATTR_LEGACY_BOOTABLE
 from installer.system import distribution, is_efi
 from installer.settings import settings, SettingsError
 from . import Step, StepError
+from .disk import UEVENT_TIMEOUT, image_path
 
 
 class FStabEntry(object):
@@ -83,6 +89,7 @@ class _InstallStep(Step):
     def __init__(self):
         Step.__init__(self)
         self._fstab = {}
+        self._images = []
         self._extra_packages = []
         # Do sanity checkings early on the packages file list but
         # don't store the result to allow the user to do late
@@ -103,6 +110,59 @@ class _InstallStep(Step):
     def _do_rootfs(self):
         raise NotImplementedError()
 
+    def _find_images(self):
+        """Returns the (partition, image path) of the partitions to
+        install from an image, given by the 'Images' section"""
+        images = []
+        for part in partitions:
+            path = image_path(part.name)
+            if not path:
+                continue
+            if part.is_swap or not part.device:
+                raise StepError(_("no partition to install %s on") % path)
+            images.append((part, path))
+        return images
+
+    def _do_write_images(self):
+        #
+        # The disk step writes the images instead of creating the
+        # filesystems, only the partitions set up by other means are
+        # left.
+        #
+        images = [(part, path) for part, path in self._images
+                  if not (part.setup and part.setup.image == path)]
+        total = sum(os.path.getsize(path) for part, path in images)
+        done = 0
+
+        for part, path in images:
+            bdev = part.device
+            self.logger.info("writing image %s to %s", path, bdev.devpath)
+
+            size = os.path.getsize(path)
+            def progress(written, mapped, done=done, size=size):
+                # Each image weighs its size in the completion.
+                done += size * written // mapped
+                self.set_completion(1 + 49 * done // total)
+
+            start = time.time()
+            bmap = image.install(path, bdev, progress, UEVENT_TIMEOUT, self._cancelled)
+            self.logger.debug("%s: %s of %s written in %.1fs", bdev.devpath,
+                              pretty_size(bmap.mapped), pretty_size(bmap.size),
+                              time.time() - start)
+            done += size
+
+    def _do_grow_images(self):
+        for part, path in self._images:
+            bdev = part.device
+            mountpoint = self._root + part.name
+            cmd = image.grow_command(bdev.filesystem, bdev.devpath, mountpoint)
+            if not cmd:
+                self.logger.warning(_("can't grow %s filesystem on %s"),
+                                    bdev.filesystem, bdev.devpath)
+                continue
+            self.logger.info("growing filesystem on %s", bdev.devpath)
+            self._monitor(cmd)
+
     def _do_i18n(self):
         l10n.init_timezones(distro.paths['timezones'], self._root)
         l10n.init_keymaps(distro.paths['keymaps'], self._root)
@@ -252,16 +312,46 @@ class _InstallStep(Step):
     def _do_extra_packages(self):
         raise NotImplementedError()
 
-    def _process(self):
+    def _prepare(self):
         self.set_completion(1)
 
-        self._do_rootfs(settings.Installation.packages)
-        self._do_i18n()
-        self._do_fstab()
-        self._do_mdadm()
-        self._do_bootloader()
-        self._do_extra_packages()
-        self._do_initramfs()
+        #
+        # Images are written before the partitions are mounted, they
+        # replace any filesystem already created on them.
+        #
+        self._images = self._find_images()
+        try:
+            self._do_write_images()
+        except (IOError, OSError, image.ImageError) as e:
+            raise StepError(_("failed to write image: %s") % e)
+
+    def _process(self):
+
+        #
+        # The arrays created by the disk step are probably still being
+        # synchronized: leave most of the bandwidth to the package
+        # installation and report the progress meanwhile.
+        #
+        self._resync_progress = {}
+        with mdstat.throttle_resync(settings.Installation.resync_speed_limit), \
+             mdstat.ResyncMonitor(self._on_resync):
+            self._do_grow_images()
+            if not settings.get('Images', '/'):
+                self._do_rootfs(settings.Installation.packages)
+            self._do_i18n()
+            self._do_fstab()
+            self._do_mdadm()
+            self._do_bootloader()
+            self._do_extra_packages()
+            self._do_initramfs()
+
+    def _on_resync(self, arrays):
+        # Report each array every 10% only.
+        for md in arrays:
+            step = int((md.progress or 0) * 10)
+            if self._resync_progress.get(md.name) != step:
+                self._resync_progress[md.name] = step
+                self.logger.info("%s", md)
 
     #
     # Some generic helpers
@@ -286,27 +376,33 @@ class _InstallStep(Step):
         else:
             partnums = [bootable.partnum]
 
+        with open(self._root + bootcode, 'rb') as f:
+            bootcode = f.read(BOOTCODE_SIZE)
+
         for i, parent in enumerate(disk.get_candidates(bootable)):
-            # install mbr
+            #
+            # Install the bootcode in the MBR and flag the boot
+            # partition with a single update of the partition table.
+            #
             self.logger.debug("installing bootcode in %s MBR", parent.devpath)
-            cmd  = "dd bs=440 conv=notrunc count=1 if={0} of={1} 2>/dev/null"
-            self._chroot(['sh', '-c', cmd.format(bootcode, parent.devpath)],
-                         bind_mounts=['/dev'])
-
-            if gpt:
-                #
-                # make sure the attribute legacy BIOS bootable (bit 2)
-                # is set for the /boot partition for GPT. It's
-                # required by syslinux on BIOS system.
-                #
-                self._chroot(['sgdisk', parent.devpath,
-                              '--attributes=%d:set:2' % partnums[i]],
-                             bind_mounts=['/dev'])
-            else:
-                # on MBR, we need to mark the boot partition active.
-                self._chroot(['sfdisk' '--activate=%d' % partnums[i],
-                              parent.devpath],
-                             bind_mounts=['/dev'])
+            try:
+                table = PartitionTable.read(parent.devpath, parent.sector_size)
+                table.set_bootcode(bootcode)
+                if gpt:
+                    #
+                    # make sure the attribute legacy BIOS bootable
+                    # (bit 2) is set for the /boot partition for
+                    # GPT. It's required by syslinux on BIOS system.
+                    #
+                    table.set_attribute(partnums[i], GPT_ATTR_LEGACY_BOOTABLE)
+                else:
+                    # on MBR, we need to mark the boot partition active.
+                    table.set_active(partnums[i])
+                # The layout is unchanged, the partitions are in use.
+                table.write(parent.devpath, reread=False)
+            except (PartitionTableError, IOError, OSError) as e:
+                raise StepError(_("failed to install bootcode on %s: %s") %
+                                (parent.devpath, e))
 
     def _do_bootloader_on_bios_with_grub(self, bootable, grub="grub"):
         self._chroot([grub + '-mkconfig', '-o', '/boot/' + grub + '/grub.cfg'])
@@ -373,11 +469,11 @@ initrd      /{initrd}
         self._do_bootloader_on_efi_with_gummiboot()
 
     def _do_bootloader_on_mbr(self, bootable):
-        self._pacstrap(['syslinux', 'util-linux'], 80)
+        self._pacstrap(['syslinux'], 80)
         self._do_bootloader_on_bios_with_syslinux(bootable, gpt=False)
 
     def _do_bootloader_on_gpt(self, bootable):
-        self._pacstrap(['syslinux', 'gptfdisk'], 80)
+        self._pacstrap(['syslinux'], 80)
         self._do_bootloader_on_bios_with_syslinux(bootable, gpt=True)
 
     def _do_bootloader_finish(self):
@@ -426,11 +522,11 @@ class MandrivaInstallStep(_InstallStep):
         self._do_bootloader_on_efi_with_gummiboot()
 
     def _do_bootloader_on_gpt(self, bootable):
-        self._urpmi(['syslinux', 'extlinux', 'gdisk'], 70)
+        self._urpmi(['syslinux', 'extlinux'], 70)
         self._do_bootloader_on_bios_with_syslinux(bootable, gpt=True)
 
     def _do_bootloader_on_mbr(self, bootable):
-        self._urpmi(['syslinux', 'extlinux', 'util-linux'], 70)
+        self._urpmi(['syslinux', 'extlinux'], 70)
         self._do_bootloader_on_bios_with_syslinux(bootable, gpt=False)
 
     def _do_bootloader_finish(self):
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# A synthetic device backend standing in for GUdev.Client. It builds
+# fake disks, partitions, loop, RAM and MD devices out of a declarative
+# description so the device layer can be exercised (and profiled) at
+# scale without the real hardware:
+#
+#   backend = SyntheticBackend({
+#       'disks': [{'count': 500, 'bus': 'ata', 'size': 4*TiB,
+#                  'rotational': True, 'partitions': 3}],
+#       'loop':  8,
+#       'ram':   16,
+#       'md':    [{'level': 'raid1', 'members': ['sda1', 'sdb1']}],
+#   })
+#   device.set_backend(backend)
+#
+# Uevents are replayed synchronously by the caller's thread with
+# backend.emit() or backend.replay(), the latter reporting them as a
+# single batch like a real uevent storm.
+#
+from __future__ import unicode_literals
+
+import string
+import uuid
+from collections import OrderedDict
+
+from .utils import GiB
+
+
+SYSFS_ROOT = '/sys/devices/synthetic'
+
+# Block majors used by the sd driver, extra disks use the extended
+# (blkext) major like the kernel does.
+_SD_MAJORS = [8] + list(range(65, 72)) + list(range(128, 136))
+_BLKEXT_MAJOR = 259
+
+
+def _sd_name(index):
+    """0 -> 'sda', 25 -> 'sdz', 26 -> 'sdaa'..."""
+    letters = ''
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = string.ascii_lowercase[rem] + letters
+    return 'sd' + letters
+
+
+class SyntheticDevice(object):
+    """Implement the GUdev.Device getters used by the device module"""
+
+    def __init__(self, name, devtype, major, minor, syspath,
+                 properties=None, attributes=None):
+        self.name = name
+        self.devtype = devtype
+        self.syspath = syspath
+        self.properties = OrderedDict([('MAJOR', str(major)),
+                                       ('MINOR', str(minor)),
+                                       ('DEVNAME', '/dev/' + name),
+                                       ('DEVTYPE', devtype),
+                                       ('SUBSYSTEM', 'block')])
+        if properties:
+            self.properties.update(properties)
+        self.attributes = {'ro': '0'}
+        if attributes:
+            self.attributes.update(attributes)
+
+    def copy(self, properties=None, attributes=None):
+        dev = SyntheticDevice(self.name, self.devtype,
+                              self.properties['MAJOR'],
+                              self.properties['MINOR'], self.syspath,
+                              self.properties, self.attributes)
+        if properties:
+            dev.properties.update(properties)
+        if attributes:
+            dev.attributes.update(attributes)
+        return dev
+
+    def get_sysfs_path(self):
+        return self.syspath
+
+    def get_device_file(self):
+        return '/dev/' + self.name
+
+    def get_devtype(self):
+        return self.devtype
+
+    def get_name(self):
+        return self.name
+
+    def get_property_keys(self):
+        return list(self.properties.keys())
+
+    def get_property(self, key):
+        return self.properties.get(key)
+
+    def get_property_as_int(self, key):
+        try:
+            return int(self.properties.get(key, 0))
+        except ValueError:
+            return 0
+
+    def get_property_as_boolean(self, key):
+        return self.properties.get(key, '').lower() in ('1', 'true')
+
+    def get_sysfs_attr(self, attr):
+        return self.attributes.get(attr)
+
+
+class SyntheticClient(object):
+    """The object returned to the device module, it shares the device
+    set of its backend."""
+
+    batch_uevents = True
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def connect(self, signal, callback):
+        assert(signal in ('uevent', 'uevents'))
+        self._backend._callbacks.append((self, signal, callback))
+
+    def query_by_subsystem(self, subsystem):
+        assert(subsystem == 'block')
+        return list(self._backend.devices.values())
+
+
+class SyntheticBackend(object):
+
+    def __init__(self, description=None):
+        self._callbacks = []
+        self._sd_count = 0
+        self._blkext_minor = 0
+        self.devices = OrderedDict()   # present devices, by name
+        self.removed = {}              # removed devices, by name
+        if description:
+            self.build(description)
+
+    def __call__(self):
+        return SyntheticClient(self)
+
+    #
+    # Device builders
+    #
+    def _add(self, dev):
+        self.devices[dev.name] = dev
+        return dev
+
+    def _next_sd_devnum(self):
+        index = self._sd_count
+        self._sd_count += 1
+        if index < len(_SD_MAJORS) * 16:
+            major, minor = _SD_MAJORS[index // 16], (index % 16) * 16
+            return index, major, minor, 15
+        self._blkext_minor += 1
+        return index, _BLKEXT_MAJOR, self._blkext_minor, 0
+
+    def _next_blkext_minor(self):
+        self._blkext_minor += 1
+        return self._blkext_minor
+
+    def add_disk(self, bus='ata', model=None, size=500 * GiB,
+                 rotational=True, removable=False, partitions=0,
+                 scheme='gpt', fs=None):
+        index, major, minor, nr_minors = self._next_sd_devnum()
+        name = _sd_name(index)
+        serial = 'SYNTH%08d' % index
+        model = model or 'Synthetic_%s_Disk' % bus.upper()
+        syspath = '%s/host%d/block/%s' % (SYSFS_ROOT, index, name)
+
+        props = {'ID_BUS': bus,
+                 'ID_MODEL': model,
+                 'ID_SERIAL': '%s_%s' % (model, serial),
+                 'ID_SERIAL_SHORT': serial,
+                 'DEVLINKS': '/dev/disk/by-id/%s-%s_%s' % (bus, model, serial)}
+        if partitions:
+            props['ID_PART_TABLE_TYPE'] = scheme
+        attrs = {'size': str(size // 512),
+                 'removable': '1' if removable else '0',
+                 'queue/rotational': '1' if rotational else '0',
+                 'queue/nr_requests': '1023' if bus == 'nvme' else '64',
+                 'queue/logical_block_size': '512',
+                 'queue/physical_block_size': '512' if rotational else '4096',
+                 'queue/minimum_io_size': '512' if rotational else '4096',
+                 'queue/optimal_io_size': '0',
+                 'queue/discard_max_bytes': '0' if rotational else '2147450880',
+                 'queue/discard_zeroes_data': '0',
+                 'queue/write_zeroes_max_bytes': '131072' if bus == 'nvme' else '0',
+                 'alignment_offset': '0'}
+        disk = self._add(SyntheticDevice(name, 'disk', major, minor, syspath,
+                                         props, attrs))
+
+        if partitions:
+            partsize = size // partitions // 512
+            for num in range(1, partitions + 1):
+                if num <= nr_minors:
+                    pmajor, pminor = major, minor + num
+                else:
+                    pmajor, pminor = _BLKEXT_MAJOR, self._next_blkext_minor()
+                self.add_partition(disk, num, pmajor, pminor, partsize, scheme, fs)
+        return disk
+
+    def add_partition(self, disk, num, major, minor, sectors, scheme='gpt', fs=None):
+        name = disk.name + str(num)
+        props = {'ID_PART_ENTRY_NUMBER': str(num),
+                 'ID_PART_ENTRY_SCHEME': scheme,
+                 'ID_PART_ENTRY_UUID': str(uuid.uuid4()),
+                 'ID_PART_ENTRY_NAME': 'part%d' % num,
+                 'DEVLINKS': '/dev/disk/by-partlabel/part%d' % num}
+        if fs:
+            props['ID_FS_TYPE'] = fs
+            props['ID_FS_UUID'] = str(uuid.uuid4())
+        attrs = {'size': str(sectors), 'start': str(2048 + (num - 1) * sectors)}
+        return self._add(SyntheticDevice(name, 'partition', major, minor,
+                                         disk.syspath + '/' + name, props, attrs))
+
+    def add_loop(self, index, backing_file=None, size=1 * GiB):
+        attrs = {'size': str(size // 512)}
+        if backing_file:
+            attrs['loop/backing_file'] = backing_file
+        return self._add(SyntheticDevice('loop%d' % index, 'disk', 7, index,
+                                         '%s/virtual/block/loop%d' % (SYSFS_ROOT, index),
+                                         attributes=attrs))
+
+    def add_ram(self, index, size=64 * 1024 * 1024):
+        return self._add(SyntheticDevice('ram%d' % index, 'disk', 1, index,
+                                         '%s/virtual/block/ram%d' % (SYSFS_ROOT, index),
+                                         attributes={'size': str(size // 512)}))
+
+    def add_md(self, index, level, members, metadata='1.2', name=None):
+        name = name or 'md%d' % index
+        props = {'MD_LEVEL': level,
+                 'MD_DEVICES': str(len(members)),
+                 'MD_METADATA': metadata,
+                 'MD_DEVNAME': name}
+        for member in members:
+            props['MD_DEVICE_%s_DEV' % member] = '/dev/' + member
+            props['MD_DEVICE_%s_ROLE' % member] = str(members.index(member))
+
+        size = min(int(self.devices[m].attributes['size']) for m in members)
+        return self._add(SyntheticDevice('md%d' % index, 'disk', 9, index,
+                                         '%s/virtual/block/md%d' % (SYSFS_ROOT, index),
+                                         props, {'size': str(size)}))
+
+    def build(self, description):
+        """Create the devices listed by the declarative 'description'"""
+        for spec in description.get('disks', []):
+            spec = dict(spec)
+            for i in range(spec.pop('count', 1)):
+                self.add_disk(**spec)
+
+        for i in range(description.get('loop', 0)):
+            self.add_loop(i, backing_file='/var/tmp/loop%d.img' % i)
+
+        for i in range(description.get('ram', 0)):
+            self.add_ram(i)
+
+        for i, spec in enumerate(description.get('md', [])):
+            self.add_md(127 - i, spec['level'], spec['members'],
+                        spec.get('metadata', '1.2'), spec.get('name'))
+
+    #
+    # Uevents
+    #
+    def _apply(self, action, name, properties=None, attributes=None):
+        if action == 'add':
+            dev = self.removed.pop(name, None) or self.devices[name]
+            self.devices[name] = dev
+        elif action == 'remove':
+            dev = self.devices.pop(name)
+            self.removed[name] = dev
+        elif action == 'change':
+            dev = self.devices[name].copy(properties, attributes)
+            self.devices[name] = dev
+        else:
+            raise ValueError("unknown uevent action '%s'" % action)
+        return dev
+
+    def _deliver(self, uevents):
+        for client, signal, callback in self._callbacks:
+            if signal == 'uevents':
+                callback(client, uevents)
+            else:
+                for action, dev in uevents:
+                    callback(client, action, dev)
+
+    def emit(self, action, name, properties=None, attributes=None):
+        """Report a uevent for device 'name' to the connected clients.
+        'change' events can update the device properties/attributes."""
+        dev = self._apply(action, name, properties, attributes)
+        self._deliver([(action, dev)])
+
+    def replay(self, events, batch=True):
+        """Replay a sequence of (action, name[, properties[, attributes]]).
+        The events are reported as a single batch unless 'batch' is
+        false."""
+        uevents = []
+        for event in events:
+            uevents.append((event[0], self._apply(*event)))
+        if batch:
+            self._deliver(uevents)
+        else:
+            for uevent in uevents:
+                self._deliver([uevent])
+        return len(uevents)
+
+    #
+    # Helpers generating usual uevent storms
+    #
+    def repartition_storm(self, disks=None):
+        """Events emitted when the partition tables of 'disks' are
+        re-read: partitions are removed, the disk changes and the
+        partitions are added back."""
+        if disks is None:
+            disks = [d for d in self.devices.values()
+                     if d.devtype == 'disk' and d.name.startswith('sd')]
+        for disk in disks:
+            parts = [p for p in self.devices.values()
+                     if p.devtype == 'partition' and
+                     p.syspath.startswith(disk.syspath + '/')]
+            for p in parts:
+                yield ('remove', p.name)
+            yield ('change', disk.name)
+            for p in parts:
+                yield ('add', p.name)
+
+    def mkfs_storm(self, fs='ext4'):
+        """'change' events emitted after formatting all partitions"""
+        for dev in list(self.devices.values()):
+            if dev.devtype == 'partition':
+                yield ('change', dev.name, {'ID_FS_TYPE': fs,
+                                            'ID_FS_UUID': str(uuid.uuid4())})
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# A device backend reading the block devices straight from sysfs and
+# from the udev database, so GLib/GObject aren't needed. It exposes
+# the same subset of the GUdev API as the other backends, see
+# device.set_backend():
+#
+#  - the kernel part of a device (MAJOR, MINOR, DEVNAME, DEVTYPE...)
+#    is read from /sys/class/block/<name>/uevent,
+#
+#  - the properties added by udev (ID_*, MD_*...) are read from
+#    /run/udev/data/b<major>:<minor>, each line being prefixed by a
+#    type: 'E:' for properties, 'S:' for the device symlinks.
+#
+# Uevents are received through the udev netlink socket, they already
+# carry all the device properties. They're delivered in batches when
+# connecting to the 'uevents' signal.
+#
+from __future__ import unicode_literals
+
+import os
+
+from .uevent import NetlinkMonitor, BATCH_WINDOW
+
+
+SYSFS_CLASS_BLOCK = '/sys/class/block'
+UDEV_DATA_DIR = '/run/udev/data'
+
+
+def _read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return None
+
+
+def _read_uevent(syspath):
+    props = {}
+    content = _read_file(os.path.join(syspath, 'uevent')) or ''
+    for line in content.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            props[key] = value
+    return props
+
+
+def _read_udev_db(major, minor, props):
+    content = _read_file(os.path.join(UDEV_DATA_DIR, 'b%s:%s' % (major, minor)))
+    if not content:
+        return
+    links = []
+    for line in content.splitlines():
+        if line.startswith('E:'):
+            key, sep, value = line[2:].partition('=')
+            if sep:
+                props[key] = value
+        elif line.startswith('S:'):
+            links.append('/dev/' + line[2:])
+    if links:
+        props['DEVLINKS'] = ' '.join(links)
+
+
+class SysfsDevice(object):
+    """Compact record describing a block device. It implements the
+    GUdev.Device getters used by the device module."""
+
+    __slots__ = ('_syspath', '_props')
+
+    def __init__(self, syspath, properties=None):
+        self._syspath = syspath
+        if properties is None:
+            properties = _read_uevent(syspath)
+            if 'MAJOR' in properties:
+                _read_udev_db(properties['MAJOR'], properties['MINOR'], properties)
+
+        # The kernel uses names relative to /dev.
+        devname = properties.get('DEVNAME')
+        if devname and not devname.startswith('/'):
+            properties['DEVNAME'] = '/dev/' + devname
+        self._props = properties
+
+    def get_sysfs_path(self):
+        return self._syspath
+
+    def get_device_file(self):
+        return self._props.get('DEVNAME')
+
+    def get_devtype(self):
+        return self._props.get('DEVTYPE')
+
+    def get_name(self):
+        return os.path.basename(self._syspath)
+
+    def get_property_keys(self):
+        return list(self._props.keys())
+
+    def get_property(self, key):
+        return self._props.get(key)
+
+    def get_property_as_int(self, key):
+        try:
+            return int(self._props.get(key, 0))
+        except ValueError:
+            return 0
+
+    def get_property_as_boolean(self, key):
+        return self._props.get(key, '').lower() in ('1', 'true')
+
+    def get_sysfs_attr(self, attr):
+        return _read_file(os.path.join(self._syspath, attr))
+
+
+class SysfsClient(object):
+    """Backend factory to pass to device.set_backend()"""
+
+    # Uevents are collected by the netlink monitor and can be
+    # delivered by batches through the 'uevents' signal.
+    batch_uevents = True
+
+    def __init__(self):
+        self._monitor = None
+
+    def connect(self, signal, callback):
+        assert(signal in ('uevent', 'uevents'))
+        assert(not self._monitor)
+
+        def device(props):
+            return SysfsDevice('/sys' + props['DEVPATH'], props)
+
+        if signal == 'uevents':
+            def on_uevents(batch):
+                callback(self, [(p['ACTION'], device(p)) for p in batch])
+            self._monitor = NetlinkMonitor(on_uevents, subsystem='block',
+                                           window=BATCH_WINDOW)
+        else:
+            def on_uevent(props):
+                callback(self, props['ACTION'], device(props))
+            self._monitor = NetlinkMonitor(on_uevent, subsystem='block')
+
+        self._monitor.start()
+
+    def query_by_subsystem(self, subsystem):
+        assert(subsystem == 'block')
+        syspaths = []
+        for name in os.listdir(SYSFS_CLASS_BLOCK):
+            syspaths.append(os.path.realpath(os.path.join(SYSFS_CLASS_BLOCK, name)))
+        # Report the devices in the same order as libudev.
+        return [SysfsDevice(syspath) for syspath in sorted(syspaths)]
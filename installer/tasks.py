@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Run a set of tasks as a dependency graph: a task is started as soon
+# as all the tasks it depends on are done, so independent tasks (the
+# partitioning of different disks for example) run concurrently.
+#
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Task(object):
+
+    def __init__(self, name, func, deps, weight):
+        self.name = name
+        self.func = func
+        self.deps = set(deps)
+        self.weight = weight
+
+
+class TaskGraph(object):
+
+    def __init__(self, max_jobs=8):
+        self._max_jobs = max_jobs
+        self._tasks = OrderedDict()
+
+    def add(self, name, func, deps=(), weight=1):
+        """Add a task calling 'func' once the tasks named in 'deps' are
+        done. Dependencies must have been added before, so the graph
+        can't have cycles. 'weight' is the share of the task in the
+        progress reported by run(). Returns the task name."""
+        assert(name not in self._tasks)
+        for dep in deps:
+            assert(dep in self._tasks)
+        self._tasks[name] = _Task(name, func, deps, weight)
+        return name
+
+    def run(self, progress=None):
+        """Execute the tasks, at most 'max_jobs' at the same time, and
+        call 'progress' with the completed fraction of the work each
+        time a task is done. It's called by the thread running the
+        graph only.
+
+        If a task fails, no more tasks are started and the exception
+        of the first failure is raised once the running ones are
+        finished."""
+        cond = threading.Condition()
+        pending = list(self._tasks.values())
+        running = set()
+        done = set()
+        errors = []
+        total = sum(t.weight for t in pending) or 1
+
+        def execute(task):
+            try:
+                task.func()
+            except Exception as e:
+                logger.debug("task '%s' failed: %s", task.name, e)
+                with cond:
+                    errors.append(e)
+            with cond:
+                running.remove(task.name)
+                done.add(task.name)
+                cond.notify()
+
+        while True:
+            completed = None
+            with cond:
+                for task in list(pending):
+                    if errors or len(running) >= self._max_jobs:
+                        break
+                    if task.deps.issubset(done):
+                        pending.remove(task)
+                        running.add(task.name)
+                        th = threading.Thread(target=execute, args=(task,),
+                                              name="task-%s" % task.name)
+                        th.daemon = True
+                        th.start()
+
+                if not running:
+                    break
+                cond.wait()
+
+                if progress and not errors:
+                    completed = sum(self._tasks[n].weight for n in done)
+
+            # Don't block the tasks while the progress is reported.
+            if completed is not None:
+                progress(float(completed) / total)
+
+        if errors:
+            raise errors[0]
+        assert(not pending)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Listen to the uevents broadcast by udevd on the netlink socket, the
+# same way libudev's udev_monitor does it but without requiring any
+# bindings.
+#
+# udevd re-broadcasts the kernel uevents once it has processed them
+# (rules applied, udev database updated) to the 'udev' multicast
+# group. Each message starts with a small header followed by the
+# device properties stored as NUL terminated KEY=VALUE strings. See
+# src/libudev/libudev-monitor.c in the systemd sources.
+#
+from __future__ import unicode_literals
+
+import socket
+import struct
+import time
+import logging
+import threading
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# netlink multicast groups
+MONITOR_GROUP_KERNEL = 1
+MONITOR_GROUP_UDEV   = 2
+
+_UDEV_MONITOR_MAGIC = 0xfeedcafe
+_UDEV_HEADER = struct.Struct(str('=8sIIII'))   # prefix, magic, header_size,
+                                               # properties_off, properties_len
+_RCVBUF_SIZE = 16 * 1024 * 1024
+_MSG_SIZE = 8192
+
+#
+# Uevents are usually emitted in bursts (partitioning a disk, creating
+# an array...). They're collected during this window (in seconds) and
+# delivered as a single batch. A continuous flow of events is
+# delivered at least every BATCH_MAX_DELAY seconds.
+#
+BATCH_WINDOW = 0.05
+BATCH_MAX_DELAY = 0.5
+
+SO_PASSCRED = getattr(socket, 'SO_PASSCRED', 16)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+SCM_CREDENTIALS = getattr(socket, 'SCM_CREDENTIALS', 2)
+
+
+def parse_message(data):
+    """Returns the properties carried by a udev netlink message as a
+    dict or None if the message is not valid."""
+    if not data.startswith(b'libudev\0') or len(data) < _UDEV_HEADER.size:
+        return None
+
+    prefix, magic, header_size, off, length = _UDEV_HEADER.unpack_from(data)
+    if socket.ntohl(magic) != _UDEV_MONITOR_MAGIC:
+        return None
+    if off < header_size or off + length > len(data):
+        return None
+
+    props = {}
+    for field in data[off:off + length].split(b'\0'):
+        key, sep, value = field.partition(b'=')
+        if sep:
+            props[key.decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+
+    if 'ACTION' not in props or 'DEVPATH' not in props:
+        return None
+    return props
+
+
+class UeventBatcher(object):
+    """Collect items pushed by any threads and pass them in batches to
+    'callback' from a dedicated thread once no new item showed up for
+    'window' seconds."""
+
+    def __init__(self, callback, window=BATCH_WINDOW, max_delay=BATCH_MAX_DELAY):
+        self._callback = callback
+        self._window = window
+        self._max_delay = max_delay
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="uevent-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def _collect(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            start = last = time.time()
+            count = len(self._items)
+            while True:
+                now = time.time()
+                timeout = min(last + self._window, start + self._max_delay) - now
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+                if len(self._items) != count:
+                    count = len(self._items)
+                    last = time.time()
+            items = list(self._items)
+            self._items.clear()
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            try:
+                self._callback(items)
+            except:
+                logger.exception("uevent callback got an unexpected exception")
+
+
+class NetlinkMonitor(object):
+    """Receive the udev uevents of a given subsystem from a dedicated
+    thread. The uevents received within 'window' seconds are passed
+    as a list of property dicts to 'callback'. If 'window' is None,
+    each uevent is passed on its own."""
+
+    def __init__(self, callback, subsystem=None, window=None):
+        self._callback = callback
+        self._subsystem = subsystem
+        self._window = window
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        assert(not self._sock)
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_KOBJECT_UEVENT)
+        # Uevent storms shouldn't overflow the socket buffer.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, _RCVBUF_SIZE)
+        except socket.error:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RCVBUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, SO_PASSCRED, 1)
+        sock.bind((0, MONITOR_GROUP_UDEV))
+        self._sock = sock
+
+        self._thread = threading.Thread(target=self._run, name="uevent-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _receive(self, timeout=None):
+        self._sock.settimeout(timeout)
+
+        if not hasattr(self._sock, 'recvmsg'):
+            # python2.7: no way to check the sender credentials.
+            data, addr = self._sock.recvfrom(_MSG_SIZE)
+            return data if addr[0] else None
+
+        data, ancdata, flags, addr = self._sock.recvmsg(_MSG_SIZE,
+                                                        socket.CMSG_SPACE(12))
+        # Messages from the kernel (pid 0) have not been processed
+        # by udev and only root is allowed to send uevents.
+        if not addr[0]:
+            return None
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == SCM_CREDENTIALS:
+                pid, uid, gid = struct.unpack(str('iII'), cdata[:12])
+                if uid == 0:
+                    return data
+        return None
+
+    def _receive_uevent(self, timeout=None):
+        data = self._receive(timeout)
+        if not data:
+            return None
+        props = parse_message(data)
+        if not props:
+            return None
+        if self._subsystem and props.get('SUBSYSTEM') != self._subsystem:
+            return None
+        return props
+
+    def _receive_batch(self):
+        batch = []
+        while not batch:
+            props = self._receive_uevent()
+            if props:
+                batch.append(props)
+
+        start = last = time.time()
+        while True:
+            timeout = min(last + self._window, start + BATCH_MAX_DELAY) - time.time()
+            if timeout <= 0:
+                break
+            try:
+                props = self._receive_uevent(timeout)
+            except socket.timeout:
+                break
+            if props:
+                batch.append(props)
+                last = time.time()
+        return batch
+
+    def _run(self):
+        while self._sock:
+            try:
+                if self._window is None:
+                    item = self._receive_uevent()
+                else:
+                    item = self._receive_batch()
+            except (socket.error, AttributeError) as e:
+                if self._sock is None:
+                    break
+                logger.warning("failed to receive uevent: %s", e)
+                continue
+            if not item:
+                continue
+            try:
+                self._callback(item)
+            except:
+                logger.exception("uevent callback got an unexpected exception")
+
+    def stop(self):
+        sock, self._sock = self._sock, None
+        if sock:
+            sock.close()
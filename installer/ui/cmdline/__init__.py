@@ -2,14 +2,18 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import sys
+import json
 import time
 import logging
 import threading
-from gi.repository import GLib, GObject
 
 from .. import UI
 from .widgets import ProgressBar
 from installer import steps
+from installer import device
+from installer import disk
+from installer import planner
+from installer.sysfs import SysfsClient
 from installer.settings import settings
 from installer.system import get_terminal_size
 
@@ -28,12 +32,107 @@ def parse_cmdline(parser):
                        dest="progress",
                        action="store_false",
                        help="don't show progress during installation"),
+    group.add_argument("--preset",
+                       choices=planner.PRESETS,
+                       default='small',
+                       help="server setup used to partition the disk(s)"),
+    group.add_argument("--export-inventory",
+                       dest="export_inventory",
+                       metavar="FILE",
+                       help="write the inventory of the disk(s) in JSON and exit, "
+                       "'-' for stdout"),
+    group.add_argument("--plan",
+                       dest="plan",
+                       metavar="FILE",
+                       nargs="+",
+                       help="print the disk layouts planned for the inventories "
+                       "stored in FILE(s) and exit, '-' for stdin"),
     group.add_argument("disks",
                         metavar="disk",
                         nargs="*",
                         help="disk(s) to use for installation (cmdline frontend only)")
 
 
+def _open(path, mode='r'):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode)
+
+
+def _export_inventory(args):
+    device.set_backend(SysfsClient)
+    device.wait_enumeration()
+
+    #
+    # The disks are selected and validated like for an installation,
+    # so the inventory only holds disks the installer would accept.
+    #
+    candidates = [bdev for group in disk.get_candidates() for bdev in group]
+    if args.disks:
+        disks = [device.devpath_to_bdev(path) for path in args.disks]
+        for path, bdev in zip(args.disks, disks):
+            if not bdev or bdev.devtype != 'disk':
+                raise ViewError(_('%s is not a disk.') % path)
+            if bdev not in candidates:
+                raise ViewError(_('device is not valid for an installation'))
+        try:
+            disk.check_candidates(disks)
+        except disk.DiskError as e:
+            raise ViewError(e)
+    else:
+        disks = disk.select_candidates(candidates)
+        if not disks:
+            raise ViewError(_("no disk suitable for an installation"))
+
+    inventory = planner.Inventory.from_system(disks)
+    f = _open(args.export_inventory, 'w')
+    json.dump(inventory.to_dict(), f, indent=2, sort_keys=True)
+    f.write('\n')
+    if f is not sys.stdout:
+        f.close()
+
+
+def _plan(args):
+    inventories = []
+    for path in args.plan:
+        f = _open(path)
+        try:
+            inventories += planner.load_inventories(f)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    start = time.time()
+    results = planner.plan_all(inventories, args.preset,
+                               settings.Disk.raid_bitmap)
+    elapsed = time.time() - start
+
+    errors = 0
+    for result in results:
+        errors += 'error' in result
+        print(json.dumps(result, sort_keys=True))
+    print(_("%d inventories planned in %.2fs, %d failed") %
+          (len(results), elapsed, errors), file=sys.stderr)
+    return 1 if errors else 0
+
+
+def run_planner(args):
+    """Dry-run mode: export the local inventory and/or plan the
+    layouts of inventories without installing anything. Returns None
+    if no dry-run option was passed."""
+    if not (args.export_inventory or args.plan):
+        return None
+    try:
+        if args.export_inventory:
+            _export_inventory(args)
+        if args.plan:
+            return _plan(args)
+    except (IOError, OSError, ValueError, ViewError) as e:
+        print("%s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
 class ViewError(Exception):
     """Exception thrown by cmdline view"""
 
@@ -55,11 +154,18 @@ class CommandLineUI(UI):
     def __init__(self, args):
         # For now, no need to accept the license with the cmdline frontend.
         settings.Steps.License = False
+        #
+        # No need to pull GLib in: devices are read from sysfs and the
+        # udev database directly and uevents come from the udev netlink
+        # socket.
+        #
+        device.set_backend(SysfsClient)
         UI.__init__(self)
         self._retcode = 0
         self._args = args
         self._isatty = sys.stdout.isatty()
-        self._loop = GLib.MainLoop()
+        self._done = threading.Event()
+        self._progress_step = None
 
         if not self._isatty:
             self._args.progress = False
@@ -109,7 +215,7 @@ class CommandLineUI(UI):
 
             if self._args.progress:
                 self._progress_bar = ProgressBar(step.name)
-                timer = GLib.timeout_add_seconds(1, self._on_timeout, step)
+                self._progress_step = step
 
             view.run(self._args)
 
@@ -124,7 +230,7 @@ class CommandLineUI(UI):
         except ViewError as e:
             logger.critical("%s" % e)
         finally:
-            self._loop.quit()
+            self._done.set()
 
     def run(self):
         self._init_logging()
@@ -133,14 +239,14 @@ class CommandLineUI(UI):
             logger.error(_("You must provide one or more disk(s)."))
             return 1
 
-        # Since PyGObject 3.10.2, calling GObject.threads_init() is no
-        # longer needed.
-        GObject.threads_init()
-
         th = threading.Thread(target=self._run_steps)
         th.start()
         try:
-            self._loop.run()
+            # Refresh the progress bar every second until the steps
+            # are done.
+            while not self._done.wait(1):
+                if self._args.progress and self._progress_step:
+                    self._on_timeout(self._progress_step)
         except KeyboardInterrupt:
             logger.critical(_("Interrupt signal received, aborting..."))
 
@@ -167,9 +273,6 @@ class CommandLineUI(UI):
             self._progress_bar.width = get_terminal_size().columns
             self._progress_bar.show()
             self._progress_lock.release()
-            return True
-        # stop and destroy the timer
-        return False
 
 
 class StepView(object):
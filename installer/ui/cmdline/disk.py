@@ -15,7 +15,7 @@ class DiskView(StepView):
 
     def run(self, args):
         disks  = []
-        preset = 'small'
+        preset = args.preset
 
         #
         # This has been checked by the frontend previously.
@@ -27,6 +27,8 @@ class DiskView(StepView):
         # the user must pass valid disk(s). We might accept partition
         # devs too in the future.
         #
+        device.wait_enumeration()
+
         for path in args.disks:
             st = os.stat(path)
 
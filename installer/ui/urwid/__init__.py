@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 import os
 import sys
 import time
+import threading
 import collections
 import logging
 import urwid
@@ -102,11 +103,13 @@ class UrwidUI(UI):
         self._args = args
         self._uevent_handlers = []
         self._watch_pipe_fd = None
+        self._watch_pipe_lock = threading.Lock()
         self._watch_pipe_queue = collections.deque()
+        self._ui_thread = threading.current_thread()
         UI.__init__(self)
         urwid.set_encoding("utf8")
 
-        device.listen_uevent(self._on_uevent)
+        device.listen_uevent(self._on_uevents, batch=True)
 
         # Parse Urwid's specific options
         if args.colors:
@@ -154,7 +157,10 @@ class UrwidUI(UI):
             # make sure the pipe read side won't be closed.
             return True
 
-        self._watch_pipe_fd = self._loop.watch_pipe(watch_pipe_cb)
+        with self._watch_pipe_lock:
+            self._watch_pipe_fd = self._loop.watch_pipe(watch_pipe_cb)
+            if self._watch_pipe_queue:
+                os.write(self._watch_pipe_fd, b'ping')
 
     def suspend(self):
         raise NotImplementedError()
@@ -260,15 +266,26 @@ class UrwidUI(UI):
         return keys
 
     def register_uevent_handler(self, handler):
+        """'handler' is called with the list of (action, bdev) of
+        each batch of uevents"""
         self._uevent_handlers.append(handler)
 
     def __call(self, func):
-        if self._watch_pipe_fd:
-            self._watch_pipe_queue.appendleft(func)
-            os.write(self._watch_pipe_fd, b'ping')
-        else:
-            # Used only during initialisation.
-            func()
+        with self._watch_pipe_lock:
+            if self._watch_pipe_fd:
+                self._watch_pipe_queue.appendleft(func)
+                os.write(self._watch_pipe_fd, b'ping')
+                return
+            if threading.current_thread() is not self._ui_thread:
+                #
+                # Devices are enumerated by a background thread which
+                # can notify us before the UI is ready. Queue the
+                # call, it will be run once the watch pipe is created.
+                #
+                self._watch_pipe_queue.appendleft(func)
+                return
+        # Used only during initialisation.
+        func()
 
     def ui_thread(func):
         """This decorator is used to make sure that decorated
@@ -315,9 +332,9 @@ class UrwidUI(UI):
         self._echo_area.notify(lvl, record)
 
     @ui_thread
-    def _on_uevent(self, action, bdev):
+    def _on_uevents(self, events):
         for fn in self._uevent_handlers:
-            fn(action, bdev)
+            fn(events)
 
 
 class View(urwid.WidgetWrap):
@@ -54,7 +54,7 @@ class DiskTableWidget(urwid.WidgetWrap):
         self._prio = priority
         super(DiskTableWidget, self).__init__(widgets.NullWidget())
         self._create_disk_table()
-        ui.register_uevent_handler(self._on_uevent)
+        ui.register_uevent_handler(self._on_uevents)
 
     def __get_bus(self, bdev):
         return bdev.bus.capitalize() if bdev.bus else ''
@@ -114,15 +114,16 @@ class DiskTableWidget(urwid.WidgetWrap):
         selected = [d for d in self.get_selected() if d.priority >= self._prio]
         self._create_disk_table(selected, focus=self.get_focus())
 
-    def _on_uevent(self, action, bdev):
+    def _on_uevents(self, events):
         #
         # Display all disks known by the system. We'll check the
         # validity of the selected disks later. Note that 'change'
         # events might add new disks, loop devices is an example.
         #
         selected = self.get_selected()
-        if action == 'remove' and bdev in selected:
-            selected.remove(bdev)
+        for action, bdev in events:
+            if action == 'remove' and bdev in selected:
+                selected.remove(bdev)
 
         self._create_disk_table(selected, self.get_focus())
 
@@ -156,7 +156,7 @@ class InstallationView(StepView):
         urwid.connect_signal(self._devlist, 'focus_changed',
                              lambda dev: footer.set_text('%s' % dev))
 
-        ui.register_uevent_handler(self._on_uevent)
+        ui.register_uevent_handler(self._on_uevents)
 
     def _redraw(self):
         # When switching to the install view, devices can have been
@@ -217,10 +217,11 @@ class InstallationView(StepView):
         self.page = self._partition_page
         self._update_install_button()
 
-    def _on_uevent(self, action, bdev):
+    def _on_uevents(self, events):
         #
         # Note: we can enter this function when the current page is
-        # the progress one.
+        # the progress one. The pages are refreshed once per batch of
+        # uevents.
         #
         if self.page == self._devlist_page:
             #
@@ -235,7 +236,7 @@ class InstallationView(StepView):
             # displayed. For the other case, it will be refreshed by
             # _on_select_device().
             #
-            if action == "remove" or action == "change":
+            if any(action in ("remove", "change") for action, bdev in events):
                 self._partition_list_widget.refresh()
                 self._update_install_button()
 
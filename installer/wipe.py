@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Erase the signatures (partition tables, RAID superblocks, filesystem
+# magics) found on a disk, like 'wipefs -a' but for the whole disk at
+# once: the areas of the partitions currently known by the kernel and
+# of the ones still described by the on-disk partition table are
+# scanned too, so a previous layout can't be resurrected when the same
+# partitions are created again.
+#
+# Only the magic strings are cleared, which is enough for libblkid to
+# stop recognizing the signatures, and all of them are erased with one
+# pass of small writes followed by a single fsync.
+#
+from __future__ import unicode_literals
+
+import os
+import struct
+
+from .parttable import PartitionTable, PartitionTableError
+
+
+class Signature(object):
+
+    __slots__ = ('type', 'offset', 'magic')
+
+    def __init__(self, type, offset, magic):
+        self.type = type
+        self.offset = offset    # from the start of the disk
+        self.magic = magic
+
+    def __str__(self):
+        return "%s at 0x%x" % (self.type, self.offset)
+
+
+_MD_MAGIC = struct.pack(str('<I'), 0xa92b4efc)
+
+#
+# Magics located from the start of an area: (type, offset, magic).
+#
+_HEAD_MAGICS = (
+    ('dos',               0x1fe,   b'\x55\xaa'),
+    ('gpt',               0x200,   b'EFI PART'),
+    ('gpt',               0x1000,  b'EFI PART'),    # 4K sectors
+    ('linux_raid_member', 0x0,     _MD_MAGIC),      # 1.1
+    ('linux_raid_member', 0x1000,  _MD_MAGIC),      # 1.2
+    ('ext4',              0x438,   b'\x53\xef'),
+    ('xfs',               0x0,     b'XFSB'),
+    ('btrfs',             0x10040, b'_BHRfS_M'),
+    ('vfat',              0x36,    b'FAT12   '),
+    ('vfat',              0x36,    b'FAT16   '),
+    ('vfat',              0x52,    b'FAT32   '),
+    ('swap',              0xff6,   b'SWAPSPACE2'),
+    ('swap',              0xff6,   b'SWAP-SPACE'),
+    ('swap',              0xfff6,  b'SWAPSPACE2'),  # 64K pages
+)
+
+# Everything above is found in the first bytes of an area, read them
+# at once.
+_HEAD_SIZE = 0x10048
+
+# The signatures at the end of an area are within its last 128K.
+_TAIL_SIZE = 0x20000
+
+
+def _tail_magics(size):
+    """Magics located relatively to the end of an area of 'size'
+    bytes: (type, offset, magic)"""
+    return (
+        ('gpt',               size - 0x200,  b'EFI PART'),
+        ('gpt',               size - 0x1000, b'EFI PART'),
+        # md 0.90: last 64K aligned block
+        ('linux_raid_member', (size & ~0xffff) - 0x10000, _MD_MAGIC),
+        # md 1.0: between 8K and 12K from the end, 4K aligned
+        ('linux_raid_member', (size - 0x2000) & ~0xfff, _MD_MAGIC),
+    )
+
+
+def _pread(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _pwrite(fd, offset, data):
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _scan_area(fd, start, size, found):
+    head = _pread(fd, start, min(size, _HEAD_SIZE))
+    for type, offset, magic in _HEAD_MAGICS:
+        if head[offset:offset + len(magic)] == magic:
+            found.setdefault(start + offset, Signature(type, start + offset, magic))
+
+    tail_start = max(0, size - _TAIL_SIZE)
+    tail = _pread(fd, start + tail_start, size - tail_start)
+    for type, offset, magic in _tail_magics(size):
+        if offset < 0:
+            continue
+        offset -= tail_start
+        if offset >= 0 and tail[offset:offset + len(magic)] == magic:
+            offset += start + tail_start
+            found.setdefault(offset, Signature(type, offset, magic))
+
+
+def _areas(path, size, partitions, sector_size):
+    areas = set([(0, size)])
+    areas.update((start, length) for start, length in partitions
+                 if length > 0 and start + length <= size)
+    # Partitions still described by the on-disk table but not
+    # (anymore) known by the kernel.
+    try:
+        table = PartitionTable.read(path, sector_size)
+    except PartitionTableError:
+        return areas
+    for part in table.partitions:
+        start = part.start * table.sector_size
+        length = part.sectors * table.sector_size
+        if length > 0 and start + length <= size:
+            areas.add((start, length))
+    return areas
+
+
+def scan(path, partitions=(), sector_size=512):
+    """Returns the signatures found on the disk 'path' sorted by
+    offset. 'partitions' is a list of (start, size) in bytes of
+    additional areas to scan. 'sector_size' is the logical block size
+    of the disk, used to locate the partitions of the on-disk table."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        found = {}
+        for start, length in sorted(_areas(path, size, partitions, sector_size)):
+            _scan_area(fd, start, length, found)
+    finally:
+        os.close(fd)
+    return sorted(found.values(), key=lambda s: s.offset)
+
+
+def wipe(path, partitions=(), sector_size=512):
+    """Erase all the signatures found on the disk 'path' and returns
+    them, see scan()."""
+    signatures = scan(path, partitions, sector_size)
+    if not signatures:
+        return signatures
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for sig in signatures:
+            _pwrite(fd, sig.offset, b'\0' * len(sig.magic))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return signatures
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Tests of the lock statistics reports.
+#
+from __future__ import unicode_literals
+
+import io
+import unittest
+
+from installer.lockstat import InstrumentedRLock
+
+
+class ReportTest(unittest.TestCase):
+
+    def report(self, lock):
+        out = io.StringIO()
+        lock.report(out)
+        return out.getvalue()
+
+    def test_released(self):
+        lock = InstrumentedRLock('test')
+        with lock:
+            pass
+        report = self.report(lock)
+        self.assertIn("acquired 1 times, contended 0 times", report)
+        self.assertIn("hold: total", report)
+        self.assertNotIn("no samples", report)
+
+    def test_held(self):
+        lock = InstrumentedRLock('test')
+        with lock:
+            report = self.report(lock)
+        self.assertIn("acquired 1 times", report)
+        self.assertIn("no samples", report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Tests of the /proc/mdstat parser.
+#
+from __future__ import unicode_literals
+
+import unittest
+
+from installer import mdstat
+
+
+RESYNC = """\
+Personalities : [raid1] [raid6] [raid5] [raid4]
+md2 : active raid1 sdb3[1] sda3[0]
+      98436096 blocks super 1.2 [2/2] [UU]
+      [=====>...............]  resync = 27.4% (26971264/98436096) finish=6.5min speed=181234K/sec
+      bitmap: 1/1 pages [4KB], 65536KB chunk
+
+md0 : active (auto-read-only) raid1 sdb1[1] sda1[0]
+      262080 blocks super 1.0 [2/2] [UU]
+        resync=PENDING
+      bitmap: 1/1 pages [4KB], 65536KB chunk
+
+unused devices: <none>
+"""
+
+RECOVERY = """\
+Personalities : [raid1] [raid6] [raid5] [raid4]
+md1 : active raid5 sdc2[3] sdb2[1] sda2[0]
+      6157312 blocks super 1.2 level 5, 512k chunk, algorithm 2 [3/2] [UU_]
+      [===>.................]  recovery = 17.5% (539136/3078656) finish=0.7min speed=53913K/sec
+      bitmap: 0/1 pages [0KB], 65536KB chunk
+
+unused devices: <none>
+"""
+
+IDLE = """\
+Personalities : [raid1] [raid10]
+md127 : active raid10 sdd3[3] sdc3[2] sdb3[1] sda3[0]
+      196872192 blocks super 1.2 512K chunks 2 near-copies [4/4] [UUUU]
+      bitmap: 0/2 pages [0KB], 65536KB chunk
+
+md126 : inactive sde1[0](S)
+      262080 blocks super 1.0
+
+unused devices: <none>
+"""
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_resync(self):
+        arrays = mdstat.parse(RESYNC)
+        self.assertEqual(list(arrays), ['md2', 'md0'])
+
+        md = arrays['md2']
+        self.assertEqual((md.state, md.level, md.members),
+                         ('active', 'raid1', ['sdb3', 'sda3']))
+        self.assertTrue(md.is_syncing)
+        self.assertEqual(md.action, 'resync')
+        self.assertAlmostEqual(md.progress, 0.274)
+        self.assertAlmostEqual(md.finish, 390)
+        self.assertEqual(md.speed, 181234)
+
+        md = arrays['md0']
+        self.assertEqual((md.state, md.level), ('active', 'raid1'))
+        self.assertEqual((md.action, md.progress), ('resync', None))
+        self.assertEqual(str(md), "md0: resync pending")
+
+    def test_recovery(self):
+        md = mdstat.parse(RECOVERY)['md1']
+        self.assertEqual(md.level, 'raid5')
+        self.assertEqual(md.members, ['sdc2', 'sdb2', 'sda2'])
+        self.assertEqual(md.action, 'recovery')
+        self.assertAlmostEqual(md.progress, 0.175)
+        self.assertEqual(md.speed, 53913)
+
+    def test_idle(self):
+        arrays = mdstat.parse(IDLE)
+        self.assertEqual(list(arrays), ['md127', 'md126'])
+        self.assertFalse(any(md.is_syncing for md in arrays.values()))
+        self.assertEqual(str(arrays['md127']), "md127: active raid10")
+
+        # Inactive arrays have no level.
+        md = arrays['md126']
+        self.assertEqual((md.state, md.level, md.members),
+                         ('inactive', '', ['sde1']))
+
+    def test_empty(self):
+        self.assertEqual(mdstat.parse("Personalities : \nunused devices: <none>\n"), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
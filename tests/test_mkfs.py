@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Tests of the mkfs command lines and of the zeroing of new arrays.
+#
+from __future__ import unicode_literals
+
+import unittest
+
+from installer import mkfs, probe
+from installer.utils import MiB, GiB
+
+
+class FakeDisk(object):
+
+    def __init__(self, rotational=False, discard=True, discard_zeroes=False,
+                 write_zeroes=False, size=64 * GiB, device_class='ssd'):
+        self.devpath = '/dev/fake'
+        self.syspath = '/sys/block/fake'
+        self.serial = None
+        self.device_class = device_class
+        self.size = size
+        self.is_rotational = rotational
+        self.supports_discard = discard
+        self.discard_zeroes_data = discard_zeroes
+        self.supports_write_zeroes = write_zeroes
+
+    def get_root_parents(self):
+        return []
+
+
+class ZeroingTest(unittest.TestCase):
+
+    def test_parity_levels(self):
+        members = [FakeDisk(discard_zeroes=True) for i in range(3)]
+        self.assertEqual(mkfs.zeroing_method('raid5', members), None)
+        self.assertEqual(mkfs.zeroing_method('raid6', members), None)
+
+    def test_rotational(self):
+        members = [FakeDisk(discard_zeroes=True), FakeDisk(rotational=True)]
+        self.assertEqual(mkfs.zeroing_method('raid1', members), None)
+
+    def test_discard_zeroes_data(self):
+        members = [FakeDisk(discard_zeroes=True) for i in range(2)]
+        self.assertEqual(mkfs.zeroing_method('raid1', members), mkfs.discard)
+        self.assertEqual(mkfs.zeroing_method('raid10', members), mkfs.discard)
+
+    def test_write_zeroes(self):
+        # Discard alone doesn't guarantee zeroes.
+        members = [FakeDisk(discard_zeroes=True, write_zeroes=True),
+                   FakeDisk(write_zeroes=True)]
+        self.assertEqual(mkfs.zeroing_method('raid1', members), mkfs.zeroout)
+
+    def test_no_zeroing(self):
+        members = [FakeDisk(), FakeDisk(write_zeroes=True)]
+        self.assertEqual(mkfs.zeroing_method('raid1', members), None)
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_fast(self):
+        plan = mkfs.plan(FakeDisk(), 'ext4', fast=True)
+        self.assertTrue(plan.discard)
+        self.assertIn('nodiscard', plan.command[plan.command.index('-E') + 1])
+        self.assertTrue(plan.deferred > 0)
+
+    def test_assume_clean(self):
+        for fast in (False, True):
+            plan = mkfs.plan(FakeDisk(), 'ext4', fast=fast, assume_clean=True)
+            self.assertFalse(plan.discard)
+            self.assertIn('nodiscard', plan.command[plan.command.index('-E') + 1])
+
+            plan = mkfs.plan(FakeDisk(), 'xfs', fast=fast, assume_clean=True)
+            self.assertFalse(plan.discard)
+            self.assertIn('-K', plan.command)
+
+            plan = mkfs.plan(FakeDisk(), 'swap', fast=fast, assume_clean=True)
+            self.assertFalse(plan.discard)
+
+    def test_not_fast(self):
+        plan = mkfs.plan(FakeDisk(), 'ext4')
+        self.assertFalse(plan.discard)
+        self.assertEqual(plan.command, ['mkfs', '-t', 'ext4', '-q', '/dev/fake'])
+
+
+class SavingsTest(unittest.TestCase):
+
+    def tearDown(self):
+        probe._cache.clear()
+
+    def test_estimated(self):
+        seconds, measured = mkfs.estimate_savings(FakeDisk(device_class='hdd'), 1200 * MiB)
+        self.assertEqual((seconds, measured), (10, False))
+        self.assertIn("about 10.0s saved (estimated for hdd)",
+                      mkfs.describe_savings(FakeDisk(device_class='hdd'), 1200 * MiB))
+
+    def test_measured(self):
+        disk = FakeDisk()
+        probe._cache[disk.syspath] = probe.ProbeResult(100 * MiB, 0.1)
+        self.assertEqual(mkfs.estimate_savings(disk, 300 * MiB), (3, True))
+        self.assertTrue(mkfs.describe_savings(disk, 300 * MiB).endswith("about 3.0s saved"))
+
+
+if __name__ == '__main__':
+    unittest.main()
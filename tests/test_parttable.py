@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Round-trip tests of the parttable module on sparse image files.
+#
+from __future__ import unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from installer.parttable import PartitionTable, PartitionTableError, \
+    GPT_ATTR_LEGACY_BOOTABLE, _GPT_HEADER, _GPT_ENTRY, _GPT_ENTRIES
+
+
+LINUX_FS = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+LINUX_SWAP = '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f'
+MiB = 1024 * 1024
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class ImageTestCase(unittest.TestCase):
+
+    size = 256 * MiB
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'disk.img')
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pread(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def check_gpt_header(self, lba, sector_size, current, backup):
+        """Check the CRCs of the header at 'lba' and of its entries,
+        returns the unpacked header"""
+        sector = self.pread(lba * sector_size, sector_size)
+        fields = list(_GPT_HEADER.unpack_from(sector))
+        self.assertEqual(fields[0], b'EFI PART')
+        self.assertEqual(fields[5:7], [current, backup])
+
+        crc = fields[3]
+        fields[3] = 0
+        self.assertEqual(crc, _crc32(_GPT_HEADER.pack(*fields)))
+
+        entries_lba, count, entry_size, entries_crc = fields[10:14]
+        self.assertEqual((count, entry_size), (_GPT_ENTRIES, _GPT_ENTRY.size))
+        entries = self.pread(entries_lba * sector_size, count * entry_size)
+        self.assertEqual(entries_crc, _crc32(entries))
+        return fields
+
+
+class GPTTest(ImageTestCase):
+
+    def create(self, sector_size=512, alignment=2048, alignment_offset=0):
+        table = PartitionTable(self.size, 'gpt', sector_size, alignment,
+                               alignment_offset=alignment_offset)
+        table.add(32 * MiB, LINUX_FS, 'boot')
+        table.add(16 * MiB, LINUX_SWAP, 'swap')
+        table.add(0, LINUX_FS, 'root')
+        table.set_attribute(1, GPT_ATTR_LEGACY_BOOTABLE)
+        table.write(self.path)
+        return table
+
+    def assertSameTable(self, table, other):
+        self.assertEqual(other.scheme, 'gpt')
+        self.assertEqual(other.disk_uuid, table.disk_uuid)
+        self.assertEqual(len(other.partitions), len(table.partitions))
+        for part, read in zip(table.partitions, other.partitions):
+            self.assertEqual((read.num, read.start, read.end),
+                             (part.num, part.start, part.end))
+            self.assertEqual((read.typeuuid, read.uuid, read.name),
+                             (part.typeuuid, part.uuid, part.name))
+            self.assertEqual(read.attributes, part.attributes)
+
+    def test_round_trip(self):
+        table = self.create()
+        self.assertSameTable(table, PartitionTable.read(self.path))
+
+        parts = table.partitions
+        self.assertEqual(parts[0].start, 2048)
+        self.assertEqual(parts[0].sectors * 512, 32 * MiB)
+        self.assertEqual(parts[1].start, parts[0].end + 1)
+        self.assertEqual(parts[2].sectors % 2048, 0)
+        self.assertTrue(parts[2].end <= table.last_usable)
+
+    def test_protective_mbr(self):
+        self.create()
+        mbr = self.pread(0, 512)
+        self.assertEqual(mbr[510:512], b'\x55\xaa')
+        self.assertEqual(bytearray(mbr)[446 + 4], 0xee)
+
+    def test_backup(self):
+        table = self.create()
+        last = table.sectors - 1
+        primary = self.check_gpt_header(1, 512, 1, last)
+        backup = self.check_gpt_header(last, 512, last, 1)
+
+        # Same table, only the locations differ.
+        self.assertEqual(primary[7:10], backup[7:10])
+        self.assertEqual(primary[13], backup[13])
+        self.assertEqual(primary[10], 2)
+        self.assertEqual(backup[10], last - 32)
+        self.assertEqual(self.pread(2 * 512, 32 * 512),
+                         self.pread((last - 32) * 512, 32 * 512))
+
+    def test_alignment_offset(self):
+        table = self.create(alignment_offset=7)
+        self.assertEqual(table.partitions[0].start, 2048 + 7)
+        for part in table.partitions:
+            self.assertEqual((part.start - 7) % 2048, 0)
+        self.assertSameTable(table, PartitionTable.read(self.path))
+
+    def test_4k_sectors(self):
+        table = self.create(sector_size=4096, alignment=256)
+        last = table.sectors - 1
+        self.assertEqual(table.partitions[0].start, 256)
+        self.assertEqual(table.partitions[0].sectors * 4096, 32 * MiB)
+
+        # 128 entries fit in 4 sectors.
+        fields = self.check_gpt_header(1, 4096, 1, last)
+        self.assertEqual(fields[7], 6)
+        self.check_gpt_header(last, 4096, last, 1)
+
+        self.assertSameTable(table, PartitionTable.read(self.path, 4096))
+        # Not found with the wrong sector size.
+        self.assertEqual(PartitionTable.read(self.path, 512).scheme, 'dos')
+
+    def test_too_big(self):
+        table = PartitionTable(self.size)
+        self.assertRaises(PartitionTableError, table.add, 2 * self.size, LINUX_FS)
+
+
+class MBRTest(ImageTestCase):
+
+    def test_round_trip(self):
+        table = PartitionTable(self.size, 'dos')
+        table.add(32 * MiB, typecode='8300')
+        table.add(16 * MiB, typecode='8200')
+        table.add(0, typecode='8302')
+        table.set_active(1)
+        table.set_bootcode(b'\xeb' * 500)
+        table.write(self.path)
+
+        read = PartitionTable.read(self.path)
+        self.assertEqual(read.scheme, 'dos')
+        self.assertEqual(read.disk_uuid, table.disk_uuid)
+        self.assertEqual(read.bootcode, b'\xeb' * 440)
+        self.assertEqual([(p.start, p.end) for p in read.partitions],
+                         [(p.start, p.end) for p in table.partitions])
+        self.assertEqual([p.mbr_type for p in read.partitions], [0x83, 0x82, 0x83])
+        self.assertEqual([p.active for p in read.partitions], [True, False, False])
+
+    def test_only_first_sector(self):
+        with open(self.path, 'r+b') as f:
+            f.seek(self.size - 512)
+            f.write(b'\xff' * 512)
+        table = PartitionTable(self.size, 'dos')
+        table.add(0)
+        self.assertEqual([offset for offset, data in table.build()], [0])
+        table.write(self.path)
+        self.assertEqual(self.pread(self.size - 512, 512), b'\xff' * 512)
+
+    def test_typecodes(self):
+        table = PartitionTable(self.size, 'dos')
+        self.assertEqual(table.add(MiB, typecode='EF00').mbr_type, 0xef)
+        self.assertEqual(table.add(MiB, typecode='fd00').mbr_type, 0xfd)
+        # Not of the 'XX00' form.
+        self.assertRaises(PartitionTableError, table.add, MiB, typecode='ef02')
+
+    def test_primary_limit(self):
+        table = PartitionTable(self.size, 'dos')
+        for i in range(4):
+            table.add(MiB)
+        self.assertRaises(PartitionTableError, table.add, MiB)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# Tests of the signature scan and wipe on sparse image files.
+#
+from __future__ import unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from installer import wipe
+from installer.parttable import PartitionTable
+
+
+LINUX_FS = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+MiB = 1024 * 1024
+MD_MAGIC = struct.pack(str('<I'), 0xa92b4efc)
+
+
+class WipeTest(unittest.TestCase):
+
+    size = 64 * MiB
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'disk.img')
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pwrite(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def pread(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def signatures(self, *args):
+        return [(s.type, s.offset) for s in wipe.scan(self.path, *args)]
+
+    def write_table(self, sector_size=512):
+        table = PartitionTable(self.size, 'gpt', sector_size, MiB // sector_size)
+        table.add(16 * MiB, LINUX_FS)
+        table.add(0, LINUX_FS)
+        table.write(self.path)
+        return [(p.start * sector_size, p.sectors * sector_size)
+                for p in table.partitions]
+
+    def test_empty(self):
+        self.assertEqual(self.signatures(), [])
+        self.assertEqual(wipe.wipe(self.path), [])
+
+    def test_disk_head(self):
+        self.pwrite(0, b'XFSB')
+        self.pwrite(0x438, b'\x53\xef')
+        self.assertEqual(self.signatures(), [('xfs', 0), ('ext4', 0x438)])
+
+    def test_partitions(self):
+        # Not described by any table, only found if passed.
+        self.pwrite(MiB + 0x438, b'\x53\xef')
+        self.assertEqual(self.signatures(), [])
+        self.assertEqual(self.signatures([(MiB, 16 * MiB)]),
+                         [('ext4', MiB + 0x438)])
+        # Areas beyond the disk are ignored.
+        self.assertEqual(self.signatures([(self.size - MiB, 2 * MiB)]), [])
+
+    def test_on_disk_table(self):
+        parts = self.write_table()
+        start, length = parts[1]
+        self.pwrite(start + 0x1000, MD_MAGIC)
+        # md 1.0 superblock of the first partition.
+        md10 = parts[0][0] + ((parts[0][1] - 0x2000) & ~0xfff)
+        self.pwrite(md10, MD_MAGIC)
+
+        self.assertEqual(self.signatures(), [
+            ('dos', 0x1fe),
+            ('gpt', 0x200),
+            ('linux_raid_member', md10),
+            ('linux_raid_member', start + 0x1000),
+            ('gpt', self.size - 0x200),
+        ])
+
+    def test_4k_sectors(self):
+        parts = self.write_table(4096)
+        start, length = parts[1]
+        self.pwrite(start + 0x438, b'\x53\xef')
+
+        found = self.signatures((), 4096)
+        self.assertIn(('gpt', 0x1000), found)
+        self.assertIn(('gpt', self.size - 0x1000), found)
+        self.assertIn(('ext4', start + 0x438), found)
+        # The table isn't found with the wrong sector size.
+        self.assertNotIn(('ext4', start + 0x438), self.signatures((), 512))
+
+    def test_wipe(self):
+        self.write_table()
+        self.pwrite(0x1f0, b'keep')
+        signatures = wipe.wipe(self.path)
+        self.assertEqual([s.type for s in signatures], ['dos', 'gpt', 'gpt'])
+        self.assertEqual(self.signatures(), [])
+        # Only the magics are cleared.
+        self.assertEqual(self.pread(0x1f0, 4), b'keep')
+        self.assertEqual(self.pread(0x208, 4), b'\0\0\x01\0')
+
+
+if __name__ == '__main__':
+    unittest.main()